@@ -0,0 +1,70 @@
+"""
+Size and decompression time of the crawled pages per codec, over synthetic successive crawls of the recorded page.
+
+Run from the repository root:
+
+    python -m benchmarks.compression [--crawls N]
+
+Each crawl rotates a few videos of tests/html/vtuber_antenna/real.html, like the consecutive crawls 5 minutes apart.
+The zstd dictionary is trained on the first half of the crawls, and the sizes are measured on the second half.
+"""
+import argparse
+import io
+import statistics
+import sys
+import time
+from typing import List
+
+from benchmarks import fixtures
+from vhub.compression import GZIP, ZstdCodec
+from vhub.utils import write_envelope, read_envelope
+
+header = {'url': 'https://vtuber-antenna.net/new/', 'crawled_at': '2020-01-01 00:00:00+00:00', 'videos': None}
+
+
+def successive_crawls(n: int) -> List[str]:
+    html = fixtures.read_file('tests/html/vtuber_antenna/real.html')
+    crawls = []
+
+    for i in range(n):
+        # A new video replaces an old one on every crawl.
+        crawls.append(html.replace('watch?v=', f'watch?v=crawl{i}_', i % 5 + 1))
+
+    return crawls
+
+
+def measure(name: str, codec, pages: List[str]):
+    sizes, times = [], []
+
+    for page in pages:
+        out = io.BytesIO()
+        write_envelope(out, header, page, codec)
+        sizes.append(len(out.getvalue()))
+
+        start = time.perf_counter()
+        read_envelope(io.BytesIO(out.getvalue()), codec=codec)
+        times.append(time.perf_counter() - start)
+
+    print(f"{name:<20} {statistics.mean(sizes) / 1024:>10.1f} KiB {statistics.median(times) * 1000:>10.2f} ms")
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--crawls', type=int, default=40)
+    args = parser.parse_args(argv)
+
+    import zstandard
+
+    crawls = successive_crawls(args.crawls)
+    training, pages = crawls[:len(crawls) // 2], crawls[len(crawls) // 2:]
+    dictionary = zstandard.train_dictionary(112640, [page.encode('utf-8') for page in training]).as_bytes()
+
+    print(f"{'codec':<20} {'mean size':>14} {'decompress':>13}")
+    print(f"{'raw':<20} {statistics.mean(len(page.encode('utf-8')) for page in pages) / 1024:>10.1f} KiB")
+    measure('gzip', GZIP, pages)
+    measure('zstd', ZstdCodec(), pages)
+    measure('zstd+dictionary', ZstdCodec(dictionary), pages)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,158 @@
+import json
+import re
+from gzip import GzipFile
+from io import BytesIO
+from urllib.parse import urlparse, parse_qs
+
+from vhub.youtube import YoutubeVideo
+
+
+def read_file(path: str) -> str:
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def read_bytes(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class FakeS3Object:
+    """
+    Serves a fixed body through `get()`, like `s3.Object`.
+    """
+
+    bucket_name = 'benchmark'
+
+    def __init__(self, body: bytes):
+        self.body = body
+
+    def get(self) -> dict:
+        return {'Body': BytesIO(self.body)}
+
+
+def legacy_envelope(header: dict, body: str) -> bytes:
+    """
+    Returns a page saved in the legacy envelope format: a single gzipped JSON object including the body.
+    """
+    out = BytesIO()
+
+    with GzipFile(fileobj=out, mode='w') as f:
+        f.write(json.dumps({**header, 'body': body}).encode('utf-8'))
+
+    return out.getvalue()
+
+
+def crawled_page(path: str) -> dict:
+    with GzipFile(path, mode='r') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def recorded_video(path: str) -> YoutubeVideo:
+    s = json.loads(read_file(path))['items'][0]['snippet']
+
+    return YoutubeVideo(
+        url="https://www.youtube.com/watch?v=test_video",
+        channel_url=f"https://www.youtube.com/channel/{s['channelId']}",
+        title=s['title'],
+        description=s['description'],
+        tags=s.get('tags', []),
+        thumbnails=s['thumbnails']
+    )
+
+
+def synthetic_vtubers_list(n_channels: int, n_categories: int = 50) -> str:
+    """
+    Returns a page like https://vtuber-antenna.net/list/ with `n_channels` channels.
+    """
+    items = []
+
+    for i in range(n_channels):
+        if i % (n_channels // n_categories or 1) == 0:
+            category = f'category_{i}'
+            items.append(f"<li><h3 id='{category}'><a href='/category?tag={category}'>"
+                         f"<span>{category} >></span></a></h3></li>")
+
+        items.append(f"""
+            <li>
+                <p class='thumbnail'><a href='/channel/?id=UC{i:022d}'><img src='https://yt3.ggpht.com/{i}'></a></p>
+                <p class='channelName'><a href='/channel/?id=UC{i:022d}'>チャンネル {i}</a></p>
+            </li>""")
+
+    return f"""<!doctype html>
+<html lang="ja">
+<head><meta charset="UTF-8"></head>
+<body>
+<div id="main" class="list"><div class="inner"><div id="main-area"><div class="channel">
+<ul class='icon'>{''.join(items)}<li class='empty'></li></ul>
+</div></div></div></div>
+</body>
+</html>"""
+
+
+def synthetic_description(n_urls: int, custom_urls: bool = False) -> str:
+    """
+    Returns a video description mentioning `n_urls` channels among other links and text,
+    by their custom URLs if `custom_urls`, or by their channel IDs otherwise.
+    """
+    lines = []
+
+    for i in range(n_urls):
+        if custom_urls:
+            lines.append(f"参加者 {i}: https://www.youtube.com/c/vtuber_{i}")
+        else:
+            lines.append(f"参加者 {i}: https://www.youtube.com/channel/UC{i:022d}")
+        lines.append(f"Twitter: https://twitter.com/vtuber_{i}")
+
+    return '\n'.join(lines)
+
+
+def _legacy_is_valid_youtube_video_url(url: str) -> bool:
+    o = urlparse(url)
+    qs = parse_qs(o.query)
+
+    return o.scheme == 'https' \
+        and o.netloc == 'www.youtube.com' \
+        and o.path == '/watch' \
+        and 'v' in qs \
+        and re.fullmatch(r"[a-zA-Z0-9_\-]+", qs['v'][0]) is not None
+
+
+def _legacy_youtube_video_id(url: str) -> str:
+    return parse_qs(urlparse(url).query)['v'][0]
+
+
+class LegacyYoutubeVideo:
+    """
+    The dict-backed `YoutubeVideo` as it was before `__slots__`, kept as the baseline of the model benchmarks.
+    """
+
+    def __init__(self, url: str, channel_url=None, title=None,
+                 description=None, published_at=None, tags=None, thumbnails=None,
+                 channel_title=None, live_broadcast_content=None, n_watch=None, n_like=None,
+                 category_id=None, default_language=None, localized=None):
+        if _legacy_is_valid_youtube_video_url(url):
+            self.url = url
+            self.channel_url = channel_url
+            self.channel_title = channel_title
+            self.title = title
+            self.description = description
+            self.published_at = published_at
+            self.tags = tags
+            self.thumbnails = thumbnails
+            self.live_broadcast_content = live_broadcast_content
+            self.n_watch = n_watch
+            self.n_like = n_like
+            self.category_id = category_id
+            self.default_language = default_language
+            self.localized = localized
+        else:
+            raise ValueError(f"{url} is not a valid YouTube video URL.")
+
+    @property
+    def video_id(self) -> str:
+        return _legacy_youtube_video_id(self.url)
+
+
+def video_urls(n: int) -> list:
+    return [f"https://www.youtube.com/watch?v=video{i:06d}" for i in range(n)]
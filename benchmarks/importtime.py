@@ -0,0 +1,87 @@
+"""
+Import-time profile of the Lambda handler modules, i.e. the module-loading part of a cold start.
+
+Run from the repository root:
+
+    python -m benchmarks.importtime [--runs N] [--save PATH] [--compare PATH]
+
+Each handler module is imported in fresh interpreters with `python -X importtime`,
+and the median of its cumulative import time is reported along with the slowest dependencies.
+"""
+import argparse
+import json
+import re
+import statistics
+import subprocess
+import sys
+from typing import List, Dict, Tuple
+
+handlers = [
+    'vhub.fetch_vtuber_antenna',
+    'vhub.fetch_video',
+    'vhub.fetch_vtuber_channels',
+    'vhub.notifier',
+]
+
+_line = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def import_times(module: str) -> Dict[str, int]:
+    """
+    Returns the cumulative import time in microseconds of every top-level module loaded by importing `module`.
+    """
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True, check=True).stderr
+    times = {}
+
+    for match in _line.finditer(output):
+        _, cumulative, indent, name = match.groups()
+        if len(indent) <= 3:
+            times[name] = int(cumulative)
+
+    return times
+
+
+def profile(module: str, runs: int) -> Tuple[float, List[Tuple[str, float]]]:
+    samples = [import_times(module) for _ in range(runs)]
+    total = statistics.median(sample[module] for sample in samples)
+    dependencies = {name: statistics.median(sample.get(name, 0) for sample in samples)
+                    for name in samples[0] if name != module}
+    slowest = sorted(dependencies.items(), key=lambda x: -x[1])[:5]
+
+    return total, slowest
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--save', help='Write the results as JSON to this path.')
+    parser.add_argument('--compare', help='Compare with the results saved at this path.')
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+
+    for module in handlers:
+        total, slowest = profile(module, args.runs)
+        results[module] = total
+
+        line = f"{module:<30} {total / 1000:>8.1f} ms"
+        if module in baseline:
+            line += f"  (baseline {baseline[module] / 1000:.1f} ms, {total / baseline[module]:.2f}x)"
+        print(line)
+
+        for name, time in slowest:
+            print(f"    {name:<26} {time / 1000:>8.1f} ms")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,286 @@
+"""
+Benchmarks of the hot paths over the recorded fixtures, with synthetic scale-ups.
+
+Run from the repository root:
+
+    python -m benchmarks.run [--filter SUBSTRING] [--save PATH] [--compare PATH] [--metrics]
+
+Each benchmark reports the throughput (ops/sec, the best of several rounds) and the peak memory
+allocated by a single call, as traced by `tracemalloc` (which does not see the C heap of e.g. lxml).
+`--save` writes the results as JSON, which a later run can be compared with by `--compare`.
+`--metrics` aggregates the stage metrics of `vhub.metrics` recorded during the benchmarks, and prints their summary.
+"""
+import argparse
+import io
+import json
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+from dataclasses import dataclass, asdict
+from typing import Callable, List, Dict
+
+from benchmarks import fixtures
+from vhub import metrics
+from vhub.fetch_video import extract_html
+from vhub.mentions import MentionMatcher, alias_key
+from vhub.notifier import message
+from vhub.parsers import parse_videos_list, parse_vtubers_list
+from vhub.utils import extract_gzip, emptystr_to_none, gzip_str, write_envelope, read_envelope
+from vhub.youtube import YoutubeVideo, mentioned_channel_urls
+
+
+@dataclass(frozen=True)
+class Benchmark:
+    name: str
+    # Called once before timing; returns the function to benchmark.
+    setup: Callable[[], Callable[[], object]]
+
+
+@dataclass(frozen=True)
+class Result:
+    name: str
+    ops_per_sec: float
+    peak_memory_bytes: int
+
+
+benchmarks: List[Benchmark] = []
+
+
+def benchmark(name: str):
+    def register(setup: Callable[[], Callable[[], object]]):
+        benchmarks.append(Benchmark(name, setup))
+        return setup
+
+    return register
+
+
+@benchmark('parse_videos_list[real]')
+def _():
+    html = fixtures.read_file('tests/html/vtuber_antenna/real.html')
+    return lambda: list(parse_videos_list(html))
+
+
+@benchmark('parse_vtubers_list[real]')
+def _():
+    html = fixtures.read_file('tests/html/vtuber_antenna/list/real.html')
+    return lambda: list(parse_vtubers_list(html))
+
+
+@benchmark('parse_vtubers_list[synthetic_20k]')
+def _():
+    html = fixtures.synthetic_vtubers_list(20000)
+    return lambda: list(parse_vtubers_list(html))
+
+
+@benchmark('extract_gzip[s3_object]')
+def _():
+    body = fixtures.read_bytes('tests/s3_object/251839840704.json.gz')
+    return lambda: extract_gzip(body)
+
+
+@benchmark('extract_html[s3_object]')
+def _():
+    obj = fixtures.FakeS3Object(fixtures.read_bytes('tests/s3_object/251839840704.json.gz'))
+    return lambda: extract_html(obj)
+
+
+def _large_page() -> tuple:
+    header = {'url': 'https://vtuber-antenna.net/list/', 'crawled_at': '2020-01-01 00:00:00+00:00', 'videos': None}
+    return header, fixtures.synthetic_vtubers_list(20000)
+
+
+@benchmark('save[legacy_json_gzip_str][synthetic_20k]')
+def _():
+    header, body = _large_page()
+    return lambda: gzip_str(json.dumps({**header, 'body': body}))
+
+
+@benchmark('save[write_envelope][synthetic_20k]')
+def _():
+    header, body = _large_page()
+    return lambda: write_envelope(io.BytesIO(), header, body)
+
+
+@benchmark('load[legacy_extract_gzip_json][synthetic_20k]')
+def _():
+    obj = fixtures.FakeS3Object(fixtures.legacy_envelope(*_large_page()))
+    return lambda: json.loads(extract_gzip(obj.get()['Body'].read()))
+
+
+@benchmark('load[read_envelope][synthetic_20k]')
+def _():
+    header, body = _large_page()
+    out = io.BytesIO()
+    write_envelope(out, header, body)
+    obj = fixtures.FakeS3Object(out.getvalue())
+    return lambda: read_envelope(obj.get()['Body'])
+
+
+@benchmark('load[read_envelope_header][synthetic_20k]')
+def _():
+    header, body = _large_page()
+    out = io.BytesIO()
+    write_envelope(out, header, body)
+    obj = fixtures.FakeS3Object(out.getvalue())
+    return lambda: read_envelope(obj.get()['Body'], with_body=False)
+
+
+@benchmark('emptystr_to_none[video]')
+def _():
+    video = fixtures.recorded_video('tests/api_responses/youtube/videos/list/one_mention.json')
+    item = video.to_item()
+    return lambda: emptystr_to_none(item)
+
+
+@benchmark('mentioned_channel_urls[real]')
+def _():
+    video = fixtures.recorded_video('tests/api_responses/youtube/videos/list/one_mention.json')
+    return lambda: mentioned_channel_urls(video)
+
+
+@benchmark('mentioned_channel_urls[synthetic_200_urls]')
+def _():
+    video = YoutubeVideo("https://www.youtube.com/watch?v=test_video",
+                         description=fixtures.synthetic_description(200))
+    return lambda: mentioned_channel_urls(video)
+
+
+@benchmark('mentioned_channel_urls[synthetic_200_urls_20k_aliases]')
+def _():
+    aliases = {alias_key('c', f'vtuber_{i}'): f"https://www.youtube.com/channel/UC{i:022d}" for i in range(20000)}
+    matcher = MentionMatcher(aliases)
+    video = YoutubeVideo("https://www.youtube.com/watch?v=test_video",
+                         description=fixtures.synthetic_description(200, custom_urls=True))
+    return lambda: mentioned_channel_urls(video, matcher)
+
+
+@benchmark('message[2_channels]')
+def _():
+    video = fixtures.recorded_video('tests/api_responses/youtube/videos/list/one_mention.json')
+    return lambda: message(video, ['月ノ美兎', '樋口楓'])
+
+
+@benchmark('message[20_channels]')
+def _():
+    video = fixtures.recorded_video('tests/api_responses/youtube/videos/list/one_mention.json')
+    return lambda: message(video, [f'チャンネル名 {i}' for i in range(20)])
+
+
+@benchmark('YoutubeVideo[construct_10k]')
+def _():
+    urls = fixtures.video_urls(10000)
+    return lambda: [YoutubeVideo(url) for url in urls]
+
+
+@benchmark('LegacyYoutubeVideo[construct_10k]')
+def _():
+    urls = fixtures.video_urls(10000)
+    return lambda: [fixtures.LegacyYoutubeVideo(url) for url in urls]
+
+
+@benchmark('YoutubeVideo[video_id_10k]')
+def _():
+    videos = [YoutubeVideo(url) for url in fixtures.video_urls(10000)]
+    return lambda: [video.video_id for video in videos]
+
+
+@benchmark('LegacyYoutubeVideo[video_id_10k]')
+def _():
+    videos = [fixtures.LegacyYoutubeVideo(url) for url in fixtures.video_urls(10000)]
+    return lambda: [video.video_id for video in videos]
+
+
+@benchmark('YoutubeVideo[to_item_from_item_10k]')
+def _():
+    videos = [YoutubeVideo(url, title='title') for url in fixtures.video_urls(10000)]
+    return lambda: [YoutubeVideo.from_item(video.to_item()) for video in videos]
+
+
+@benchmark('LegacyYoutubeVideo[vars_10k]')
+def _():
+    videos = [fixtures.LegacyYoutubeVideo(url, title='title') for url in fixtures.video_urls(10000)]
+    return lambda: [fixtures.LegacyYoutubeVideo(**vars(video)) for video in videos]
+
+
+def measure(bench: Benchmark, min_time: float, rounds: int) -> Result:
+    func = bench.setup()
+
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    best = min(timer.repeat(repeat=rounds, number=number)) / number
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return Result(name=bench.name, ops_per_sec=1 / best, peak_memory_bytes=peak)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except Exception:
+        return 'unknown'
+
+
+def report(results: List[Result], baseline: Dict[str, dict]):
+    print(f"{'benchmark':<45} {'ops/sec':>12} {'peak memory':>14} {'vs baseline':>12}")
+
+    for result in results:
+        line = f"{result.name:<45} {result.ops_per_sec:>12.1f} {result.peak_memory_bytes / 1024:>11.1f} KiB"
+
+        if result.name in baseline:
+            ratio = result.ops_per_sec / baseline[result.name]['ops_per_sec']
+            line += f" {ratio:>11.2f}x"
+
+        print(line)
+
+
+def report_metrics(summary: Dict[str, dict]):
+    print(f"\n{'metric':<30} {'unit':>12} {'count':>10} {'p50':>12} {'p95':>12} {'max':>12}")
+
+    for name, stats in summary.items():
+        print(f"{name:<30} {stats['unit']:>12} {stats['count']:>10} "
+              f"{stats['p50']:>12.3f} {stats['p95']:>12.3f} {stats['max']:>12.3f}")
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filter', default='', help='Run only the benchmarks whose name contains this.')
+    parser.add_argument('--save', help='Write the results as JSON to this path.')
+    parser.add_argument('--compare', help='Compare with the results saved at this path.')
+    parser.add_argument('--min-time', type=float, default=0.2, help='Seconds to spend per round.')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--metrics', action='store_true', help='Print the summary of the stage metrics.')
+    args = parser.parse_args(argv)
+
+    recorder = metrics.configure('local' if args.metrics else 'off')
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {result['name']: result for result in json.load(f)['results']}
+
+    results = [measure(bench, args.min_time, args.rounds) for bench in benchmarks if args.filter in bench.name]
+    report(results, baseline)
+
+    if args.metrics:
+        report_metrics(recorder.summary())
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'results': [asdict(result) for result in results]
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
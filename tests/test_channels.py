@@ -0,0 +1,178 @@
+from typing import List
+
+import boto3
+from moto import mock_dynamodb2
+
+from vhub.channels import ChannelDirectory, ChannelRepository
+
+
+class MockClient:
+    def __init__(self, items: List[dict]):
+        self.items = items
+        self.batch_get_item_keys = []
+
+    def batch_get_item(self, RequestItems: dict) -> dict:
+        (table_name, request), = RequestItems.items()
+        urls = [key['url'] for key in request['Keys']]
+        self.batch_get_item_keys.append(sorted(urls))
+
+        return {'Responses': {table_name: [item for item in self.items if item['url'] in urls]}}
+
+    def scan(self, TableName: str, Segment: int, TotalSegments: int, ExclusiveStartKey: dict = None) -> dict:
+        return {'Items': self.items if Segment == 0 else []}
+
+
+class MockTable:
+    def __init__(self, items: List[dict]):
+        self.name = 'Channels'
+        self.items = {item['url']: item for item in items}
+        self.meta = type('Meta', (), {'client': MockClient(items)})
+        self.n_get_item = 0
+
+    def get_item(self, Key: dict) -> dict:
+        self.n_get_item += 1
+        item = self.items.get(Key['url'])
+        return {} if item is None else {'Item': item}
+
+
+class MockClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+known_url = 'https://www.youtube.com/channel/Av87muUsEdf7amViaQ4L84'
+unknown_url = 'https://www.youtube.com/channel/ZLe5IzkSGQaDtd6VqgDE3i'
+items = [{'url': known_url, 'name': 'test_channel', 'is_host_blacklisted': True}]
+
+
+def test_caches_known_and_unknown_channels():
+    table = MockTable(items)
+    directory = ChannelDirectory(table)
+
+    for _ in range(3):
+        assert directory.get(known_url).name == 'test_channel'
+        assert directory.get(known_url).is_host_blacklisted
+        assert directory.get(unknown_url) is None
+
+    assert table.n_get_item == 2
+    assert (directory.hits, directory.misses) == (7, 2)
+
+
+def test_entries_expire():
+    table = MockTable(items)
+    clock = MockClock()
+    directory = ChannelDirectory(table, ttl=10, negative_ttl=5, clock=clock)
+
+    directory.get(known_url)
+    directory.get(unknown_url)
+    clock.now = 7
+    directory.get(known_url)
+    directory.get(unknown_url)
+
+    assert table.n_get_item == 3
+
+    clock.now = 11
+    directory.get(known_url)
+
+    assert table.n_get_item == 4
+
+
+def test_evicts_least_recently_used_entry():
+    urls = [f'https://www.youtube.com/channel/channel_{i}' for i in range(3)]
+    table = MockTable([{'url': url, 'name': url} for url in urls])
+    directory = ChannelDirectory(table, maxsize=2)
+
+    directory.get(urls[0])
+    directory.get(urls[1])
+    directory.get(urls[0])
+    directory.get(urls[2])
+
+    assert len(directory) == 2
+
+    directory.get(urls[0])
+    assert table.n_get_item == 3
+
+    directory.get(urls[1])
+    assert table.n_get_item == 4
+
+
+def test_preload_answers_without_get_item():
+    table = MockTable(items)
+    clock = MockClock()
+    directory = ChannelDirectory(table, ttl=10, clock=clock)
+
+    directory.preload()
+
+    assert directory.get(known_url).name == 'test_channel'
+    assert directory.get(unknown_url) is None
+    assert table.n_get_item == 0
+
+    clock.now = 11
+    directory.get(unknown_url)
+
+    assert table.n_get_item == 1
+
+
+def test_preload_of_table_larger_than_cache_is_not_complete():
+    urls = [f'https://www.youtube.com/channel/channel_{i}' for i in range(3)]
+    table = MockTable([{'url': url, 'name': url} for url in urls])
+    directory = ChannelDirectory(table, maxsize=2)
+
+    directory.preload()
+    directory.get(unknown_url)
+
+    assert table.n_get_item == 1
+
+
+def test_get_many_fetches_misses_at_once():
+    table = MockTable(items)
+    directory = ChannelDirectory(table)
+
+    directory.get(known_url)
+    out = directory.get_many([known_url, unknown_url, unknown_url])
+
+    assert out[known_url].name == 'test_channel'
+    assert out[unknown_url] is None
+    assert table.meta.client.batch_get_item_keys == [[unknown_url]]
+
+    directory.get_many([known_url, unknown_url])
+
+    assert len(table.meta.client.batch_get_item_keys) == 1
+    assert (directory.hits, directory.misses) == (3, 2)
+
+
+@mock_dynamodb2
+def test_repository_get_many():
+    db = boto3.resource('dynamodb', region_name='us-east-2')
+    db.create_table(
+        TableName='Channels',
+        KeySchema=[
+            {
+                'AttributeName': 'url',
+                'KeyType': 'HASH'
+            }
+        ],
+        AttributeDefinitions=[
+            {
+                'AttributeName': 'url',
+                'AttributeType': 'S'
+            },
+        ],
+        ProvisionedThroughput={
+            'ReadCapacityUnits': 1,
+            'WriteCapacityUnits': 1
+        }
+    )
+    table = db.Table('Channels')
+    urls = [f'https://www.youtube.com/channel/channel_{i}' for i in range(120)]
+    for url in urls[:110]:
+        table.put_item(Item={'url': url, 'name': url, 'is_guest_blacklisted': True})
+
+    out = ChannelRepository(table).get_many(urls)
+
+    assert set(out.keys()) == set(urls)
+    assert all(out[url].name == url and out[url].is_guest_blacklisted for url in urls[:110])
+    assert all(out[url] is None for url in urls[110:])
@@ -0,0 +1,67 @@
+import io
+
+import boto3
+import pytest
+import requests_mock
+from moto import mock_s3
+
+from vhub.compression import GZIP, ZstdCodec, is_crawl_key, train_dictionary
+from vhub.fetch_video import extract_page
+from vhub.fetch_vtuber_antenna import crawl
+from vhub.utils import write_envelope, read_envelope
+from tests.utils import read_file
+
+header = {'url': 'https://vtuber-antenna.net/new/', 'crawled_at': '2020-01-01 00:00:00+00:00', 'videos': ['a', 'b']}
+
+
+@pytest.fixture
+def bucket():
+    with mock_s3():
+        bucket = boto3.resource("s3").Bucket("crawled-webpage")
+        bucket.create()
+        yield bucket
+
+
+def round_trip(codec, body: str) -> dict:
+    out = io.BytesIO()
+    write_envelope(out, header, body, codec)
+    out.seek(0)
+
+    return read_envelope(out, codec=codec)
+
+
+def test_gzip_round_trip():
+    body = read_file('tests/html/vtuber_antenna/real.html')
+    assert round_trip(GZIP, body) == {**header, 'body': body}
+
+
+def test_zstd_round_trip():
+    pytest.importorskip('zstandard')
+    body = read_file('tests/html/vtuber_antenna/real.html')
+
+    assert round_trip(ZstdCodec(), body) == {**header, 'body': body}
+
+
+def test_is_crawl_key():
+    assert is_crawl_key('251839840704.json.gz')
+    assert is_crawl_key('251839840704.json.zst')
+    assert not is_crawl_key('dictionaries/1234.zdict')
+
+
+def test_crawl_with_zstd_dictionary(bucket):
+    pytest.importorskip('zstandard')
+    url = 'https://vtuber-antenna.net/new/'
+    html = read_file('tests/html/vtuber_antenna/real.html')
+    samples = [html.replace('</body>', f'<!-- {i} --></body>').encode('utf-8') for i in range(20)]
+
+    dictionary_id = train_dictionary(bucket, samples, size=16384)
+    codec = ZstdCodec(bucket.Object(f'dictionaries/{dictionary_id}.zdict').get()['Body'].read())
+
+    with requests_mock.Mocker() as m:
+        m.get(url, text=html)
+        obj = crawl(url, bucket, codec)
+
+    assert obj.key.endswith('.json.zst')
+    assert obj.content_encoding == 'zstd'
+    assert obj.metadata['zstd-dictionary'] == dictionary_id
+    assert extract_page(obj)['body'] == html
@@ -1,15 +1,24 @@
+import json
+import threading
+import time
+from typing import Iterable, List
+
 import boto3
 import pytest
 from moto import mock_dynamodb2, mock_s3
 
-from vhub.fetch_video import parse_videos_list, main, save_video
+from vhub import fetch_video
+from vhub.fetch_video import parse_videos_list, main, save_video, save_videos, get_new_videos, \
+    fetch_and_save_videos, get_previous_object
+from vhub.quota import QuotaLedger, FileQuotaStore
+from vhub.utils import gzip_str
 from vhub.youtube import YoutubeVideo
 from tests.utils import read_file, read_json
 
 
 class MockYouTube:
-    def get_video_detail(self, video: YoutubeVideo) -> YoutubeVideo:
-        return YoutubeVideo("https://www.youtube.com/watch?v=test_video")
+    def get_video_details(self, videos: Iterable[YoutubeVideo]) -> List[YoutubeVideo]:
+        return [YoutubeVideo("https://www.youtube.com/watch?v=test_video") for _ in videos]
 
 
 @pytest.fixture
@@ -70,6 +79,46 @@ def test_main(setup_s3):
         assert isinstance(video, YoutubeVideo)
 
 
+def test_get_new_videos_from_saved_video_ids(setup_s3):
+    _, s3_client = setup_s3
+    bucket = s3_client.Bucket('crawled-webpages')
+
+    def put_page(key, videos):
+        body = json.dumps({'url': 'https://vtuber-antenna.net/new/', 'body': '', 'videos': videos})
+        bucket.put_object(Key=key, Body=gzip_str(body), ContentEncoding='gzip')
+        return bucket.Object(key)
+
+    prev = put_page('251839841304.json.gz', ['03H1qSot9_s', 'uaQS2ZnrFQg'])
+    new = put_page('251839841004.json.gz', ['RnDf_nvcx3A', 'uaQS2ZnrFQg'])
+
+    videos = get_new_videos(new, prev)
+
+    assert videos == {YoutubeVideo('https://www.youtube.com/watch?v=RnDf_nvcx3A')}
+
+
+def test_main_fetches_deferred_videos(setup_s3, tmp_path):
+    event, s3_client = setup_s3
+    store = FileQuotaStore(str(tmp_path / 'quota.json'))
+    store.defer(["https://www.youtube.com/watch?v=deferred_video"])
+    youtube = MockYouTube()
+    youtube.ledger = QuotaLedger(store)
+
+    videos = list(main(event, s3_client, youtube))
+
+    assert len(videos) == 3
+    # Kept until the videos are saved.
+    assert store.get_deferred() == ["https://www.youtube.com/watch?v=deferred_video"]
+
+
+def test_previous_object_is_a_crawled_page(setup_s3):
+    _, s3_client = setup_s3
+    bucket = s3_client.Bucket('crawled-webpages')
+    bucket.put_object(Key='dictionaries/1234.zdict', Body=b'dictionary')
+
+    assert get_previous_object(bucket.Object('251839840704.json.gz')).key == '251839841004.json.gz'
+    assert get_previous_object(bucket.Object('251839841004.json.gz')) is None
+
+
 def test_parse_minimal_html():
     html = read_file('tests/html/vtuber_antenna/minimal.html')
     videos = parse_videos_list(html)
@@ -114,4 +163,128 @@ def test_save_video_with_empty_string(table):
     response = table.get_item(Key={"url": url})
     out = response['Item']
 
-    assert out == vars(video)
+    assert out == video.to_item()
+
+
+def test_save_videos(table):
+    urls = [f"https://www.youtube.com/watch?v=test_video_{i}" for i in range(30)]
+    videos = [YoutubeVideo(url=url, title="") for url in urls]
+
+    save_videos(table, videos)
+
+    for url in urls:
+        out = table.get_item(Key={"url": url})['Item']
+
+        assert out['url'] == url
+        assert out['title'] is None
+
+
+def test_save_videos_keeps_saved_videos(table):
+    url = "https://www.youtube.com/watch?v=test_video"
+    table.put_item(Item={"url": url, "title": "saved"})
+
+    save_videos(table, [YoutubeVideo(url=url, title="fetched again")])
+
+    assert table.get_item(Key={"url": url})['Item']['title'] == "saved"
+
+
+class SlowYouTube:
+    """
+    Takes a while to return the videos as they are, failing for those whose URL contains "fail".
+    """
+
+    def __init__(self):
+        self.running = 0
+        self.max_running = 0
+        self.fetched = []
+        self.lock = threading.Lock()
+
+    def get_video_details(self, videos: Iterable[YoutubeVideo]) -> List[YoutubeVideo]:
+        with self.lock:
+            self.fetched.extend(video.url for video in videos)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+        time.sleep(0.05)
+
+        with self.lock:
+            self.running -= 1
+
+        if any('fail' in video.url for video in videos):
+            raise RuntimeError('Failed to fetch the videos.')
+
+        return [YoutubeVideo(url=video.url, title="title") for video in videos]
+
+
+def test_fetch_and_save_videos(table):
+    urls = [f"https://www.youtube.com/watch?v=test_video_{i}" for i in range(60)]
+    youtube = SlowYouTube()
+
+    fetch_and_save_videos(table, [YoutubeVideo(url) for url in urls], youtube, concurrency=4, chunk_size=5)
+
+    for url in urls:
+        assert table.get_item(Key={"url": url})['Item']['title'] == "title"
+
+    assert youtube.max_running > 1
+
+
+def test_fetch_and_save_videos_isolates_failures(table):
+    urls = ["https://www.youtube.com/watch?v=test_video", "https://www.youtube.com/watch?v=fail"]
+    youtube = SlowYouTube()
+
+    fetch_and_save_videos(table, [YoutubeVideo(url) for url in urls], youtube, chunk_size=1)
+
+    assert 'Item' in table.get_item(Key={"url": urls[0]})
+    assert 'Item' not in table.get_item(Key={"url": urls[1]})
+
+
+def test_fetch_and_save_videos_skips_saved_videos(table):
+    urls = [f"https://www.youtube.com/watch?v=test_video_{i}" for i in range(4)]
+    table.put_item(Item={"url": urls[0], "title": "saved"})
+    youtube = SlowYouTube()
+
+    fetch_and_save_videos(table, [YoutubeVideo(url) for url in urls], youtube)
+
+    assert sorted(youtube.fetched) == urls[1:]
+    assert table.get_item(Key={"url": urls[0]})['Item']['title'] == "saved"
+
+
+def test_fetch_and_save_videos_survives_failing_saves(table, monkeypatch):
+    saved = []
+
+    def save_videos(table, videos):
+        if any('fail' in video.url for video in videos):
+            raise RuntimeError('Failed to save the videos.')
+        saved.extend(video.url for video in videos)
+        return [video.url for video in videos]
+
+    monkeypatch.setattr(fetch_video, 'save_videos', save_videos)
+    urls = [f"https://www.youtube.com/watch?v=test_video_{i}" for i in range(10)]
+    # Fetched fine, but failing to be saved.
+    urls[0] = "https://www.youtube.com/watch?v=will_fail"
+    youtube = SlowYouTube()
+    youtube.get_video_details = lambda videos: [YoutubeVideo(url=video.url) for video in videos]
+
+    thread = threading.Thread(target=fetch_and_save_videos,
+                              args=(table, [YoutubeVideo(url) for url in urls], youtube),
+                              kwargs={'concurrency': 2, 'chunk_size': 1, 'queue_size': 2}, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+
+    assert not thread.is_alive()
+    assert sorted(saved) == sorted(urls[1:])
+
+
+def test_fetch_and_save_videos_resolves_saved_deferred_videos(table, tmp_path):
+    urls = ["https://www.youtube.com/watch?v=saved", "https://www.youtube.com/watch?v=new",
+            "https://www.youtube.com/watch?v=fail"]
+    table.put_item(Item={"url": urls[0], "title": "saved"})
+    store = FileQuotaStore(str(tmp_path / 'quota.json'))
+    store.defer(urls)
+    youtube = SlowYouTube()
+    youtube.ledger = QuotaLedger(store)
+    deferred = [YoutubeVideo(url) for url in youtube.ledger.deferred()]
+
+    fetch_and_save_videos(table, deferred, youtube, chunk_size=1)
+
+    assert store.get_deferred() == ["https://www.youtube.com/watch?v=fail"]
@@ -4,7 +4,11 @@ import requests
 import requests_mock
 from moto import mock_s3
 
-from vhub.fetch_vtuber_antenna import main
+from vhub.compression import is_crawl_key
+from vhub.fetch_video import extract_page, get_previous_object
+from vhub.fetch_vtuber_antenna import main, crawl, latest_crawl
+from vhub.manifest import load_manifest, MANIFEST_KEY
+from tests.utils import read_file
 
 
 def mock_request(url: str, text: str, headers: dict = {}, method: str = 'GET') -> requests.Response:
@@ -13,6 +17,10 @@ def mock_request(url: str, text: str, headers: dict = {}, method: str = 'GET') -
         return requests.get(url)
 
 
+def crawled_keys(bucket) -> list:
+    return [summary.key for summary in bucket.objects.all() if is_crawl_key(summary.key)]
+
+
 @pytest.fixture
 def bucket():
     with mock_s3():
@@ -34,6 +42,16 @@ def test_page_item_represents_the_response_page(bucket):
     assert page.body == body
 
 
+def test_page_item_has_video_ids(bucket):
+    url = 'https://vtuber-antenna.net/new/'
+    body = read_file('tests/html/vtuber_antenna/minimal.html')
+    response = mock_request(url, body)
+
+    _, page = main(response, bucket)
+
+    assert page.videos == ['n-8AN0WbZ_M', 'E_geYW37sMM', '6xRWmw-388k']
+
+
 def test_newer_object_has_smaller_key(bucket):
     url = 'http://example.com/'
     body = 'test_body'
@@ -47,3 +65,163 @@ def test_newer_object_has_smaller_key(bucket):
     obj_next, _ = main(response_next, bucket)
 
     assert obj_prev.key > obj_next.key
+
+
+def test_crawl_skips_unchanged_videos(bucket):
+    url = 'https://vtuber-antenna.net/new/'
+    html = read_file('tests/html/vtuber_antenna/minimal.html')
+
+    with requests_mock.Mocker() as m:
+        m.get(url, text=html, headers={'Date': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        assert crawl(url, bucket) is not None
+
+        # The same videos on a page with different markup.
+        m.get(url, text=html.replace('<head>', '<head><title>ad</title>'),
+              headers={'Date': 'Wed, 21 Oct 2015 07:33:00 GMT'})
+        assert crawl(url, bucket) is None
+
+        m.get(url, text=html.replace('n-8AN0WbZ_M', 'uaQS2ZnrFQg'),
+              headers={'Date': 'Wed, 21 Oct 2015 07:38:00 GMT'})
+        assert crawl(url, bucket) is not None
+
+    assert len(crawled_keys(bucket)) == 2
+
+
+def test_crawl_sends_validators_of_the_latest_page(bucket):
+    url = 'https://vtuber-antenna.net/new/'
+    html = read_file('tests/html/vtuber_antenna/minimal.html')
+    etag = '"5d1a2c3f-14f1d"'
+    last_modified = 'Wed, 21 Oct 2015 07:28:00 GMT'
+
+    with requests_mock.Mocker() as m:
+        m.get(url, text=html, headers={'ETag': etag, 'Last-Modified': last_modified})
+        obj = crawl(url, bucket)
+
+        assert obj.metadata['etag'] == etag
+        assert load_manifest(bucket)[0].validators == {'etag': etag, 'last-modified': last_modified}
+
+        m.get(url, status_code=304)
+        assert crawl(url, bucket) is None
+        assert m.last_request.headers['If-None-Match'] == etag
+        assert m.last_request.headers['If-Modified-Since'] == last_modified
+
+    assert len(crawled_keys(bucket)) == 1
+
+
+def test_saved_page_round_trip(bucket):
+    url = 'https://vtuber-antenna.net/new/'
+    html = read_file('tests/html/vtuber_antenna/minimal.html')
+
+    with requests_mock.Mocker() as m:
+        m.get(url, text=html)
+        obj = crawl(url, bucket)
+
+    page = extract_page(obj)
+    header = extract_page(obj, with_body=False)
+
+    assert obj.content_encoding == 'gzip'
+    assert page['body'] == html
+    assert page['videos'] == ['n-8AN0WbZ_M', 'E_geYW37sMM', '6xRWmw-388k']
+    assert header == {key: value for key, value in page.items() if key != 'body'}
+
+
+def test_crawl_follows_pages(bucket):
+    url = 'https://vtuber-antenna.net/new/'
+    html = read_file('tests/html/vtuber_antenna/minimal.html')
+    # The second page, where the last video of the first page has been pushed while crawling.
+    html_2 = html.replace('n-8AN0WbZ_M', 'uaQS2ZnrFQg').replace('E_geYW37sMM', 'RnDf_nvcx3A')
+
+    with requests_mock.Mocker() as m:
+        m.get(url, text=html)
+        m.get(f'{url}?page=2', text=html_2)
+        m.get(f'{url}?page=3', status_code=404)
+        obj = crawl(url, bucket, max_pages=5, concurrency=2)
+
+        assert all(request.timeout is not None for request in m.request_history)
+
+    page = extract_page(obj, with_body=False)
+
+    assert page['videos'] == ['n-8AN0WbZ_M', 'E_geYW37sMM', '6xRWmw-388k', 'uaQS2ZnrFQg', 'RnDf_nvcx3A']
+    assert [p['url'] for p in page['pages']] == [url, f'{url}?page=2']
+    assert extract_page(obj)['body'] == html
+
+
+def test_crawl_stops_at_known_page(bucket):
+    url = 'https://vtuber-antenna.net/new/'
+    html = read_file('tests/html/vtuber_antenna/minimal.html')
+    html_2 = html.replace('n-8AN0WbZ_M', 'uaQS2ZnrFQg')
+
+    with requests_mock.Mocker() as m:
+        m.get(url, text=html, headers={'Date': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        m.get(f'{url}?page=2', text=html_2)
+        m.get(f'{url}?page=3', status_code=404)
+        crawl(url, bucket, max_pages=3, concurrency=1)
+        assert m.call_count == 3
+
+        # A new video pushes the known ones to the second page, where the crawl stops.
+        m.get(url, text=html.replace('6xRWmw-388k', 'new_video_1'), headers={'Date': 'Wed, 21 Oct 2015 07:33:00 GMT'})
+        m.get(f'{url}?page=2', text=html)
+        m.reset_mock()
+        obj = crawl(url, bucket, max_pages=3, concurrency=1)
+
+        assert [request.url for request in m.request_history] == [url, f'{url}?page=2']
+
+    assert 'new_video_1' in extract_page(obj, with_body=False)['videos']
+
+
+def test_crawl_records_manifest(bucket):
+    url = 'https://vtuber-antenna.net/new/'
+    html = read_file('tests/html/vtuber_antenna/minimal.html')
+
+    with requests_mock.Mocker() as m:
+        m.get(url, text=html, headers={'Date': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        first = crawl(url, bucket)
+
+        m.get(url, text=html.replace('n-8AN0WbZ_M', 'uaQS2ZnrFQg'), headers={'Date': 'Wed, 21 Oct 2015 07:33:00 GMT'})
+        second = crawl(url, bucket)
+
+    manifest = load_manifest(bucket)
+
+    assert [(entry.key, entry.previous) for entry in manifest] == [(second.key, first.key), (first.key, None)]
+    assert manifest[0].videos_digest == second.metadata['videos-digest']
+    assert get_previous_object(second).key == first.key
+    assert get_previous_object(first) is None
+
+
+def test_previous_object_of_page_not_in_manifest(bucket):
+    url = 'https://vtuber-antenna.net/new/'
+    html = read_file('tests/html/vtuber_antenna/minimal.html')
+    # A page crawled before the manifest was introduced.
+    with open('tests/s3_object/251839841004.json.gz', 'rb') as f:
+        bucket.put_object(Key='251839841304.json.gz', Body=f, ContentEncoding='gzip')
+
+    with requests_mock.Mocker() as m:
+        m.get(url, text=html)
+        obj = crawl(url, bucket)
+
+    bucket.Object(MANIFEST_KEY).delete()
+
+    assert get_previous_object(obj).key == '251839841304.json.gz'
+
+
+def test_latest_crawl_ignores_other_objects(bucket):
+    bucket.put_object(Key='dictionaries/1234.zdict', Body=b'dictionary')
+
+    assert latest_crawl(bucket) is None
+
+
+def test_crawl_skips_unchanged_pages(bucket):
+    url = 'https://vtuber-antenna.net/new/'
+    html = read_file('tests/html/vtuber_antenna/minimal.html')
+    html_2 = html.replace('n-8AN0WbZ_M', 'uaQS2ZnrFQg')
+
+    with requests_mock.Mocker() as m:
+        m.get(url, text=html, headers={'Date': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        m.get(f'{url}?page=2', text=html_2)
+        m.get(f'{url}?page=3', status_code=404)
+        assert crawl(url, bucket, max_pages=3) is not None
+
+        m.get(url, text=html, headers={'Date': 'Wed, 21 Oct 2015 07:33:00 GMT'})
+        assert crawl(url, bucket, max_pages=3) is None
+
+    assert len(crawled_keys(bucket)) == 1
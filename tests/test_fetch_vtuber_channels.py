@@ -1,11 +1,13 @@
+from typing import List
+
 import boto3
 import pytest
 import requests
 import requests_mock
 from moto import mock_dynamodb2
 
-from vhub.fetch_vtuber_channels import parse_vtubers_list, main, save_channel
-from vhub.youtube import YoutubeChannel
+from vhub.fetch_vtuber_channels import parse_vtubers_list, main, save_channel, diff_channels
+from vhub.youtube import YoutubeChannel, YouTube, YouTubeBackend
 from tests.utils import read_file
 
 
@@ -41,6 +43,31 @@ def table():
         yield db.Table('Channels')
 
 
+class MockBackend(YouTubeBackend):
+    def __init__(self, custom_urls: dict):
+        self.custom_urls = custom_urls
+        self.calls = []
+
+    def list_videos(self, video_ids: List[str]) -> dict:
+        return {'items': []}
+
+    def list_channels(self, channel_ids: List[str]) -> dict:
+        self.calls.append(channel_ids)
+        return {'items': [{'id': id, 'snippet': {'customUrl': self.custom_urls[id]}}
+                          for id in channel_ids if id in self.custom_urls]}
+
+
+def create_alias_table():
+    db = boto3.resource('dynamodb', region_name='us-east-2')
+    db.create_table(
+        TableName='ChannelAliases',
+        KeySchema=[{'AttributeName': 'alias', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'alias', 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+    )
+    return db.Table('ChannelAliases')
+
+
 def test_main(table):
     url = 'https://vtuber-antenna.net/list/'
     body = read_file('tests/html/vtuber_antenna/list/minimal.html')
@@ -59,6 +86,64 @@ def test_main(table):
     assert set(out['affiliations']) == {'カバー', 'ホロライブ'}
 
 
+def test_main_keeps_blacklist_flags(table):
+    url = 'https://vtuber-antenna.net/list/'
+    body = read_file('tests/html/vtuber_antenna/list/minimal.html')
+    response = mock_request(url, body)
+    channel_url = 'https://www.youtube.com/channel/UCp6993wxpyDPHUpavwDFqgg'
+    table.put_item(Item={'url': channel_url, 'name': 'old_name', 'is_host_blacklisted': True})
+
+    main(response, table)
+
+    out = table.get_item(Key={'url': channel_url})['Item']
+
+    assert out['name'] == 'SoraCh. ときのそらチャンネル'
+    assert out['is_host_blacklisted'] is True
+
+
+def test_main_writes_only_changed_channels(table):
+    url = 'https://vtuber-antenna.net/list/'
+    body = read_file('tests/html/vtuber_antenna/list/minimal.html')
+
+    diff = main(mock_request(url, body), table)
+    assert (len(diff.inserted), len(diff.updated), len(diff.unchanged)) == (1, 0, 0)
+
+    removed_url = 'https://www.youtube.com/channel/UC4LhEy6ZGQ2XtvFd5jmiNG'
+    table.put_item(Item={'url': removed_url, 'name': 'removed_channel'})
+
+    diff = main(mock_request(url, body), table)
+    assert (len(diff.inserted), len(diff.updated), len(diff.unchanged)) == (0, 0, 1)
+    assert diff.removed == [removed_url]
+    assert table.get_item(Key={'url': removed_url})['Item']['name'] == 'removed_channel'
+
+
+def test_diff_channels():
+    current = {
+        'https://www.youtube.com/channel/unchanged': {
+            'url': 'https://www.youtube.com/channel/unchanged', 'name': 'a', 'thumbnail': 't',
+            'affiliations': ['x', 'y'], 'is_host_blacklisted': True
+        },
+        'https://www.youtube.com/channel/updated': {
+            'url': 'https://www.youtube.com/channel/updated', 'name': 'old', 'thumbnail': 't', 'affiliations': ['x']
+        },
+        'https://www.youtube.com/channel/removed': {
+            'url': 'https://www.youtube.com/channel/removed', 'name': 'c', 'thumbnail': 't', 'affiliations': ['x']
+        },
+    }
+    channels = [
+        YoutubeChannel('https://www.youtube.com/channel/unchanged', name='a', thumbnail='t', affiliations=['y', 'x']),
+        YoutubeChannel('https://www.youtube.com/channel/updated', name='new', thumbnail='t', affiliations=['x']),
+        YoutubeChannel('https://www.youtube.com/channel/inserted', name='d', thumbnail='t', affiliations=['x']),
+    ]
+
+    diff = diff_channels(channels, current)
+
+    assert [channel.url for channel in diff.unchanged] == ['https://www.youtube.com/channel/unchanged']
+    assert [channel.url for channel in diff.updated] == ['https://www.youtube.com/channel/updated']
+    assert [channel.url for channel in diff.inserted] == ['https://www.youtube.com/channel/inserted']
+    assert diff.removed == ['https://www.youtube.com/channel/removed']
+
+
 def test_parse_minimal_html():
     html = read_file('tests/html/vtuber_antenna/list/minimal.html')
     channels = list(parse_vtubers_list(html))
@@ -90,3 +175,20 @@ def test_save_channel(table):
 
     assert out['url'] == url
     assert out['name'] == "test_channel"
+
+
+def test_main_indexes_aliases(table):
+    url = 'https://vtuber-antenna.net/list/'
+    body = read_file('tests/html/vtuber_antenna/list/minimal.html')
+    alias_table = create_alias_table()
+    backend = MockBackend({'UCp6993wxpyDPHUpavwDFqgg': '@TokinoSora'})
+    youtube = YouTube(backend=backend)
+
+    main(mock_request(url, body), table, alias_table, youtube)
+    main(mock_request(url, body), table, alias_table, youtube)
+
+    channel_url = 'https://www.youtube.com/channel/UCp6993wxpyDPHUpavwDFqgg'
+    assert alias_table.get_item(Key={'alias': '@tokinosora'})['Item']['url'] == channel_url
+    assert alias_table.get_item(Key={'alias': 'c/tokinosora'})['Item']['url'] == channel_url
+    # The channel is already indexed on the second run.
+    assert backend.calls == [['UCp6993wxpyDPHUpavwDFqgg']]
@@ -0,0 +1,50 @@
+from vhub.mentions import MentionMatcher, alias_key
+
+channel_id = "UC_x5XG1OV2P6uZZ5FSM9Ttw"
+canonical_url = f"https://www.youtube.com/channel/{channel_id}"
+
+
+def test_channel_url_variants():
+    text = f"""
+    https://www.youtube.com/channel/{channel_id}
+    http://youtube.com/channel/{channel_id}
+    https://m.youtube.com/channel/{channel_id}?sub_confirmation=1
+    youtube.com/channel/{channel_id}
+    """
+
+    assert MentionMatcher().channel_urls(text) == [canonical_url]
+
+
+def test_resolves_aliases():
+    matcher = MentionMatcher({alias_key('c', 'Name'): canonical_url, alias_key('@', 'handle'): canonical_url})
+
+    assert matcher.channel_urls("https://www.youtube.com/c/NAME") == [canonical_url]
+    assert matcher.channel_urls("チャンネル: youtube.com/@Handle.") == [canonical_url]
+
+
+def test_unknown_aliases():
+    matcher = MentionMatcher()
+    text = "https://www.youtube.com/user/someone https://www.youtube.com/@someone"
+
+    assert matcher.channel_urls(text) == ["https://www.youtube.com/user/someone"]
+
+
+def test_ignores_other_hosts():
+    text = f"https://notyoutube.com/channel/{channel_id} https://www.example.com/youtube.com/channel/{channel_id}"
+
+    assert MentionMatcher().channel_urls(text) == []
+
+
+def test_url_glued_to_text():
+    text = (f"月ノ美兎https://www.youtube.com/channel/{channel_id}\n"
+            f"樋口楓youtube.com/c/HiguchiKaede\n"
+            f"static.notyoutube.com/c/Other")
+
+    assert MentionMatcher().channel_urls(text) == [
+        f"https://www.youtube.com/channel/{channel_id}",
+        "https://www.youtube.com/c/HiguchiKaede"
+    ]
+
+
+def test_no_description():
+    assert MentionMatcher().channel_urls(None) == []
@@ -0,0 +1,92 @@
+import io
+import json
+
+import pytest
+
+from vhub import metrics
+
+
+@pytest.fixture
+def emf():
+    stream = io.StringIO()
+    previous = metrics.recorder()
+    yield metrics.configure(metrics.EmfRecorder(stream=stream)), stream
+    metrics.configure(previous)
+
+
+def emitted_lines(stream: io.StringIO) -> list:
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_handler_flushes_embedded_metric_format(emf):
+    recorder, stream = emf
+
+    @metrics.handler('test_function')
+    def handler(event, context):
+        with metrics.timer('Stage'):
+            metrics.count('Items', 3)
+        metrics.count('Items', 2)
+        return 'done'
+
+    assert handler({}, None) == 'done'
+
+    line, = emitted_lines(stream)
+    directive, = line['_aws']['CloudWatchMetrics']
+
+    assert directive['Namespace'] == 'vhub'
+    assert directive['Dimensions'] == [['Function']]
+    assert {metric['Name']: metric['Unit'] for metric in directive['Metrics']} == \
+        {'Duration': 'Milliseconds', 'Items': 'Count', 'Stage': 'Milliseconds'}
+    assert line['Function'] == 'test_function'
+    assert line['Items'] == [3, 2]
+    assert line['Stage'] >= 0
+    assert recorder.values == {}
+
+
+def test_handler_flushes_on_error(emf):
+    _, stream = emf
+
+    @metrics.handler('test_function')
+    def handler(event, context):
+        metrics.count('Items')
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        handler({}, None)
+
+    line, = emitted_lines(stream)
+    assert line['Items'] == 1
+
+
+def test_values_split_across_lines(emf):
+    recorder, stream = emf
+
+    for i in range(metrics.MAX_VALUES_PER_METRIC + 1):
+        metrics.count('Items', i)
+    metrics.count('Other')
+    recorder.flush()
+
+    first, second = emitted_lines(stream)
+
+    assert len(first['Items']) == metrics.MAX_VALUES_PER_METRIC
+    assert first['Other'] == 1
+    assert second['Items'] == metrics.MAX_VALUES_PER_METRIC
+    assert 'Other' not in second
+
+
+def test_local_summary():
+    recorder = metrics.LocalRecorder()
+
+    for value in range(1, 101):
+        recorder.record('Stage', value, 'Milliseconds')
+
+    summary = recorder.summary()['Stage']
+
+    assert (summary['count'], summary['min'], summary['max'], summary['sum']) == (100, 1, 100, 5050)
+    assert summary['p50'] == 51
+    assert summary['p95'] == 96
+
+
+def test_noop_by_default():
+    assert isinstance(metrics.recorder(), metrics.NoopRecorder)
+    metrics.count('Items')
@@ -5,7 +5,10 @@ import pytest
 from moto import mock_dynamodb2
 from twitter_text import parse_tweet
 
-from vhub.notifier import main
+from vhub.mentions import MentionMatcher, alias_key
+from vhub import channels, notifier
+from vhub.notifier import main, message, message_candidates, weighted_length, channel_directory
+from vhub.youtube import YoutubeVideo
 from tests.utils import read_yaml
 
 
@@ -29,11 +32,7 @@ def get_table(test_cases: dict) -> Tuple[str, List[list]]:
 test_cases = read_yaml('tests/cases/notifier.yml')
 
 
-@pytest.mark.parametrize(*get_table(test_cases))
-@mock_dynamodb2
-def test_notifier(description: str, event: List[dict], channels: List[dict], expected: List[dict]):
-    twitter = MockTwitter()
-
+def create_table():
     db = boto3.resource('dynamodb', region_name='us-east-2')
     db.create_table(
         TableName='Channels',
@@ -54,7 +53,14 @@ def test_notifier(description: str, event: List[dict], channels: List[dict], exp
             'WriteCapacityUnits': 1
         }
     )
-    table = db.Table('Channels')
+    return db.Table('Channels')
+
+
+@pytest.mark.parametrize(*get_table(test_cases))
+@mock_dynamodb2
+def test_notifier(description: str, event: List[dict], channels: List[dict], expected: List[dict]):
+    twitter = MockTwitter()
+    table = create_table()
 
     for channel in channels:
         table.put_item(Item=channel)
@@ -62,3 +68,185 @@ def test_notifier(description: str, event: List[dict], channels: List[dict], exp
     main(event, table, twitter)
 
     assert twitter.tweeted_messages == expected
+
+
+def stream_record(sequence_number: str, video_id: str, description: str) -> dict:
+    url = f"https://www.youtube.com/watch?v={video_id}"
+
+    return {
+        'eventName': 'INSERT',
+        'dynamodb': {
+            'Keys': {'url': {'S': url}},
+            'NewImage': {
+                'url': {'S': url},
+                'channel_url': {'S': "https://www.youtube.com/channel/Av87muUsEdf7amViaQ4L84"},
+                'title': {'S': video_id},
+                'description': {'S': description}
+            },
+            'SequenceNumber': sequence_number
+        }
+    }
+
+
+class FailingTwitter(MockTwitter):
+    def update_status(self, text: str):
+        if 'failing_video' in text:
+            raise RuntimeError('Twitter API is down.')
+        else:
+            super().update_status(text)
+
+
+def notifier_table():
+    table = create_table()
+    table.put_item(Item={'name': 'test_channel_0', 'url': "https://www.youtube.com/channel/Av87muUsEdf7amViaQ4L84"})
+    table.put_item(Item={'name': 'test_channel_1', 'url': "https://www.youtube.com/channel/ZLe5IzkSGQaDtd6VqgDE3i"})
+    return table
+
+
+COLLAB = "https://www.youtube.com/channel/ZLe5IzkSGQaDtd6VqgDE3i"
+
+
+@mock_dynamodb2
+def test_notifier_processes_every_record():
+    twitter = FailingTwitter()
+    table = notifier_table()
+    event = {
+        'Records': [
+            stream_record('7', 'video_2', COLLAB),
+            stream_record('1', 'video_0', COLLAB),
+            stream_record('2', 'video_1', 'description'),
+            stream_record('4', 'video_0', COLLAB),
+            {'eventName': 'REMOVE', 'dynamodb': {'SequenceNumber': '5'}},
+            {'eventName': 'INSERT', 'dynamodb': {'NewImage': {'url': {'S': 'invalid'}}, 'SequenceNumber': '6'}},
+        ]
+    }
+
+    response = main(event, table, twitter)
+
+    assert len(twitter.tweeted_messages) == 2
+    assert 'video_0' in twitter.tweeted_messages[0]
+    assert 'video_2' in twitter.tweeted_messages[1]
+    assert response['batchItemFailures'] == []
+
+
+@mock_dynamodb2
+def test_notifier_stops_at_first_failure():
+    twitter = FailingTwitter()
+    table = notifier_table()
+    event = {
+        'Records': [
+            stream_record('1', 'video_0', COLLAB),
+            {'eventName': 'INSERT', 'dynamodb': {'NewImage': {'url': {'S': 'invalid'}}, 'SequenceNumber': '2'}},
+            stream_record('3', 'failing_video', COLLAB),
+            stream_record('4', 'video_1', 'description'),
+            stream_record('5', 'video_2', COLLAB),
+        ]
+    }
+
+    response = main(event, table, twitter)
+
+    assert len(twitter.tweeted_messages) == 1
+    assert 'video_0' in twitter.tweeted_messages[0]
+    assert [x['itemIdentifier'] for x in response['batchItemFailures']] == ['3', '4', '5']
+
+
+@mock_dynamodb2
+def test_notifier_resolves_custom_urls():
+    twitter = MockTwitter()
+    table = create_table()
+    collab = "https://www.youtube.com/channel/ZLe5IzkSGQaDtd6VqgDE3i"
+    table.put_item(Item={'name': 'test_channel_0', 'url': "https://www.youtube.com/channel/Av87muUsEdf7amViaQ4L84"})
+    table.put_item(Item={'name': 'test_channel_1', 'url': collab})
+    matcher = MentionMatcher({alias_key('@', 'test_channel_1'): collab})
+    event = {'Records': [stream_record('1', 'video_0', "https://youtube.com/@Test_Channel_1")]}
+
+    main(event, table, twitter, matcher=matcher)
+
+    assert len(twitter.tweeted_messages) == 1
+    assert 'test_channel_1' in twitter.tweeted_messages[0]
+
+
+def test_weighted_length_agrees_with_twitter_text():
+    for text in ["test_title", "#VTuberコラボ通知", "【参加者】\nにじさんじ", "Ünïcödé “quotes” …", "😀"]:
+        assert weighted_length(text) == parse_tweet(text).weightedLength
+
+
+def test_message_truncates_participants():
+    video = YoutubeVideo("https://www.youtube.com/watch?v=test_video", title="タイトル" * 20)
+    names = [f"チャンネル名{i:02d}" for i in range(30)]
+
+    mes = message(video, names)
+    lines = mes.split('\n')
+
+    assert parse_tweet(mes).valid
+    assert lines[1] == video.title
+    assert lines[-1] == f"ほか{30 - len(lines[5:-1])}名"
+    assert lines[5:-1] == names[:len(lines[5:-1])]
+
+
+@mock_dynamodb2
+def test_notifier_falls_back_when_preload_fails(monkeypatch):
+    def failing_scan(table, *args, **kwargs):
+        raise RuntimeError('The Scan was throttled.')
+
+    monkeypatch.setenv('CHANNEL_CACHE_PRELOAD', 'true')
+    monkeypatch.setattr(channels, 'scan_items', failing_scan)
+    monkeypatch.setattr(notifier, '_channel_directories', {})
+    twitter = MockTwitter()
+    table = notifier_table()
+
+    response = main({'Records': [stream_record('1', 'video_0', COLLAB)]}, table, twitter, channel_directory(table))
+
+    assert len(twitter.tweeted_messages) == 1
+    assert response['batchItemFailures'] == []
+
+
+@pytest.mark.parametrize('name_length, fits', [(173, True), (174, False)])
+def test_message_at_weighted_length_limit(monkeypatch, name_length: int, fits: bool):
+    n_parsed = []
+
+    def is_valid_tweet(text: str) -> bool:
+        n_parsed.append(text)
+        return parse_tweet(text).valid
+
+    monkeypatch.setattr(notifier, 'is_valid_tweet', is_valid_tweet)
+    video = YoutubeVideo("https://www.youtube.com/watch?v=test_video", title="t")
+    names = ['a' * name_length, 'b' * 50]
+
+    mes = message(video, names)
+
+    # Everyone is listed, with the title only if it fits.
+    assert len(n_parsed) == 1
+    assert all(name in mes for name in names)
+    assert (mes.split('\n')[1] == 't') == fits
+    if fits:
+        assert parse_tweet(mes).weightedLength == 280
+
+
+def test_message_truncated_at_weighted_length_limit(monkeypatch):
+    n_parsed = []
+
+    def is_valid_tweet(text: str) -> bool:
+        n_parsed.append(text)
+        return parse_tweet(text).valid
+
+    monkeypatch.setattr(notifier, 'is_valid_tweet', is_valid_tweet)
+    video = YoutubeVideo("https://www.youtube.com/watch?v=test_video", title="あああ")
+    names = [f"名名名名名名名名x{i:02d}" for i in range(14)]
+
+    mes = message(video, names)
+
+    assert len(n_parsed) == 1
+    assert mes.split('\n')[1] == "あああ"
+    assert "ほか" in mes
+
+
+@pytest.mark.parametrize('title_length', range(0, 40, 3))
+def test_first_candidate_fits(title_length: int):
+    video = YoutubeVideo("https://www.youtube.com/watch?v=test_video", title="あ" * title_length)
+
+    for n_names in range(8, 20):
+        names = [f"名名名名名名名名x{i:02d}" for i in range(n_names)]
+        first = next(message_candidates(video, names))
+
+        assert parse_tweet(first).weightedLength <= 280
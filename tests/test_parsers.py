@@ -0,0 +1,62 @@
+import json
+from gzip import GzipFile
+
+import pytest
+
+from vhub.parsers import (_video_urls_lxml, _video_urls_bs4, _channel_entries_lxml, _channel_entries_bs4,
+                          parse_videos_list, parse_vtubers_list)
+from tests.utils import read_file
+
+
+def read_crawled_page(path: str) -> str:
+    with GzipFile(path, mode='r') as f:
+        return json.loads(f.read().decode('utf-8'))['body']
+
+
+videos_list_pages = [
+    read_file('tests/html/vtuber_antenna/minimal.html'),
+    read_file('tests/html/vtuber_antenna/real.html'),
+    read_crawled_page('tests/s3_object/251839840704.json.gz'),
+    read_crawled_page('tests/s3_object/251839841004.json.gz'),
+]
+
+vtubers_list_pages = [
+    read_file('tests/html/vtuber_antenna/list/minimal.html'),
+    read_file('tests/html/vtuber_antenna/list/real.html'),
+]
+
+
+@pytest.mark.parametrize('html', videos_list_pages)
+def test_videos_list_parity(html: str):
+    out = _video_urls_lxml(html)
+
+    assert len(out) > 0
+    assert out == _video_urls_bs4(html)
+
+
+@pytest.mark.parametrize('html', vtubers_list_pages)
+def test_vtubers_list_parity(html: str):
+    out = _channel_entries_lxml(html)
+
+    assert len(out) > 0
+    assert out == _channel_entries_bs4(html)
+
+
+def test_videos_list_falls_back_to_bs4(monkeypatch):
+    def broken(html: str):
+        raise ValueError()
+
+    monkeypatch.setattr('vhub.parsers._video_urls_lxml', broken)
+    html = read_file('tests/html/vtuber_antenna/minimal.html')
+
+    assert len(list(parse_videos_list(html))) == 3
+
+
+def test_vtubers_list_falls_back_to_bs4(monkeypatch):
+    def broken(html: str):
+        raise ValueError()
+
+    monkeypatch.setattr('vhub.parsers._channel_entries_lxml', broken)
+    html = read_file('tests/html/vtuber_antenna/list/real.html')
+
+    assert len(list(parse_vtubers_list(html))) == 1142
@@ -0,0 +1,139 @@
+import json
+from datetime import datetime, timezone
+from typing import List
+
+import boto3
+import pytest
+import requests
+import requests_mock
+from moto import mock_dynamodb2
+
+from vhub.quota import QuotaLedger, FileQuotaStore, DynamoDBQuotaStore
+from vhub.youtube import YouTube, YouTubeBackend, YoutubeVideo, RestBackend, QuotaExceededError
+
+quota_exceeded = json.dumps({
+    'error': {
+        'errors': [{'domain': 'youtube.quota', 'reason': 'quotaExceeded'}],
+        'code': 403
+    }
+})
+
+
+class MockBackend(YouTubeBackend):
+    def __init__(self, fail_after: int = None):
+        self.fail_after = fail_after
+        self.calls = []
+
+    def list_videos(self, video_ids: List[str]) -> dict:
+        if self.fail_after is not None and len(self.calls) >= self.fail_after:
+            raise QuotaExceededError(quota_exceeded)
+
+        self.calls.append(video_ids)
+        return {'items': []}
+
+    def list_channels(self, channel_ids: List[str]) -> dict:
+        return {'items': []}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return FileQuotaStore(str(tmp_path / 'quota.json'))
+
+
+def videos(n: int) -> List[YoutubeVideo]:
+    return [YoutubeVideo(f"https://www.youtube.com/watch?v=video_{i}") for i in range(n)]
+
+
+def test_ledger_persists_units_per_day(store):
+    clock = lambda: datetime(2019, 7, 7, 12, tzinfo=timezone.utc)
+    ledger = QuotaLedger(store, clock=clock)
+
+    ledger.record('videos.list')
+    ledger.record('videos.list')
+
+    assert QuotaLedger(store, clock=clock).used_today() == 2
+    assert QuotaLedger(store, clock=lambda: datetime(2019, 7, 8, 12, tzinfo=timezone.utc)).used_today() == 0
+    assert ledger.spent == {'videos.list': 2}
+
+
+def test_defers_videos_near_the_limit(store):
+    backend = MockBackend()
+    ledger = QuotaLedger(store, daily_limit=4, defer_ratio=0.5)
+    youtube = YouTube(backend=backend, ledger=ledger)
+
+    out = youtube.get_video_details(videos(200))
+
+    assert out == [None] * 200
+    assert len(backend.calls) == 2
+    assert store.pop_deferred() == sorted(video.url for video in videos(200)[100:])
+
+
+def test_defers_videos_when_quota_exceeded(store):
+    backend = MockBackend(fail_after=1)
+    ledger = QuotaLedger(store)
+    youtube = YouTube(backend=backend, ledger=ledger)
+
+    youtube.get_video_details(videos(150))
+
+    assert len(backend.calls) == 1
+    assert ledger.exhausted
+    assert ledger.used_today() == 1
+    assert store.pop_deferred() == sorted(video.url for video in videos(150)[50:])
+    assert store.pop_deferred() == []
+
+
+def test_rest_backend_recognizes_quota_exceeded():
+    backend = RestBackend(secret='secret', session=requests.Session(), sleep=lambda _: None)
+
+    with requests_mock.Mocker() as m:
+        m.get("https://www.googleapis.com/youtube/v3/videos", status_code=403, text=quota_exceeded)
+
+        with pytest.raises(QuotaExceededError):
+            backend.list_videos(['video_0'])
+
+
+def test_rest_backend_distinguishes_other_forbidden_errors():
+    backend = RestBackend(secret='secret', session=requests.Session(), sleep=lambda _: None)
+    forbidden = json.dumps({'error': {'errors': [{'reason': 'forbidden'}], 'code': 403}})
+
+    with requests_mock.Mocker() as m:
+        m.get("https://www.googleapis.com/youtube/v3/videos", status_code=403, text=forbidden)
+
+        with pytest.raises(requests.HTTPError):
+            backend.list_videos(['video_0'])
+
+
+@mock_dynamodb2
+def test_dynamodb_store():
+    db = boto3.resource('dynamodb', region_name='us-east-2')
+    db.create_table(
+        TableName='YouTubeQuota',
+        KeySchema=[
+            {
+                'AttributeName': 'key',
+                'KeyType': 'HASH'
+            }
+        ],
+        AttributeDefinitions=[
+            {
+                'AttributeName': 'key',
+                'AttributeType': 'S'
+            },
+        ],
+        ProvisionedThroughput={
+            'ReadCapacityUnits': 1,
+            'WriteCapacityUnits': 1
+        }
+    )
+    store = DynamoDBQuotaStore(db.Table('YouTubeQuota'))
+
+    assert store.get_units('2019-07-07') == 0
+    assert store.add_units('2019-07-07', 1) == 1
+    assert store.add_units('2019-07-07', 2) == 3
+    assert store.get_units('2019-07-07') == 3
+
+    store.defer(['url_0', 'url_1'])
+    store.defer(['url_1', 'url_2'])
+
+    assert store.pop_deferred() == ['url_0', 'url_1', 'url_2']
+    assert store.pop_deferred() == []
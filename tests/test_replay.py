@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from vhub.fetch_video import crawled_videos
+from vhub.replay import LocalArchive, Checkpoint, replay, key_range
+from vhub.utils import gzip_str
+
+
+@pytest.fixture
+def archive(tmp_path):
+    for key in os.listdir('tests/s3_object'):
+        shutil.copy(os.path.join('tests/s3_object', key), tmp_path)
+
+    def put_page(key, videos):
+        body = json.dumps({'url': 'https://vtuber-antenna.net/new/', 'body': '', 'videos': videos})
+        (tmp_path / key).write_bytes(gzip_str(body))
+
+    # An older crawl than the recorded ones, and a file which is not a crawl.
+    put_page('251839841304.json.gz', ['03H1qSot9_s', 'old_video'])
+    (tmp_path / 'notes.txt').write_text('not a crawl')
+
+    return LocalArchive(str(tmp_path))
+
+
+class Sink:
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, videos):
+        self.batches.append([video.video_id for video in videos])
+
+
+def test_keys_are_crawls_in_order(archive):
+    assert list(archive.keys()) == ['251839840704.json.gz', '251839841004.json.gz', '251839841304.json.gz']
+    assert key_range(archive, '251839840704.json.gz', '251839841004.json.gz') == ['251839841004.json.gz']
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_replay_diffs_consecutive_crawls(archive, workers):
+    sink = Sink()
+    keys = list(archive.keys())
+
+    n_videos = replay(archive, keys, sink, workers=workers, batch_size=1)
+
+    newest = {video.video_id for video in crawled_videos(_FileObject(archive, keys[0]))}
+    replayed = [video_id for batch in sink.batches for video_id in batch]
+
+    assert n_videos == len(replayed) == len(set(replayed))
+    assert newest <= set(replayed)
+    assert {'03H1qSot9_s', 'old_video'} <= set(replayed)
+
+
+def test_replay_resumes_from_checkpoint(archive, tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    keys = list(archive.keys())
+
+    replay(archive, keys[:1], Sink(), checkpoint, workers=1)
+    sink = Sink()
+    replay(archive, keys, sink, checkpoint, workers=1)
+
+    last_key, seen = checkpoint.load()
+    replayed = [video_id for batch in sink.batches for video_id in batch]
+
+    assert last_key == keys[-1]
+    assert 'old_video' in replayed
+    assert len(replayed) == len(set(replayed))
+    assert replay(archive, keys, Sink(), checkpoint, workers=1) == 0
+
+
+class _FileObject:
+    """
+    Serves a page of the local archive through `get()`, like `s3.Object`.
+    """
+
+    def __init__(self, archive: LocalArchive, key: str):
+        self.bucket_name = 'local'
+        self.path = os.path.join(archive.directory, key)
+
+    def get(self) -> dict:
+        return {'Body': open(self.path, 'rb'), 'ContentEncoding': 'gzip'}
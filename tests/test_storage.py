@@ -0,0 +1,189 @@
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_dynamodb2
+
+from vhub.storage import batch_put_items, batch_get_items, scan_items, existing_keys, put_new_items, \
+    UnprocessedItemsError
+
+
+class MockClient:
+    """
+    Leaves the first `n_unprocessed` items of each `BatchWriteItem` call unprocessed, the given number of times.
+    """
+
+    def __init__(self, n_unprocessed: int, n_times: int, error: ClientError = None):
+        self.n_unprocessed = n_unprocessed
+        self.n_times = n_times
+        self.error = error
+        self.calls = []
+
+    def batch_write_item(self, RequestItems: dict) -> dict:
+        (table_name, requests), = RequestItems.items()
+        self.calls.append(requests)
+
+        if self.error is not None:
+            raise self.error
+        elif len(self.calls) <= self.n_times:
+            return {'UnprocessedItems': {table_name: requests[:self.n_unprocessed]}}
+        else:
+            return {'UnprocessedItems': {}}
+
+
+class MockTable:
+    def __init__(self, client: MockClient):
+        self.name = 'Videos'
+        self.meta = type('Meta', (), {'client': client})
+
+
+def no_sleep(seconds: float):
+    pass
+
+
+@pytest.fixture
+def table():
+    with mock_dynamodb2():
+        db = boto3.resource('dynamodb', region_name='us-east-2')
+        db.create_table(
+            TableName='Channels',
+            KeySchema=[
+                {
+                    'AttributeName': 'url',
+                    'KeyType': 'HASH'
+                }
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'url',
+                    'AttributeType': 'S'
+                },
+            ],
+            ProvisionedThroughput={
+                'ReadCapacityUnits': 1,
+                'WriteCapacityUnits': 1
+            }
+        )
+        yield db.Table('Channels')
+
+
+def test_batch_put_items(table):
+    items = [{'url': f'url_{i}', 'name': f'name_{i}'} for i in range(60)]
+
+    failures = batch_put_items(table, items)
+
+    assert failures == []
+    assert table.scan()['Count'] == 60
+
+
+def test_batch_put_items_deduplicates_keys(table):
+    items = [{'url': 'url', 'name': 'old'}, {'url': 'url', 'name': 'new'}]
+
+    failures = batch_put_items(table, items)
+
+    assert failures == []
+    assert table.get_item(Key={'url': 'url'})['Item']['name'] == 'new'
+
+
+def test_batch_put_items_splits_into_25_items():
+    client = MockClient(n_unprocessed=0, n_times=0)
+    items = [{'url': f'url_{i}'} for i in range(60)]
+
+    batch_put_items(MockTable(client), items, sleep=no_sleep)
+
+    assert [len(requests) for requests in client.calls] == [25, 25, 10]
+
+
+def test_batch_put_items_retries_unprocessed_items():
+    client = MockClient(n_unprocessed=3, n_times=2)
+    items = [{'url': f'url_{i}'} for i in range(10)]
+
+    failures = batch_put_items(MockTable(client), items, sleep=no_sleep)
+
+    assert failures == []
+    assert [len(requests) for requests in client.calls] == [10, 3, 3]
+
+
+def test_batch_put_items_gives_up_retrying():
+    client = MockClient(n_unprocessed=3, n_times=100)
+    items = [{'url': f'url_{i}'} for i in range(10)]
+
+    failures = batch_put_items(MockTable(client), items, max_attempts=4, sleep=no_sleep)
+
+    assert len(client.calls) == 4
+    assert [item for item, _ in failures] == items[:3]
+    assert all(isinstance(e, UnprocessedItemsError) for _, e in failures)
+
+
+def test_batch_put_items_reports_every_item_on_error():
+    error = ClientError({'Error': {'Code': 'ValidationException'}}, 'BatchWriteItem')
+    client = MockClient(n_unprocessed=0, n_times=0, error=error)
+    items = [{'url': f'url_{i}'} for i in range(10)]
+
+    failures = batch_put_items(MockTable(client), items, sleep=no_sleep)
+
+    assert len(client.calls) == 1
+    assert failures == [(item, error) for item in items]
+
+
+def test_batch_get_items(table):
+    for i in range(150):
+        table.put_item(Item={'url': f'url_{i}'})
+
+    keys = [{'url': f'url_{i}'} for i in range(140, 160)] + [{'url': f'url_{i}'} for i in range(110)]
+    items = batch_get_items(table, keys)
+
+    assert {item['url'] for item in items} == {f'url_{i}' for i in list(range(110)) + list(range(140, 150))}
+
+
+def test_existing_keys(table):
+    for i in range(150):
+        table.put_item(Item={'url': f'url_{i}', 'title': 'title'})
+
+    keys = existing_keys(table, [f'url_{i}' for i in range(100, 200)])
+
+    assert keys == {f'url_{i}' for i in range(100, 150)}
+
+
+def test_put_new_items(table):
+    table.put_item(Item={'url': 'url_0', 'title': 'old'})
+    items = [{'url': f'url_{i}', 'title': 'new'} for i in range(10)]
+
+    skipped, failures = put_new_items(table, items, max_workers=4)
+
+    assert skipped == [items[0]]
+    assert failures == []
+    assert table.get_item(Key={'url': 'url_0'})['Item']['title'] == 'old'
+    assert table.get_item(Key={'url': 'url_9'})['Item']['title'] == 'new'
+
+
+def test_scan_items(table):
+    for i in range(150):
+        table.put_item(Item={'url': f'url_{i}'})
+
+    # moto ignores `Segment`, so only a single segment is tested against it.
+    items = scan_items(table, total_segments=1)
+
+    assert sorted(item['url'] for item in items) == sorted(f'url_{i}' for i in range(150))
+
+
+class MockScanClient:
+    """
+    Serves two pages of items per segment.
+    """
+
+    def scan(self, TableName: str, Segment: int, TotalSegments: int, ExclusiveStartKey: dict = None) -> dict:
+        page = 0 if ExclusiveStartKey is None else ExclusiveStartKey['page']
+        items = [{'url': f'url_{Segment}_{page}'}]
+
+        if page == 0:
+            return {'Items': items, 'LastEvaluatedKey': {'page': 1}}
+        else:
+            return {'Items': items}
+
+
+def test_scan_items_reads_every_segment():
+    table = MockTable(MockScanClient())
+
+    items = scan_items(table, total_segments=3)
+
+    assert sorted(item['url'] for item in items) == [f'url_{i}_{j}' for i in range(3) for j in range(2)]
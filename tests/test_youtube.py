@@ -1,12 +1,13 @@
 import json
 import unittest
 
+import requests
+import requests_mock
 from googleapiclient.http import HttpMockSequence
 
-from vhub.youtube import is_valid_youtube_video_url, YouTube, YoutubeVideo
+from vhub.youtube import is_valid_youtube_video_url, YouTube, YoutubeVideo, YoutubeChannel, RestBackend
 from tests.utils import read_file
 
-api_discovery = read_file("tests/api_responses/youtube/discovery.json")
 PLACE_HOLDER = ""
 
 
@@ -27,13 +28,16 @@ class TestIsValidYoutubeVideoUrl(unittest.TestCase):
         url = "https://www.example.com/"
         self.assertFalse(is_valid_youtube_video_url(url))
 
+    def test_non_canonical_url(self):
+        url = "https://www.youtube.com/watch?t=30&v=uaQS2ZnrFQg"
+        self.assertTrue(is_valid_youtube_video_url(url))
+
 
 class TestGetVideoById(unittest.TestCase):
     def test_found(self):
         id = "03H1qSot9_s"
         response = read_file("tests/api_responses/youtube/videos/list/no_mention.json")
         http = HttpMockSequence([
-            ({"status": 200}, api_discovery),
             ({"status": 200}, response)
         ])
         youtube = YouTube(secret=PLACE_HOLDER, http=http)
@@ -48,7 +52,6 @@ class TestGetVideoById(unittest.TestCase):
         id = PLACE_HOLDER
         response = read_file("tests/api_responses/youtube/videos/list/not_found.json")
         http = HttpMockSequence([
-            ({"status": 200}, api_discovery),
             ({"status": 200}, response)
         ])
         youtube = YouTube(secret=PLACE_HOLDER, http=http)
@@ -66,7 +69,6 @@ class TestGetVideoDetail(unittest.TestCase):
         )
         response = read_file("tests/api_responses/youtube/videos/list/no_mention.json")
         http = HttpMockSequence([
-            ({"status": 200}, api_discovery),
             ({"status": 200}, response)
         ])
         youtube = YouTube(secret=PLACE_HOLDER, http=http)
@@ -83,7 +85,6 @@ class TestGetVideoDetail(unittest.TestCase):
         video = YoutubeVideo("https://www.youtube.com/watch?v=invalid_id")
         response = read_file("tests/api_responses/youtube/videos/list/not_found.json")
         http = HttpMockSequence([
-            ({"status": 200}, api_discovery),
             ({"status": 200}, response)
         ])
         youtube = YouTube(secret=PLACE_HOLDER, http=http)
@@ -93,6 +94,134 @@ class TestGetVideoDetail(unittest.TestCase):
         self.assertIsNone(out)
 
 
+def videos_list_response(*paths: str) -> str:
+    """
+    Merge the recorded `videos.list` responses into a single response.
+    """
+    items = [item for path in paths for item in json.loads(read_file(path))['items']]
+    return json.dumps({"kind": "youtube#videoListResponse", "items": items})
+
+
+class TestGetVideoDetails(unittest.TestCase):
+    def test_keeps_input_order(self):
+        videos = [
+            YoutubeVideo("https://www.youtube.com/watch?v=invalid_id"),
+            YoutubeVideo("https://www.youtube.com/watch?v=03H1qSot9_s"),
+            YoutubeVideo("https://www.youtube.com/watch?v=KNi82VggtBo"),
+        ]
+        response = videos_list_response(
+            "tests/api_responses/youtube/videos/list/one_mention.json",
+            "tests/api_responses/youtube/videos/list/no_mention.json"
+        )
+        http = HttpMockSequence([
+            ({"status": 200}, response)
+        ])
+        youtube = YouTube(secret=PLACE_HOLDER, http=http)
+
+        out = youtube.get_video_details(videos)
+
+        self.assertIsNone(out[0])
+        self.assertEqual(out[1].url, videos[1].url)
+        self.assertEqual(out[2].url, videos[2].url)
+
+    def test_chunks_ids_into_groups_of_50(self):
+        videos = [YoutubeVideo(f"https://www.youtube.com/watch?v=video_{i}") for i in range(51)]
+        response = read_file("tests/api_responses/youtube/videos/list/not_found.json")
+        http = HttpMockSequence([
+            ({"status": 200}, response),
+            ({"status": 200}, response)
+        ])
+        youtube = YouTube(secret=PLACE_HOLDER, http=http)
+
+        out = youtube.get_video_details(videos)
+
+        self.assertEqual(out, [None] * 51)
+        self.assertEqual(len(http.request_sequence), 2)
+
+    def test_isolates_chunk_failures(self):
+        videos = [YoutubeVideo(f"https://www.youtube.com/watch?v=video_{i}") for i in range(50)]
+        videos.append(YoutubeVideo("https://www.youtube.com/watch?v=03H1qSot9_s"))
+        response = read_file("tests/api_responses/youtube/videos/list/no_mention.json")
+        http = HttpMockSequence([
+            ({"status": 500}, "{}"),
+            ({"status": 200}, response)
+        ])
+        youtube = YouTube(secret=PLACE_HOLDER, http=http)
+
+        out = youtube.get_video_details(videos)
+
+        self.assertEqual(out[:50], [None] * 50)
+        self.assertEqual(out[50].url, videos[50].url)
+
+
+class TestRestBackend(unittest.TestCase):
+    endpoint = "https://www.googleapis.com/youtube/v3/videos"
+    fixtures = {
+        "03H1qSot9_s": "tests/api_responses/youtube/videos/list/no_mention.json",
+        "KNi82VggtBo": "tests/api_responses/youtube/videos/list/one_mention.json",
+        "invalid_id": "tests/api_responses/youtube/videos/list/not_found.json",
+    }
+
+    def rest_youtube(self, **kwargs) -> YouTube:
+        backend = RestBackend(secret="secret", session=requests.Session(), sleep=lambda _: None, **kwargs)
+        return YouTube(backend=backend)
+
+    def test_parity_with_google_api_backend(self):
+        for video_id, path in self.fixtures.items():
+            video = YoutubeVideo(f"https://www.youtube.com/watch?v={video_id}", n_watch=128)
+            response = read_file(path)
+
+            google = YouTube(secret=PLACE_HOLDER, http=HttpMockSequence([({"status": 200}, response)]))
+            expected = google.get_video_details([video])
+
+            with requests_mock.Mocker() as m:
+                m.get(self.endpoint, text=response)
+                out = self.rest_youtube().get_video_details([video])
+
+                # requests_mock lower-cases the query string.
+                query = m.last_request.qs
+                self.assertEqual(query["id"], [video_id.lower()])
+                self.assertEqual(query["part"], ["snippet"])
+
+            self.assertEqual([x and x.to_item() for x in out], [x and x.to_item() for x in expected])
+
+    def test_retries_on_server_errors(self):
+        video = YoutubeVideo("https://www.youtube.com/watch?v=03H1qSot9_s")
+        response = read_file(self.fixtures["03H1qSot9_s"])
+
+        with requests_mock.Mocker() as m:
+            m.get(self.endpoint, [
+                {"status_code": 503},
+                {"status_code": 429, "headers": {"Retry-After": "1"}},
+                {"status_code": 200, "text": response},
+            ])
+            out = self.rest_youtube().get_video_details([video])
+
+            self.assertEqual(m.call_count, 3)
+
+        self.assertEqual(out[0].url, video.url)
+
+    def test_gives_up_retrying(self):
+        video = YoutubeVideo("https://www.youtube.com/watch?v=03H1qSot9_s")
+
+        with requests_mock.Mocker() as m:
+            m.get(self.endpoint, status_code=500)
+            out = self.rest_youtube(max_attempts=2).get_video_details([video])
+
+            self.assertEqual(m.call_count, 2)
+
+        self.assertEqual(out, [None])
+
+    def test_does_not_retry_client_errors(self):
+        with requests_mock.Mocker() as m:
+            m.get(self.endpoint, status_code=400)
+
+            with self.assertRaises(requests.HTTPError):
+                self.rest_youtube().backend.list_videos(["03H1qSot9_s"])
+
+            self.assertEqual(m.call_count, 1)
+
+
 class TestYouTubeVideoEq(unittest.TestCase):
     def test_equal(self):
         url = "https://www.youtube.com/watch?v=03H1qSot9_s"
@@ -106,3 +235,25 @@ class TestYouTubeVideoEq(unittest.TestCase):
         video_2 = YoutubeVideo("https://www.youtube.com/watch?v=uaQS2ZnrFQg")
 
         self.assertNotEqual(video_1, video_2)
+
+
+class TestItemConversion(unittest.TestCase):
+    def test_video_round_trip(self):
+        video = YoutubeVideo("https://www.youtube.com/watch?t=30&v=uaQS2ZnrFQg", title="title", tags=["a"])
+        item = video.to_item()
+
+        self.assertEqual(video.video_id, "uaQS2ZnrFQg")
+        self.assertNotIn("video_id", item)
+        self.assertEqual(YoutubeVideo.from_item(item).to_item(), item)
+
+    def test_channel_round_trip(self):
+        channel = YoutubeChannel("https://www.youtube.com/channel/UC_x5XG1OV2P6uZZ5FSM9Ttw", name="name",
+                                 affiliations=["x"], is_host_blacklisted=True)
+        item = channel.to_item()
+
+        self.assertEqual(channel.channel_id, "UC_x5XG1OV2P6uZZ5FSM9Ttw")
+        self.assertEqual(YoutubeChannel.from_item(item).to_item(), item)
+
+    def test_custom_channel_url_has_no_id(self):
+        channel = YoutubeChannel("https://www.youtube.com/c/name")
+        self.assertIsNone(channel.channel_id)
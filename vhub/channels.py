@@ -0,0 +1,193 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional, Callable, Tuple, Iterable, Dict
+
+from boto3_type_annotations import dynamodb
+
+from . import metrics
+from .storage import scan_items, batch_get_items, batch_put_items
+from .youtube import YoutubeChannel
+
+logger = logging.getLogger()
+
+
+def channel_from_item(item: dict) -> YoutubeChannel:
+    return YoutubeChannel(
+        url=item['url'],
+        name=item['name'],
+        is_host_blacklisted=item.get('is_host_blacklisted'),
+        is_guest_blacklisted=item.get('is_guest_blacklisted')
+    )
+
+
+class ChannelRepository:
+    """
+    Reads the channels from the Channels table.
+    """
+
+    def __init__(self, table: dynamodb.Table):
+        self.table = table
+
+    def get(self, url: str) -> Optional[YoutubeChannel]:
+        item = self.table.get_item(Key={'url': url}).get('Item')
+        return None if item is None else channel_from_item(item)
+
+    def get_many(self, urls: Iterable[str]) -> Dict[str, Optional[YoutubeChannel]]:
+        """
+        Look up the channels with `BatchGetItem` calls of up to 100 keys each.
+
+        Returns a dictionary from every given URL to its channel, or `None` if the URL is unknown.
+        """
+        urls = set(urls)
+        items = batch_get_items(self.table, [{'url': url} for url in urls])
+        channels = {item['url']: channel_from_item(item) for item in items}
+
+        return {url: channels.get(url) for url in urls}
+
+
+class ChannelDirectory:
+    """
+    A read-through cache of the Channels table, bounded in size with the least-recently-used eviction.
+
+    Each entry expires after `ttl` seconds, and URLs unknown to the table are cached as well (as `None`),
+    expiring after `negative_ttl` seconds.
+    Once `preload` has read the whole table, URLs not in the cache are answered as unknown without a `GetItem`,
+    until the snapshot expires.
+    """
+
+    def __init__(self, table: dynamodb.Table, maxsize: int = 4096, ttl: float = 3600,
+                 negative_ttl: Optional[float] = None, clock: Callable[[], float] = time.monotonic):
+        self.table = table
+        self.repository = ChannelRepository(table)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[str, Tuple[float, Optional[YoutubeChannel]]]' = OrderedDict()
+        self._complete_until = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _put(self, url: str, channel: Optional[YoutubeChannel], now: float):
+        ttl = self.ttl if channel is not None else self.negative_ttl
+        self._entries[url] = (now + ttl, channel)
+        self._entries.move_to_end(url)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self._complete_until = None
+
+    def _lookup(self, url: str, now: float) -> Tuple[bool, Optional[YoutubeChannel]]:
+        entry = self._entries.get(url)
+
+        if entry is not None:
+            expires_at, channel = entry
+            if now < expires_at:
+                self._entries.move_to_end(url)
+                return True, channel
+            else:
+                del self._entries[url]
+
+        if self._complete_until is not None and now < self._complete_until:
+            return True, None
+        else:
+            return False, None
+
+    def get(self, url: str) -> Optional[YoutubeChannel]:
+        now = self.clock()
+        found, channel = self._lookup(url, now)
+
+        if found:
+            self.hits += 1
+            metrics.count('ChannelCacheHits')
+            return channel
+
+        self.misses += 1
+        metrics.count('ChannelCacheMisses')
+        channel = self.repository.get(url)
+        self._put(url, channel, now)
+
+        return channel
+
+    def get_many(self, urls: Iterable[str]) -> Dict[str, Optional[YoutubeChannel]]:
+        """
+        Look up the channels, fetching all the cache misses with a single `ChannelRepository.get_many`.
+        """
+        now = self.clock()
+        channels = {}
+        missed = []
+
+        for url in set(urls):
+            found, channel = self._lookup(url, now)
+
+            if found:
+                self.hits += 1
+                channels[url] = channel
+            else:
+                self.misses += 1
+                missed.append(url)
+
+        # The hits and misses of this call, whereas `hits` and `misses` add up over the warm invocations.
+        n_hits = len(channels)
+        metrics.count('ChannelCacheHits', n_hits)
+        metrics.count('ChannelCacheMisses', len(missed))
+        if n_hits + len(missed) > 0:
+            metrics.count('ChannelCacheHitRate', n_hits / (n_hits + len(missed)) * 100, unit='Percent')
+
+        if len(missed) > 0:
+            with metrics.timer('DynamoDBRead'):
+                found_channels = self.repository.get_many(missed)
+
+            for url, channel in found_channels.items():
+                self._put(url, channel, now)
+                channels[url] = channel
+
+        return channels
+
+    def preload(self):
+        """
+        Fill the cache with the whole table by a single (parallel) Scan.
+        """
+        now = self.clock()
+        items = scan_items(self.table)
+
+        for item in items:
+            self._put(item['url'], channel_from_item(item), now)
+
+        if len(items) <= self.maxsize:
+            self._complete_until = now + self.ttl
+
+        logger.info('Preloaded %d channels into the channel directory.', len(items))
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total > 0 else 0.0
+
+        logger.info('Channel directory: %d hits, %d misses (hit rate %.2f), %d entries.',
+                    self.hits, self.misses, hit_rate, len(self._entries))
+
+
+def load_aliases(table: dynamodb.Table) -> Dict[str, str]:
+    """
+    Load the ChannelAliases table, whose items map the alias keys `alias` (see `mentions.alias_key`)
+    to the canonical channel URLs `url`.
+
+    The URLs are shared between the aliases of the same channel, to keep the dictionary compact.
+    """
+    urls = {}
+    return {item['alias']: urls.setdefault(item['url'], item['url']) for item in scan_items(table)}
+
+
+def save_aliases(table: dynamodb.Table, aliases: Dict[str, str]):
+    items = [{'alias': alias, 'url': url} for alias, url in aliases.items()]
+    failures = batch_put_items(table, items, key='alias')
+
+    for item, e in failures:
+        logger.error('Failed to save a channel alias: %s', item['alias'])
+        logger.error('The reason being: %s', e)
+
+    logger.info('Successfully saved %d channel aliases.', len(items) - len(failures))
@@ -0,0 +1,164 @@
+import io
+import logging
+import re
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from gzip import GzipFile
+from typing import BinaryIO, Dict, Iterable, Optional
+
+from boto3_type_annotations import s3
+
+logger = logging.getLogger()
+
+# The crawled pages record their codec in `ContentEncoding` and in the key extension (see `crawl_key`).
+# The zstd dictionaries trained on past crawls are saved in the same bucket under this prefix,
+# and referred to by the metadata `zstd-dictionary` of the pages compressed with them.
+DICTIONARY_PREFIX = 'dictionaries/'
+
+
+class Codec(ABC):
+    content_encoding: str
+    extension: str
+
+    @abstractmethod
+    def writer(self, fileobj: BinaryIO) -> BinaryIO:
+        """
+        Returns a stream compressing what is written into `fileobj`, which is flushed on `close`.
+        """
+        pass
+
+    @abstractmethod
+    def reader(self, fileobj: BinaryIO) -> BinaryIO:
+        """
+        Returns a buffered stream decompressing `fileobj`.
+        """
+        pass
+
+    def metadata(self) -> Dict[str, str]:
+        """
+        The object metadata needed to read the object back, besides `ContentEncoding`.
+        """
+        return {}
+
+
+class GzipCodec(Codec):
+    content_encoding = 'gzip'
+    extension = '.gz'
+
+    def writer(self, fileobj: BinaryIO) -> BinaryIO:
+        return GzipFile(fileobj=fileobj, mode='wb')
+
+    def reader(self, fileobj: BinaryIO) -> BinaryIO:
+        return GzipFile(fileobj=fileobj, mode='rb')
+
+
+class ZstdCodec(Codec):
+    """
+    Zstandard, optionally with a dictionary. Requires the package `zstandard`.
+    """
+    content_encoding = 'zstd'
+    extension = '.zst'
+
+    def __init__(self, dictionary: Optional[bytes] = None, level: int = 10):
+        # zstandard is needed only by the buckets using zstd.
+        import zstandard
+
+        self.dictionary = None if dictionary is None else zstandard.ZstdCompressionDict(dictionary)
+        self.level = level
+
+    def dictionary_id(self) -> Optional[str]:
+        return None if self.dictionary is None else str(self.dictionary.dict_id())
+
+    def writer(self, fileobj: BinaryIO) -> BinaryIO:
+        import zstandard
+
+        compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self.dictionary)
+        return compressor.stream_writer(fileobj, closefd=False)
+
+    def reader(self, fileobj: BinaryIO) -> BinaryIO:
+        import zstandard
+
+        decompressor = zstandard.ZstdDecompressor(dict_data=self.dictionary)
+        return io.BufferedReader(decompressor.stream_reader(fileobj, closefd=False))
+
+    def metadata(self) -> Dict[str, str]:
+        dictionary_id = self.dictionary_id()
+        return {} if dictionary_id is None else {'zstd-dictionary': dictionary_id}
+
+
+GZIP = GzipCodec()
+
+# The extensions of the keys of the crawled pages, by `ContentEncoding`.
+EXTENSIONS = {'gzip': GzipCodec.extension, 'zstd': ZstdCodec.extension}
+
+_crawl_key = re.compile(r"\d+\.json(?:" + "|".join(re.escape(ext) for ext in EXTENSIONS.values()) + ")")
+
+
+def crawl_key(timestamp: str, codec: Codec) -> str:
+    return f"{timestamp}.json{codec.extension}"
+
+
+def is_crawl_key(key: str) -> bool:
+    """
+    Whether the key is of a crawled page, as opposed to e.g. a dictionary.
+    """
+    return _crawl_key.fullmatch(key) is not None
+
+
+def dictionary_key(dictionary_id: str) -> str:
+    return f"{DICTIONARY_PREFIX}{dictionary_id}.zdict"
+
+
+@lru_cache(maxsize=8)
+def load_dictionary(bucket_name: str, dictionary_id: str) -> bytes:
+    """
+    Download the dictionary, which is cached as the dictionaries never change.
+    """
+    import boto3
+
+    return boto3.resource('s3').Object(bucket_name, dictionary_key(dictionary_id)).get()['Body'].read()
+
+
+def codec_of(content_encoding: Optional[str], metadata: Dict[str, str], bucket_name: str) -> Codec:
+    """
+    Returns the codec to read an object, given its `ContentEncoding` and metadata.
+    Objects without `ContentEncoding` are the gzipped ones saved before the codecs were recorded.
+    """
+    if content_encoding in (None, 'gzip'):
+        return GZIP
+    elif content_encoding == 'zstd':
+        dictionary_id = metadata.get('zstd-dictionary')
+        dictionary = None if dictionary_id is None else load_dictionary(bucket_name, dictionary_id)
+        return ZstdCodec(dictionary)
+    else:
+        raise ValueError(f"Unknown content encoding: {content_encoding}")
+
+
+def page_codec(name: str, bucket_name: str, dictionary_id: Optional[str] = None) -> Codec:
+    """
+    Returns the codec to save the pages with, by its name, either "gzip" or "zstd".
+    """
+    if name == 'gzip':
+        return GZIP
+    elif name == 'zstd':
+        dictionary = None if dictionary_id is None else load_dictionary(bucket_name, dictionary_id)
+        return ZstdCodec(dictionary)
+    else:
+        raise ValueError(f"Unknown codec: {name}")
+
+
+def train_dictionary(bucket: s3.Bucket, samples: Iterable[bytes], size: int = 112640) -> str:
+    """
+    Train a zstd dictionary on the samples, e.g. the bodies of the recent crawls, and save it into the bucket.
+
+    Returns the ID of the dictionary, to be set as `ZSTD_DICTIONARY_ID` of the crawler.
+    """
+    import zstandard
+
+    dictionary = zstandard.train_dictionary(size, list(samples))
+    dictionary_id = str(dictionary.dict_id())
+    bucket.Object(dictionary_key(dictionary_id)).put(Body=dictionary.as_bytes())
+
+    logger.info('Saved the zstd dictionary %s of %d bytes.', dictionary_id, len(dictionary.as_bytes()))
+
+    return dictionary_id
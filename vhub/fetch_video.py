@@ -1,22 +1,29 @@
-import json
 import logging
 import os
-from typing import Iterable, Optional
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional, Set
 
 import boto3
 from boto3_type_annotations import s3, dynamodb
 from botocore.exceptions import ClientError
-from bs4 import BeautifulSoup
+from toolz import partition_all
 
-from .utils import emptystr_to_none, extract_gzip
-from .youtube import YouTube, YoutubeVideo
+from . import metrics
+from .compression import is_crawl_key
+from .manifest import load_manifest, find_entry
+from .parsers import parse_videos_list
+from .quota import quota_ledger
+from .storage import existing_keys, put_new_items
+from .utils import emptystr_to_none, extract_page
+from .youtube import YouTube, YoutubeVideo, youtube_video_url, youtube_backend, MAX_IDS_PER_REQUEST
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
 def save_video(table: dynamodb.Table, video: YoutubeVideo):
-    item = emptystr_to_none(vars(video))
+    item = emptystr_to_none(video.to_item())
 
     try:
         table.put_item(Item=item)
@@ -26,74 +33,187 @@ def save_video(table: dynamodb.Table, video: YoutubeVideo):
         logger.exception('The reason being: %s', e)
 
 
+def save_videos(table: dynamodb.Table, videos: Iterable[YoutubeVideo]) -> List[str]:
+    """
+    Save the videos not in the table yet. The videos already saved are left as they are,
+    so that the notifier is not triggered again by e.g. their updated view counts.
+
+    Returns the URLs of the videos in the table, i.e. all but those which failed to be saved.
+    """
+    items = [emptystr_to_none(video.to_item()) for video in videos]
+
+    with metrics.timer('DynamoDBWrite'):
+        skipped, failures = put_new_items(table, items)
+
+    for item, e in failures:
+        logger.error('Failed to save a YouTube video: %s', item['url'])
+        logger.error('The reason being: %s', e)
+
+    n_saved = len(items) - len(skipped) - len(failures)
+    logger.info('Successfully saved %d YouTube videos, skipping %d already saved.', n_saved, len(skipped))
+    metrics.count('VideosSaved', n_saved)
+    metrics.count('VideosAlreadySaved', len(skipped))
+    metrics.count('VideosFailed', len(failures))
+
+    failed = set(item['url'] for item, _ in failures)
+    return [item['url'] for item in items if item['url'] not in failed]
+
+
+def unknown_videos(table: dynamodb.Table, videos: Iterable[YoutubeVideo]) -> List[YoutubeVideo]:
+    """
+    Returns the videos not in the table yet, e.g. excluding those which drop off the page and show up again.
+
+    If the table cannot be read, all the videos are returned, as `save_videos` does not overwrite them anyway.
+    """
+    videos = list(videos)
+
+    try:
+        with metrics.timer('DynamoDBRead'):
+            known = existing_keys(table, [video.url for video in videos])
+    except ClientError as e:
+        logger.error('Failed to look up the videos already saved.')
+        logger.exception('The reason being: %s', e)
+        return videos
+
+    if len(known) > 0:
+        logger.info('Skipping the videos already saved: %s', sorted(known))
+    metrics.count('KnownVideosSkipped', len(known))
+
+    return [video for video in videos if video.url not in known]
+
+
 def get_previous_object(obj: s3.Object) -> Optional[s3.Object]:
-    client = boto3.client('s3')
-    bucket = obj.bucket_name
-    key = obj.key
-    response = client.list_objects_v2(
-        Bucket=bucket,
-        StartAfter=key,
+    """
+    Returns the page crawled just before the object, looked up in the manifest of the bucket.
+
+    The pages not in the manifest, i.e. crawled before it was introduced or not recorded in it yet,
+    are looked up by listing the key following the object's, which is the previous crawl by `reverse_timestamp`.
+    """
+    bucket = obj.Bucket()
+
+    try:
+        entry = find_entry(load_manifest(bucket), obj.key)
+    except Exception as e:
+        logger.warning('Failed to read the manifest of the crawled pages: %s', e)
+        entry = None
+
+    if entry is not None:
+        return None if entry.previous is None else bucket.Object(entry.previous)
+
+    logger.info('The crawled page is not in the manifest, listing the bucket: %s', obj.key)
+    metrics.count('ManifestMisses')
+
+    response = obj.meta.client.list_objects_v2(
+        Bucket=obj.bucket_name,
+        StartAfter=obj.key,
         MaxKeys=1
     )
 
-    if response['KeyCount'] == 0:
+    # The crawled pages come first in the bucket, before e.g. the dictionaries and the manifest.
+    if response['KeyCount'] == 0 or not is_crawl_key(response['Contents'][0]['Key']):
         return None
     else:
-        key_prev = response['Contents'][0]['Key']
-        return boto3.resource('s3').Object(bucket, key_prev)
+        return bucket.Object(response['Contents'][0]['Key'])
 
 
 def extract_html(obj: s3.Object) -> str:
-    response = obj.get()
-    body = response['Body'].read()
-    dic = json.loads(extract_gzip(body))
-
-    return dic['body']
+    return extract_page(obj)['body']
 
 
-def parse_videos_list(html: str) -> Iterable[YoutubeVideo]:
+def crawled_videos(obj: s3.Object) -> Set[YoutubeVideo]:
     """
-    Parse the web page: https://vtuber-antenna.net/new/.
+    Returns the videos on the crawled page, reading the saved video IDs instead of parsing the HTML if possible.
+    Pages crawled before the video IDs were saved alongside are parsed.
     """
-    try:
-        soup = BeautifulSoup(html, "lxml")
-    except:
-        soup = BeautifulSoup(html, "html5lib")
-
-    videos = soup.select("div#main-area div.movie ul.movieList.new li:not(.empty)")
+    page = extract_page(obj, with_body=False)
 
-    for video in videos:
-        a = video.select_one("p.movieTitle a")
-        url = a["href"]
+    if page.get('videos') is not None:
+        return set(YoutubeVideo(youtube_video_url(video_id)) for video_id in page['videos'])
+    else:
+        body = page['body'] if 'body' in page else extract_html(obj)
 
-        yield YoutubeVideo(url)
+        with metrics.timer('HtmlParse'):
+            return set(parse_videos_list(body))
 
 
 def get_new_videos(new: s3.Object, prev: Optional[s3.Object]) -> Iterable[YoutubeVideo]:
-    new_videos = parse_videos_list(extract_html(new))
+    new_videos = crawled_videos(new)
 
     if prev is None:
-        return set(new_videos)
+        return new_videos
     else:
-        prev_videos = parse_videos_list(extract_html(prev))
-        return set(new_videos) - set(prev_videos)
+        return new_videos - crawled_videos(prev)
 
 
 def get_video_details(videos: Iterable[YoutubeVideo], youtube: YouTube) -> Iterable[YoutubeVideo]:
-    for video in videos:
+    details = youtube.get_video_details(videos)
+    return [detail for detail in details if detail is not None]
+
+
+def fetch_and_save_videos(table: dynamodb.Table, videos: Iterable[YoutubeVideo], youtube: YouTube,
+                          concurrency: int = 4, chunk_size: int = MAX_IDS_PER_REQUEST, queue_size: int = 8):
+    """
+    Fetch the details of the videos not in the table yet and save them, overlapping the API calls with the DynamoDB
+    writes.
+
+    The videos are fetched in chunks by `concurrency` threads, which block once `queue_size` fetched chunks
+    are waiting to be saved. The chunks are saved on the calling thread in the order they are fetched.
+    A chunk which fails to be fetched or saved is logged and skipped, without affecting the others.
+
+    The deferred videos are removed from the quota ledger only once they are in the table,
+    so that those left unsaved are fetched again by a later run.
+    """
+    videos = list(videos)
+    unknown = unknown_videos(table, videos)
+    chunks = list(partition_all(chunk_size, unknown))
+    fetched = queue.Queue(maxsize=queue_size)
+    ledger = getattr(youtube, 'ledger', None)
+
+    def resolve(urls: List[str]):
+        if ledger is not None:
+            ledger.resolve_deferred(urls)
+
+    unknown_urls = set(video.url for video in unknown)
+    resolve([video.url for video in videos if video.url not in unknown_urls])
+
+    def fetch(chunk):
         try:
-            detail = youtube.get_video_detail(video)
-            if detail is not None:
-                yield detail
+            details = get_video_details(chunk, youtube)
         except Exception as e:
-            logger.error('YouTube API gave an error while getting details of the video: %s', video.url)
+            logger.error('Failed to fetch the details of the YouTube videos: %s', [video.url for video in chunk])
             logger.exception('The reason being: %s', e)
+            details = []
 
+        # Exactly one result is put per chunk, so that the consumer below knows when to stop.
+        fetched.put(details)
 
-def main(event, s3_client: s3.Client, youtube: YouTube) -> Iterable[YoutubeVideo]:
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for chunk in chunks:
+            executor.submit(fetch, chunk)
+
+        # Every chunk is taken off the queue even if saving one fails, so that no thread is left blocked on it.
+        for _ in chunks:
+            details = fetched.get()
+
+            try:
+                if len(details) > 0:
+                    resolve(save_videos(table, details))
+            except Exception as e:
+                logger.error('Failed to save the YouTube videos: %s', [video.url for video in details])
+                logger.exception('The reason being: %s', e)
+
+
+def collect_videos(event, s3_client: s3.Client, youtube: YouTube) -> Set[YoutubeVideo]:
+    """
+    Returns the videos to be fetched: the new videos on the crawled page, and those deferred by the previous runs.
+    """
     bucket = event['Records'][0]['s3']['bucket']['name']
     key = event['Records'][0]['s3']['object']['key']
 
+    if not is_crawl_key(key):
+        logger.warning("Ignoring the object which is not a crawled webpage: %s", key)
+        return set()
+
     new_obj = s3_client.Object(bucket, key)
     prev_obj = get_previous_object(new_obj)
     new_videos = get_new_videos(new_obj, prev_obj)
@@ -102,18 +222,36 @@ def main(event, s3_client: s3.Client, youtube: YouTube) -> Iterable[YoutubeVideo
     if prev_obj is not None:
         logger.info("Previous version of the crawled webpage: %s", prev_obj.key)
     logger.info('New videos: %s', [video.url for video in new_videos])
+    metrics.count('NewVideos', len(new_videos))
+
+    ledger = getattr(youtube, 'ledger', None)
+    if ledger is not None and ledger.can_spend('videos.list'):
+        deferred = [YoutubeVideo(url) for url in ledger.deferred()]
+        logger.info('Videos deferred by the previous runs: %s', [video.url for video in deferred])
+        metrics.count('DeferredVideosResumed', len(deferred))
+        new_videos = set(new_videos) | set(deferred)
 
-    return get_video_details(new_videos, youtube)
+    return set(new_videos)
+
+
+def main(event, s3_client: s3.Client, youtube: YouTube) -> Iterable[YoutubeVideo]:
+    return get_video_details(collect_videos(event, s3_client, youtube), youtube)
 
 
+@metrics.handler('fetch_video')
 def lambda_handler(event, context):
     s3_client = boto3.resource('s3')
     table_name = os.environ["VIDEOS_TABLE"]
     table = boto3.resource('dynamodb').Table(table_name)
     youtube_api_key = os.environ['GOOGLE_CLOUD_API_KEY']
-    youtube = YouTube(youtube_api_key)
+    backend = youtube_backend(os.environ.get('YOUTUBE_BACKEND', 'google'), youtube_api_key)
+    ledger = quota_ledger()
+    youtube = YouTube(backend=backend, ledger=ledger)
 
-    video_details = main(event, s3_client, youtube)
+    videos = collect_videos(event, s3_client, youtube)
+    fetch_and_save_videos(table, videos, youtube,
+                          concurrency=int(os.environ.get('FETCH_CONCURRENCY', 4)),
+                          chunk_size=int(os.environ.get('FETCH_CHUNK_SIZE', MAX_IDS_PER_REQUEST)))
 
-    for video in video_details:
-        save_video(table, video)
+    if ledger is not None:
+        ledger.log_metrics()
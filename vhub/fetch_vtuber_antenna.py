@@ -1,16 +1,23 @@
-import json
+import hashlib
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, asdict
 from datetime import datetime
 from email.utils import parsedate_to_datetime
-from typing import Tuple
+from tempfile import SpooledTemporaryFile
+from typing import Tuple, Iterable, Optional, Dict, List, Set
 
 import boto3
 import requests
 from boto3_type_annotations import s3
 
-from .utils import utc_now, reverse_timestamp, gzip_str
+from . import metrics
+from .compression import Codec, GZIP, crawl_key, is_crawl_key, page_codec
+from .manifest import ManifestEntry, load_manifest, save_manifest, add_entry
+from .parsers import parse_videos_list
+from .utils import utc_now, reverse_timestamp, write_envelope, extract_page
+from .youtube import YoutubeVideo, youtube_video_url, shared_session
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -21,6 +28,14 @@ class PageItem:
     url: str
     body: str
     crawled_at: datetime
+    # The IDs of the videos listed on the page, saved so that the page needs not be parsed again.
+    videos: Optional[List[str]] = None
+    # The URLs and the video IDs of the pages merged into this one, if the crawl followed the pagination.
+    # The body is that of the first page only, whereas `videos` are those of all the pages.
+    pages: Optional[List[dict]] = None
+
+    def youtube_videos(self) -> List[YoutubeVideo]:
+        return [YoutubeVideo(youtube_video_url(video_id)) for video_id in self.videos]
 
 
 def page_item_from_response(response: requests.Response) -> PageItem:
@@ -29,41 +44,266 @@ def page_item_from_response(response: requests.Response) -> PageItem:
     except:
         date = utc_now()
 
+    with metrics.timer('HtmlParse'):
+        videos = list(parse_videos_list(response.text))
+
     return PageItem(
         url=response.url,
         body=response.text,
-        crawled_at=date
+        crawled_at=date,
+        videos=[video.video_id for video in videos]
     )
 
 
-def save_zipped(obj: s3.Object, body: str):
-    obj.put(Body=gzip_str(body), ContentEncoding="gzip")
+def save_page(obj: s3.Object, page: PageItem, metadata: Optional[Dict[str, str]] = None, codec: Codec = GZIP):
+    """
+    Save the page in the envelope format, compressing it straight into the upload stream with the codec.
+
+    The compressed page is kept in memory up to 8 MiB, and spills over to a temporary file beyond that.
+    """
+    header = asdict(page)
+    body = header.pop('body')
+
+    with SpooledTemporaryFile(max_size=8 << 20) as f:
+        with metrics.timer('Compress'):
+            write_envelope(f, header, body, codec)
+
+        metrics.count('CompressedBytes', f.tell(), unit='Bytes')
+        f.seek(0)
+
+        with metrics.timer('S3Put'):
+            obj.upload_fileobj(f, ExtraArgs={
+                'ContentEncoding': codec.content_encoding,
+                'Metadata': {**(metadata or {}), **codec.metadata()}
+            })
+
+
+def videos_digest(videos: Iterable[YoutubeVideo]) -> str:
+    """
+    Returns a digest of the set of the videos, which ignores everything else on the page (e.g. ads and timestamps).
+    """
+    urls = sorted(set(video.url for video in videos))
+    return hashlib.sha256('\n'.join(urls).encode('utf-8')).hexdigest()
+
+
+def latest_crawl(bucket: s3.Bucket, manifest: Optional[List[ManifestEntry]] = None) -> Optional[s3.Object]:
+    """
+    Returns the latest crawled page, the first entry of the manifest if any, or else the one with the smallest key.
+    """
+    if manifest:
+        return bucket.Object(manifest[0].key)
+
+    # The crawled pages come first in the bucket, before e.g. the dictionaries and the manifest.
+    for summary in bucket.objects.page_size(1).limit(1):
+        return summary.Object() if is_crawl_key(summary.key) else None
+
+    return None
+
+
+def crawled_video_ids(obj: s3.Object) -> Set[str]:
+    """
+    Returns the IDs of the videos on the crawled page, read from the header of the envelope.
+    """
+    return set(extract_page(obj, with_body=False).get('videos') or [])
+
 
+def conditional_headers(metadata: Dict[str, str]) -> Dict[str, str]:
+    headers = {}
 
-def save_page(obj: s3.Object, page: PageItem):
-    body = json.dumps(asdict(page), default=str)
-    save_zipped(obj, body)
+    if 'etag' in metadata:
+        headers['If-None-Match'] = metadata['etag']
+    if 'last-modified' in metadata:
+        headers['If-Modified-Since'] = metadata['last-modified']
 
+    return headers
 
-def main(response: requests.Response, bucket: s3.Bucket) -> Tuple[s3.Object, PageItem]:
+
+def page_metadata(response: requests.Response, digest: str) -> Dict[str, str]:
+    metadata = {'videos-digest': digest}
+
+    if 'ETag' in response.headers:
+        metadata['etag'] = response.headers['ETag']
+    if 'Last-Modified' in response.headers:
+        metadata['last-modified'] = response.headers['Last-Modified']
+
+    return metadata
+
+
+def main(response: requests.Response, bucket: s3.Bucket, codec: Codec = GZIP) -> Tuple[s3.Object, PageItem]:
     page = page_item_from_response(response)
     timestamp = reverse_timestamp(page.crawled_at)
-    key = f"{timestamp}.json.gz"
+    key = crawl_key(timestamp, codec)
     obj = bucket.Object(key)
 
     return (obj, page)
 
 
+def page_url(url: str, n: int) -> str:
+    """
+    Returns the URL of the `n`-th page (1-origin) of the paginated list.
+    """
+    return url if n == 1 else f"{url}?page={n}"
+
+
+def fetch_page(session: requests.Session, url: str, timeout: Tuple[float, float]) -> Optional[PageItem]:
+    """
+    Fetch and parse a page following the first one, or return `None` if it failed or is past the last page.
+    """
+    try:
+        with metrics.timer('HttpGet'):
+            response = session.get(url, timeout=timeout)
+    except requests.RequestException as e:
+        logger.warning("The request to '%s' failed: %s", url, e)
+        metrics.count('HttpErrors')
+        return None
+
+    if not response.ok:
+        if response.status_code != 404:
+            logger.warning("The request to '%s' failed with the status code `%s`.", url, response.status_code)
+            metrics.count('HttpErrors')
+        return None
+
+    return page_item_from_response(response)
+
+
+def following_pages(url: str, first: PageItem, known: Set[str], session: requests.Session, max_pages: int,
+                    timeout: Tuple[float, float], concurrency: int) -> List[PageItem]:
+    """
+    Fetch the pages after the first one, `concurrency` pages at a time, up to the `max_pages`-th page.
+
+    The pages up to the first one whose videos are all `known` (i.e. on the last crawl) are returned,
+    as the videos on the later pages are not new either. So are the pages before a page which failed or is empty.
+    """
+    pages = []
+    if len(first.videos) == 0 or set(first.videos) <= known:
+        return pages
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for start in range(2, max_pages + 1, concurrency):
+            urls = [page_url(url, n) for n in range(start, min(start + concurrency, max_pages + 1))]
+
+            for page in executor.map(lambda next_url: fetch_page(session, next_url, timeout), urls):
+                if page is None or len(page.videos) == 0:
+                    return pages
+
+                pages.append(page)
+
+                if set(page.videos) <= known:
+                    return pages
+
+    return pages
+
+
+def merge_pages(first: PageItem, following: List[PageItem]) -> PageItem:
+    """
+    Merge the pages into the first one, listing the videos in order without duplicates,
+    which occur when a video is pushed to the next page while crawling.
+    """
+    if len(following) == 0:
+        return first
+
+    pages = [first] + following
+    videos = list(dict.fromkeys(video for page in pages for video in page.videos))
+
+    return PageItem(
+        url=first.url,
+        body=first.body,
+        crawled_at=first.crawled_at,
+        videos=videos,
+        pages=[{'url': page.url, 'videos': page.videos} for page in pages]
+    )
+
+
+def crawl(url: str, bucket: s3.Bucket, codec: Codec = GZIP, max_pages: int = 1,
+          session: Optional[requests.Session] = None, timeout: Tuple[float, float] = (3.05, 5),
+          concurrency: int = 4) -> Optional[s3.Object]:
+    """
+    Save the page into the bucket, unless its videos are the same as the last time.
+
+    With `max_pages` more than 1, the following pages are fetched as well, and saved merged into the first one.
+    The requests share the keep-alive connections of `session`, each within `timeout` (connect, read).
+
+    Returns the saved object, or `None` if nothing was saved.
+    """
+    session = session if session is not None else shared_session()
+
+    with metrics.timer('LatestCrawl'):
+        manifest = load_manifest(bucket)
+        latest = latest_crawl(bucket, manifest)
+
+        # The metadata of the latest page is in the manifest, so that it needs no HEAD.
+        if manifest and manifest[0].validators is not None:
+            metadata = manifest[0].metadata()
+        else:
+            metadata = {} if latest is None else latest.metadata
+
+    with metrics.timer('HttpGet'):
+        response = session.get(url, headers=conditional_headers(metadata), timeout=timeout)
+
+    if response.status_code == 304:
+        logger.info("The page '%s' has not been modified since the last crawl.", url)
+        metrics.count('PagesNotModified')
+        return None
+    elif not response.ok:
+        logger.warning("The request to '%s' failed with the status code `%s`.",
+                       response.url, response.status_code)
+        logger.warning(response.text)
+        metrics.count('HttpErrors')
+        return None
+
+    obj, page = main(response, bucket, codec)
+
+    if max_pages > 1:
+        known = set() if latest is None else crawled_video_ids(latest)
+        following = following_pages(url, page, known, session, max_pages, timeout, concurrency)
+        page = merge_pages(page, following)
+        metrics.count('PagesFollowed', len(following))
+
+        # The digest of the latest crawl may cover more pages than followed this time,
+        # so the videos are compared as a set instead.
+        if latest is not None and set(page.videos) <= known:
+            logger.info("No new videos on the pages of '%s' since the last crawl.", url)
+            metrics.count('PagesUnchanged')
+            return None
+
+    digest = videos_digest(page.youtube_videos())
+
+    if digest == metadata.get('videos-digest'):
+        logger.info("The videos on the page '%s' have not changed since the last crawl.", url)
+        metrics.count('PagesUnchanged')
+        return None
+
+    metadata = page_metadata(response, digest)
+    save_page(obj, page, metadata, codec)
+    metrics.count('PagesSaved')
+
+    # The page is saved first, so that the manifest never refers to a missing page.
+    # `fetch_video` falls back to listing the bucket for a page not in the manifest yet.
+    entry = ManifestEntry(
+        key=obj.key,
+        previous=None if latest is None else latest.key,
+        videos_digest=digest,
+        validators={name: value for name, value in metadata.items() if name != 'videos-digest'}
+    )
+    try:
+        save_manifest(bucket, add_entry(manifest, entry))
+    except Exception as e:
+        logger.error('Failed to update the manifest of the crawled pages.')
+        logger.exception('The reason being: %s', e)
+
+    metrics.count('PageVideos', len(page.videos))
+    return obj
+
+
+@metrics.handler('fetch_vtuber_antenna')
 def lambda_handler(event, context):
     bucket_name = os.environ["CRAWLED_WEBPAGE_BUCKET"]
     url = "https://vtuber-antenna.net/new/"
-    response = requests.get(url)
-
-    if response.ok:
-        bucket = boto3.resource("s3").Bucket(bucket_name)
-        obj, page = main(response, bucket)
-        save_page(obj, page)
-    else:
-        logger.warn("The request to '%s' failed with the status code `%s`.",
-                    response.url, response.status_code)
-        logger.warn(response.text)
+    bucket = boto3.resource("s3").Bucket(bucket_name)
+    codec = page_codec(os.environ.get('PAGE_CODEC', 'gzip'), bucket_name, os.environ.get('ZSTD_DICTIONARY_ID'))
+    timeout = float(os.environ.get('CRAWL_TIMEOUT', 5))
+
+    crawl(url, bucket, codec,
+          max_pages=int(os.environ.get('CRAWL_MAX_PAGES', 3)),
+          timeout=(min(3.05, timeout), timeout),
+          concurrency=int(os.environ.get('CRAWL_CONCURRENCY', 4)))
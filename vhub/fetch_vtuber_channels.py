@@ -1,103 +1,202 @@
 import logging
 import os
-from typing import Iterable
+from dataclasses import dataclass
+from typing import Iterable, List, Dict, Optional
 
 import boto3
 import requests
 from boto3_type_annotations import dynamodb
 from botocore.exceptions import ClientError
-from bs4 import BeautifulSoup
-import re
-from toolz import assoc, groupby
 
+from vhub import metrics
+from vhub.channels import load_aliases, save_aliases
+from vhub.mentions import custom_url_aliases
+from vhub.parsers import parse_vtubers_list
+from vhub.quota import quota_ledger
+from vhub.storage import batch_get_items, batch_put_items, scan_items
 from vhub.utils import emptystr_to_none
-from vhub.youtube import YoutubeChannel
+from vhub.youtube import YoutubeChannel, YouTube, youtube_backend
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
-def process_channels_with_multiple_affiliations(channels: Iterable[YoutubeChannel]) -> Iterable[YoutubeChannel]:
-    groups = groupby(key=lambda x: x.url, seq=channels)
+def save_channel(table: dynamodb.Table, channel: YoutubeChannel):
+    try:
+        table.update_item(
+            Key={'url': channel.url},
+            AttributeUpdates={
+                'name': {'Value': channel.name, 'Action': 'PUT'},
+                'thumbnail': {'Value': channel.thumbnail, 'Action': 'PUT'},
+                'affiliations': {'Value': channel.affiliations, 'Action': 'PUT'}
+            }
+        )
+        logger.info('Successfully saved a YouTube channel: %s', channel.url)
+    except ClientError as e:
+        logger.error('Failed to save a YouTube channel: %s', channel.url)
+        logger.exception('The reason being: %s', e)
 
-    for group in groups.values():
-        affiliations = [channel.affiliations[0] for channel in group]
-        channel = group[0]
-        dic = assoc(vars(channel), 'affiliations', affiliations)
 
-        yield YoutubeChannel(**dic)
+def channel_item(channel: YoutubeChannel, current: dict) -> dict:
+    """
+    Build the item to put, keeping the attributes not managed by this crawler (e.g. the blacklist flags).
+    """
+    return {
+        **current,
+        'url': channel.url,
+        'name': channel.name,
+        'thumbnail': channel.thumbnail,
+        'affiliations': channel.affiliations
+    }
 
 
-def _parse_vtubers_list(html: str) -> Iterable[YoutubeChannel]:
-    try:
-        soup = BeautifulSoup(html, "lxml")
-    except:
-        soup = BeautifulSoup(html, "html5lib")
+def save_channels(table: dynamodb.Table, channels: Iterable[YoutubeChannel], current: Optional[Dict[str, dict]] = None):
+    """
+    Save the channels, where `current` maps the URLs to the items already in the table, if known.
+    """
+    channels = list(channels)
+
+    if current is None:
+        current_items = batch_get_items(table, [{'url': channel.url} for channel in channels])
+        current = {item['url']: item for item in current_items}
+
+    items = [channel_item(channel, current.get(channel.url, {})) for channel in channels]
+
+    with metrics.timer('DynamoDBWrite'):
+        failures = batch_put_items(table, items)
+
+    for item, e in failures:
+        logger.error('Failed to save a YouTube channel: %s', item['url'])
+        logger.error('The reason being: %s', e)
+
+    logger.info('Successfully saved %d YouTube channels.', len(items) - len(failures))
+    metrics.count('ChannelsFailed', len(failures))
+
+
+@dataclass(frozen=True)
+class ChannelDiff:
+    inserted: List[YoutubeChannel]
+    updated: List[YoutubeChannel]
+    unchanged: List[YoutubeChannel]
+    removed: List[str]
+
+
+def load_channels(table: dynamodb.Table) -> Dict[str, dict]:
+    """
+    Load the whole table as a dictionary keyed by the channel URL.
+    """
+    return {item['url']: item for item in scan_items(table)}
+
 
-    channels = soup.select("div#main-area div.channel ul.icon li:not(.empty)")
+def is_channel_changed(channel: YoutubeChannel, item: dict) -> bool:
+    return channel.name != item.get('name') \
+        or channel.thumbnail != item.get('thumbnail') \
+        or set(channel.affiliations or []) != set(item.get('affiliations') or [])
 
-    category = None  # This is mutated inside the `for` statement below.
+
+def diff_channels(channels: Iterable[YoutubeChannel], current: Dict[str, dict]) -> ChannelDiff:
+    """
+    Compare the crawled channels with the items in the table.
+
+    The channels in the table but not in the crawled page are reported as `removed` by their URLs.
+    """
+    inserted, updated, unchanged = [], [], []
+    crawled_urls = set()
 
     for channel in channels:
-        category_elem = channel.select_one("h3")
+        crawled_urls.add(channel.url)
+        item = current.get(channel.url)
 
-        if category_elem:
-            category = category_elem.get("id")
+        if item is None:
+            inserted.append(channel)
+        elif is_channel_changed(channel, item):
+            updated.append(channel)
         else:
-            thumbnail = channel.select_one("p.thumbnail a img")
-            a = channel.select_one("p.channelName a")
-            href = a.get("href")
+            unchanged.append(channel)
 
-            channel_id = re.fullmatch(r"\/channel\/\?id=(.+)", href).group(1)
+    removed = sorted(url for url in current if url not in crawled_urls)
 
-            yield YoutubeChannel(
-                url=f"https://www.youtube.com/channel/{channel_id}",
-                name=a.text,
-                thumbnail=thumbnail.get("src"),
-                affiliations=[category]
-            )
+    return ChannelDiff(inserted=inserted, updated=updated, unchanged=unchanged, removed=removed)
 
 
-def parse_vtubers_list(html: str) -> Iterable[YoutubeChannel]:
+def sync_aliases(table: dynamodb.Table, diff: ChannelDiff, youtube: YouTube) -> Dict[str, str]:
     """
-    Parse the web page: https://vtuber-antenna.net/list/
+    Index the custom URLs of the channels in the ChannelAliases table, and return the aliases newly saved.
+
+    The channels not indexed yet and the updated ones are looked up. Channels without a custom URL are thus
+    looked up on every run, which costs only a quota unit per 50 channels.
     """
-    return process_channels_with_multiple_affiliations(_parse_vtubers_list(html))
+    with metrics.timer('DynamoDBScan'):
+        current = load_aliases(table)
 
+    indexed = set(current.values())
+    channels = diff.updated + [channel for channel in diff.inserted + diff.unchanged if channel.url not in indexed]
 
-def save_channel(table: dynamodb.Table, channel: YoutubeChannel):
-    try:
-        table.update_item(
-            Key={'url': channel.url},
-            AttributeUpdates={
-                'name': {'Value': channel.name, 'Action': 'PUT'},
-                'thumbnail': {'Value': channel.thumbnail, 'Action': 'PUT'},
-                'affiliations': {'Value': channel.affiliations, 'Action': 'PUT'}
-            }
-        )
-        logger.info('Successfully saved a YouTube channel: %s', channel.url)
-    except ClientError as e:
-        logger.error('Failed to save a YouTube channel: %s', channel.url)
-        logger.exception('The reason being: %s', e)
+    custom_urls = youtube.get_custom_urls(channels)
+    aliases = {alias: url
+               for url, custom_url in custom_urls.items()
+               for alias in custom_url_aliases(custom_url)
+               if current.get(alias) != url}
+
+    logger.info('Looked up the custom URLs of %d channels, %d new aliases.', len(channels), len(aliases))
+    metrics.count('AliasesSaved', len(aliases))
 
+    with metrics.timer('DynamoDBWrite'):
+        save_aliases(table, aliases)
 
-def main(response: requests.Response, table: dynamodb.Table):
+    return aliases
+
+
+def main(response: requests.Response, table: dynamodb.Table,
+         alias_table: Optional[dynamodb.Table] = None, youtube: Optional[YouTube] = None):
     if response.ok:
-        channels = parse_vtubers_list(response.text)
+        with metrics.timer('HtmlParse'):
+            channels = list(parse_vtubers_list(response.text))
+
+        with metrics.timer('DynamoDBScan'):
+            current = load_channels(table)
+
+        diff = diff_channels(channels, current)
 
-        for channel in channels:
-            save_channel(table, channel)
+        logger.info('Channels: %d unchanged, %d updated, %d new, %d removed.',
+                    len(diff.unchanged), len(diff.updated), len(diff.inserted), len(diff.removed))
+        if len(diff.removed) > 0:
+            logger.warning('Channels no longer listed (kept in the table): %s', diff.removed)
+
+        for name, group in [('Unchanged', diff.unchanged), ('Updated', diff.updated),
+                            ('Inserted', diff.inserted), ('Removed', diff.removed)]:
+            metrics.count(f'Channels{name}', len(group))
+
+        save_channels(table, diff.inserted + diff.updated, current)
+
+        if alias_table is not None and youtube is not None:
+            sync_aliases(alias_table, diff, youtube)
+
+        return diff
     else:
         logger.warning("The request to '%s' failed with the status code `%s`.",
                        response.url, response.status_code)
         logger.warning(response.text)
+        metrics.count('HttpErrors')
 
 
+@metrics.handler('fetch_vtuber_channels')
 def lambda_handler(event, context):
     table_name = os.environ['CHANNELS_TABLE']
     table = boto3.resource("dynamodb").Table(table_name)
 
+    if 'CHANNEL_ALIASES_TABLE' in os.environ:
+        alias_table = boto3.resource("dynamodb").Table(os.environ['CHANNEL_ALIASES_TABLE'])
+        backend = youtube_backend(os.environ.get('YOUTUBE_BACKEND', 'google'), os.environ['GOOGLE_CLOUD_API_KEY'])
+        youtube = YouTube(backend=backend, ledger=quota_ledger())
+    else:
+        alias_table, youtube = None, None
+
     url = "https://vtuber-antenna.net/list/"
-    response = requests.get(url)
+    with metrics.timer('HttpGet'):
+        response = requests.get(url)
+
+    main(response, table, alias_table, youtube)
 
-    main(response, table)
+    if youtube is not None and youtube.ledger is not None:
+        youtube.ledger.log_metrics()
@@ -0,0 +1,61 @@
+import json
+import logging
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional
+
+from boto3_type_annotations import s3
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+# The manifest of the bucket of the crawled pages lists the latest crawls, the newest first,
+# each with the crawl saved just before it, so that the previous crawl is found by a single GET.
+# The key is not a crawl key (see `compression.is_crawl_key`), so it triggers no `fetch_video`.
+MANIFEST_KEY = 'manifest.json'
+
+# A day of crawls every 5 minutes.
+MANIFEST_SIZE = 288
+
+
+@dataclass(frozen=True)
+class ManifestEntry:
+    key: str
+    # The key of the crawl saved just before, or `None` for the first crawl of the bucket.
+    previous: Optional[str]
+    videos_digest: str
+    # The validators of the response, i.e. `etag` and `last-modified`, as in the metadata of the object.
+    # Entries recorded before the validators were added have `None`.
+    validators: Optional[Dict[str, str]] = None
+
+    def metadata(self) -> Dict[str, str]:
+        """
+        Returns the user-defined metadata of the crawled page, as saved by the crawler.
+        """
+        return {**(self.validators or {}), 'videos-digest': self.videos_digest}
+
+
+def load_manifest(bucket: s3.Bucket) -> List[ManifestEntry]:
+    """
+    Returns the entries of the manifest, or an empty list if the bucket has none yet.
+    """
+    try:
+        body = bucket.Object(MANIFEST_KEY).get()['Body'].read()
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return []
+        raise
+
+    return [ManifestEntry(**entry) for entry in json.loads(body)['entries']]
+
+
+def save_manifest(bucket: s3.Bucket, entries: List[ManifestEntry]):
+    body = json.dumps({'entries': [asdict(entry) for entry in entries]})
+    bucket.Object(MANIFEST_KEY).put(Body=body.encode('utf-8'), ContentType='application/json')
+
+
+def add_entry(entries: List[ManifestEntry], entry: ManifestEntry, size: int = MANIFEST_SIZE) -> List[ManifestEntry]:
+    return ([entry] + [e for e in entries if e.key != entry.key])[:size]
+
+
+def find_entry(entries: List[ManifestEntry], key: str) -> Optional[ManifestEntry]:
+    return next((entry for entry in entries if entry.key == key), None)
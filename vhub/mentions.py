@@ -0,0 +1,88 @@
+import re
+from typing import Dict, List, Optional
+
+# Every form of a channel URL, matched in a single pass: with the channel ID, a custom URL (/c/ or /user/)
+# or a handle (/@). The pattern starts with the host, so that `re` can skip ahead to its occurrences,
+# and the optional scheme and subdomain before it are checked by `_host_prefix` only on a match.
+# A URL with the scheme may follow any character, e.g. a name written right before it,
+# whereas a URL without the scheme must not be a part of another host or path, e.g. "notyoutube.com".
+# The boundary is ASCII only, as Japanese text often runs into the URL without a space.
+_channel_reference = re.compile(r"youtube\.com/(?:(channel|c|user)/([a-zA-Z0-9_\-]+)|@([\w\-]+(?:\.[\w\-]+)*))")
+_host_prefix = re.compile(r"(?:https?://|(?:^|[^A-Za-z0-9_./\-]))(?:(?:www|m)\.)?\Z")
+# The longest prefix, "https://www.", and the character before it.
+_host_prefix_window = 13
+
+
+def channel_url(channel_id: str) -> str:
+    return f"https://www.youtube.com/channel/{channel_id}"
+
+
+def alias_key(kind: str, name: str) -> str:
+    """
+    Returns the key of the alias of a channel, e.g. "c/name", "user/name" or "@handle".
+
+    Custom URLs and handles are case-insensitive, so the key is lower-cased.
+    """
+    return f"@{name}".lower() if kind == '@' else f"{kind}/{name}".lower()
+
+
+def custom_url_aliases(custom_url: str) -> List[str]:
+    """
+    Returns the alias keys of a channel with the custom URL given by the API (`snippet.customUrl`).
+
+    The custom URL is a handle, e.g. "@name", for most channels, and a legacy custom name, e.g. "name", for the rest.
+    Both are reachable by /c/name as well.
+    """
+    if custom_url.startswith('@'):
+        return [alias_key('@', custom_url[1:]), alias_key('c', custom_url[1:])]
+    else:
+        return [alias_key('c', custom_url)]
+
+
+class MentionMatcher:
+    """
+    Extracts the channels mentioned in a text as their canonical URLs, i.e. https://www.youtube.com/channel/<ID>.
+
+    The text is scanned once by a single regular expression, and every custom URL or handle is resolved
+    by a dictionary lookup into `aliases`, which maps the alias keys (see `alias_key`) to the canonical URLs.
+    The time per text thus does not depend on the number of known channels.
+
+    A custom URL not in `aliases` is returned as is, in the https://www.youtube.com/ form,
+    whereas an unknown handle is dropped as it cannot be looked up.
+    """
+
+    def __init__(self, aliases: Optional[Dict[str, str]] = None):
+        self.aliases = aliases if aliases is not None else {}
+
+    def resolve(self, match) -> Optional[str]:
+        kind, name, handle = match.groups()
+
+        if handle is not None:
+            return self.aliases.get(alias_key('@', handle))
+        elif kind == 'channel':
+            return channel_url(name)
+        else:
+            return self.aliases.get(alias_key(kind, name), f"https://www.youtube.com/{kind}/{name}")
+
+    def channel_urls(self, text: Optional[str]) -> List[str]:
+        """
+        Returns the canonical URLs of the channels mentioned in the text, without duplicates, in order of appearance.
+        """
+        if text is None:
+            return []
+
+        urls = {}
+
+        for match in _channel_reference.finditer(text):
+            start = match.start()
+            if _host_prefix.search(text[max(0, start - _host_prefix_window):start]) is None:
+                continue
+
+            url = self.resolve(match)
+            if url is not None:
+                urls[url] = None
+
+        return list(urls)
+
+
+default_matcher = MentionMatcher()
@@ -0,0 +1,213 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, List, Optional, TextIO, Tuple
+
+logger = logging.getLogger()
+
+# The metrics are recorded by the module-level recorder, chosen by `VHUB_METRICS`:
+# "emf" prints them in the CloudWatch Embedded Metric Format when each handler returns,
+# "local" aggregates them in memory, e.g. for the benchmarks, and "off" (the default) drops them.
+NAMESPACE = 'vhub'
+
+# The limits of the Embedded Metric Format per log line.
+MAX_METRICS_PER_LINE = 100
+MAX_VALUES_PER_METRIC = 100
+
+
+class Recorder(ABC):
+    @abstractmethod
+    def record(self, name: str, value: float, unit: str):
+        pass
+
+    def flush(self, dimensions: Optional[Dict[str, str]] = None):
+        pass
+
+
+class NoopRecorder(Recorder):
+    def record(self, name: str, value: float, unit: str):
+        pass
+
+
+class AggregatingRecorder(Recorder):
+    """
+    Keeps every value recorded, by the metric name. The values can be recorded from any thread.
+    """
+
+    def __init__(self):
+        self.values: Dict[str, List[float]] = {}
+        self.units: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, value: float, unit: str):
+        with self._lock:
+            self.values.setdefault(name, []).append(value)
+            self.units[name] = unit
+
+    def drain(self) -> Tuple[Dict[str, List[float]], Dict[str, str]]:
+        with self._lock:
+            values, units = self.values, self.units
+            self.values, self.units = {}, {}
+
+        return values, units
+
+
+class EmfRecorder(AggregatingRecorder):
+    """
+    Prints the values recorded since the last flush as CloudWatch Embedded Metric Format, which CloudWatch Logs
+    turns into metrics. A metric with several values is printed as an array, which CloudWatch treats as a histogram.
+    """
+
+    def __init__(self, namespace: str = NAMESPACE, stream: Optional[TextIO] = None):
+        super().__init__()
+        self.namespace = namespace
+        self.stream = stream
+
+    def lines(self, values: Dict[str, List[float]], units: Dict[str, str], dimensions: Dict[str, str]) -> List[dict]:
+        names = sorted(values)
+        n_lines = max((len(values[name]) - 1) // MAX_VALUES_PER_METRIC + 1 for name in names) if names else 0
+        lines = []
+
+        for i in range(n_lines):
+            start = i * MAX_VALUES_PER_METRIC
+            chunk = {name: values[name][start:start + MAX_VALUES_PER_METRIC] for name in names}
+            chunk_names = [name for name in names if len(chunk[name]) > 0]
+
+            for j in range(0, len(chunk_names), MAX_METRICS_PER_LINE):
+                line_names = chunk_names[j:j + MAX_METRICS_PER_LINE]
+                line = {
+                    '_aws': {
+                        'Timestamp': int(time.time() * 1000),
+                        'CloudWatchMetrics': [{
+                            'Namespace': self.namespace,
+                            'Dimensions': [sorted(dimensions)],
+                            'Metrics': [{'Name': name, 'Unit': units[name]} for name in line_names]
+                        }]
+                    },
+                    **dimensions
+                }
+                for name in line_names:
+                    line[name] = chunk[name][0] if len(chunk[name]) == 1 else chunk[name]
+
+                lines.append(line)
+
+        return lines
+
+    def flush(self, dimensions: Optional[Dict[str, str]] = None):
+        values, units = self.drain()
+        stream = self.stream if self.stream is not None else sys.stdout
+
+        for line in self.lines(values, units, dimensions or {}):
+            stream.write(json.dumps(line) + '\n')
+        stream.flush()
+
+
+class LocalRecorder(AggregatingRecorder):
+    """
+    Aggregates the values in memory, to be summarized e.g. at the end of a benchmark.
+    """
+
+    def summary(self) -> Dict[str, dict]:
+        with self._lock:
+            items = [(name, sorted(values), self.units[name]) for name, values in self.values.items()]
+
+        return {name: {
+            'unit': unit,
+            'count': len(values),
+            'sum': sum(values),
+            'min': values[0],
+            'p50': percentile(values, 0.5),
+            'p95': percentile(values, 0.95),
+            'max': values[-1],
+        } for name, values, unit in sorted(items)}
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def recorder_of(mode: str) -> Recorder:
+    if mode == 'off':
+        return NoopRecorder()
+    elif mode == 'emf':
+        return EmfRecorder()
+    elif mode == 'local':
+        return LocalRecorder()
+    else:
+        raise ValueError(f"Unknown metrics mode: {mode}")
+
+
+_recorder: Recorder = recorder_of(os.environ.get('VHUB_METRICS', 'off'))
+
+
+def configure(mode_or_recorder) -> Recorder:
+    """
+    Replace the module-level recorder, by a mode of `VHUB_METRICS` or by a recorder, and return the new one.
+    """
+    global _recorder
+    _recorder = recorder_of(mode_or_recorder) if isinstance(mode_or_recorder, str) else mode_or_recorder
+
+    return _recorder
+
+
+def recorder() -> Recorder:
+    return _recorder
+
+
+def count(name: str, value: float = 1, unit: str = 'Count'):
+    _recorder.record(name, value, unit)
+
+
+@contextmanager
+def timer(name: str):
+    """
+    Record the time spent in the block as the metric in milliseconds, whether the block raises or not.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _recorder.record(name, (time.perf_counter() - start) * 1000, 'Milliseconds')
+
+
+def timed(name: str) -> Callable:
+    """
+    The decorator version of `timer`.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def handler(function_name: str) -> Callable:
+    """
+    Decorate a Lambda handler to time it, and to flush the metrics recorded during the invocation
+    with the dimension `Function`.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            try:
+                with timer('Duration'):
+                    return f(*args, **kwargs)
+            finally:
+                try:
+                    _recorder.flush({'Function': function_name})
+                except Exception as e:
+                    logger.warning('Failed to flush the metrics: %s', e)
+
+        return wrapper
+
+    return decorator
@@ -1,87 +1,326 @@
 import logging
 import os
-from typing import Iterable, Optional, Tuple, Set
+import re
+import time
+from typing import Iterable, Iterator, Optional, Tuple, Set, Dict, List, TYPE_CHECKING
 
 import boto3
-import tweepy
 from boto3.dynamodb.types import TypeDeserializer
 from boto3_type_annotations import dynamodb
 from toolz import valmap
-from twitter_text import parse_tweet
 
+from . import metrics
+from .channels import ChannelDirectory, load_aliases
+from .mentions import MentionMatcher, default_matcher
 from .youtube import YoutubeVideo, YoutubeChannel, short_youtube_video_url, mentioned_channel_urls
 
+if TYPE_CHECKING:
+    import tweepy
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
-def vtuber_channel_detail(url: str, table: dynamodb.Table) -> Optional[YoutubeChannel]:
-    response = table.get_item(Key={'url': url})
-    dic = response.get('Item')
+# The channel directories are kept at the module level, so that warm invocations reuse them.
+_channel_directories: Dict[str, ChannelDirectory] = {}
 
-    if dic is None:
-        return None
-    else:
-        return YoutubeChannel(
-            url=dic['url'],
-            name=dic['name'],
-            is_host_blacklisted=dic.get('is_host_blacklisted'),
-            is_guest_blacklisted=dic.get('is_guest_blacklisted')
+
+def channel_directory(table: dynamodb.Table) -> ChannelDirectory:
+    """
+    Returns the channel directory of the table, which survives across warm invocations.
+
+    With `CHANNEL_CACHE_PRELOAD`, the whole table is scanned on a cold start. If the Scan fails, e.g. throttled
+    by the small read capacity, the channels are looked up on demand instead.
+    """
+    directory = _channel_directories.get(table.name)
+
+    if directory is None:
+        directory = ChannelDirectory(
+            table,
+            maxsize=int(os.environ.get('CHANNEL_CACHE_SIZE', 4096)),
+            ttl=float(os.environ.get('CHANNEL_CACHE_TTL', 3600))
         )
+        if os.environ.get('CHANNEL_CACHE_PRELOAD', 'false').lower() == 'true':
+            try:
+                directory.preload()
+            except Exception as e:
+                logger.warning('Failed to preload the channel directory, looking up the channels on demand: %s', e)
+        _channel_directories[table.name] = directory
+
+    return directory
+
+
+# The mention matchers are kept at the module level as well, with the time they expire.
+_mention_matchers: Dict[str, Tuple[float, MentionMatcher]] = {}
+
+
+def mention_matcher(table: dynamodb.Table) -> MentionMatcher:
+    """
+    Returns the mention matcher resolving the aliases in the ChannelAliases table, reloaded every `CHANNEL_ALIASES_TTL`
+    seconds.
+    """
+    now = time.monotonic()
+    expires_at, matcher = _mention_matchers.get(table.name, (0.0, None))
 
+    if matcher is None or now >= expires_at:
+        with metrics.timer('DynamoDBScan'):
+            aliases = load_aliases(table)
 
-def mentioned_vtuber_channels(video: YoutubeVideo, table: dynamodb.Table) -> Iterable[YoutubeChannel]:
-    channels = mentioned_channel_urls(video)
-    details = (vtuber_channel_detail(channel, table) for channel in channels)
-    vtuber_channels = (x for x in details if x is not None and not x.is_guest_blacklisted)
+        logger.info('Loaded %d channel aliases.', len(aliases))
+        matcher = MentionMatcher(aliases)
+        _mention_matchers[table.name] = (now + float(os.environ.get('CHANNEL_ALIASES_TTL', 3600)), matcher)
 
-    return vtuber_channels
+    return matcher
 
 
-def video_from_event(event) -> YoutubeVideo:
-    image = event['Records'][0]['dynamodb']['NewImage']
+def configured_mention_matcher() -> MentionMatcher:
+    if 'CHANNEL_ALIASES_TABLE' in os.environ:
+        return mention_matcher(boto3.resource('dynamodb').Table(os.environ['CHANNEL_ALIASES_TABLE']))
+    else:
+        return default_matcher
+
+
+def mentioned_vtuber_channels(video: YoutubeVideo, details: Dict[str, Optional[YoutubeChannel]],
+                              matcher: MentionMatcher = default_matcher) -> Iterable[YoutubeChannel]:
+    channels = mentioned_channel_urls(video, matcher)
+    vtuber_channels = (details.get(channel) for channel in channels)
+
+    return (x for x in vtuber_channels if x is not None and not x.is_guest_blacklisted)
+
+
+def collab_channels(video: YoutubeVideo, details: Dict[str, Optional[YoutubeChannel]],
+                    matcher: MentionMatcher = default_matcher) -> List[YoutubeChannel]:
+    """
+    Select the VTuber channels taking part in the video, out of the looked-up channels.
+
+    The first element is the host channel, if it is a known VTuber channel and not black-listed as a host.
+    If the host channel is black-listed, nobody is taking part.
+    """
+    host_channel = details.get(video.channel_url)
+    mentioned_channels = list(mentioned_vtuber_channels(video, details, matcher))
+
+    if host_channel is None:
+        return mentioned_channels
+    elif host_channel.is_host_blacklisted:
+        return []
+    else:
+        return [host_channel] + mentioned_channels
+
+
+def video_from_record(record: dict) -> YoutubeVideo:
+    image = record['dynamodb']['NewImage']
     dic = valmap(TypeDeserializer().deserialize, image)
 
     return YoutubeVideo(**dic)
 
 
+def record_id(record: dict) -> Optional[str]:
+    return record.get('dynamodb', {}).get('SequenceNumber')
+
+
+def sequence_number(record: dict) -> int:
+    return int(record_id(record) or 0)
+
+
+def videos_from_event(event) -> List[Tuple[dict, Optional[YoutubeVideo]]]:
+    """
+    Decode the stream records in the order of their sequence numbers, pairing each record with its video.
+
+    A record of a video already paired with an earlier record is paired with `None`, so that it is notified only once.
+    Records without a new image, i.e. deletions, and the records which cannot be decoded are dropped,
+    as retrying them would never succeed.
+    """
+    records = []
+    seen = set()
+
+    for record in sorted(event['Records'], key=sequence_number):
+        if 'NewImage' not in record.get('dynamodb', {}):
+            continue
+
+        try:
+            video = video_from_record(record)
+        except Exception as e:
+            logger.error('Dropping the stream record which cannot be decoded: %s', record_id(record))
+            logger.exception('The reason being: %s', e)
+            metrics.count('MalformedRecords')
+            continue
+
+        records.append((record, None if video in seen else video))
+        seen.add(video)
+
+    return records
+
+
 def is_valid_tweet(text: str) -> bool:
+    # twitter_text is slow to import, and most videos are not collaborations to tweet about.
+    from twitter_text import parse_tweet
+
     return parse_tweet(text).valid
 
 
-def message(video: YoutubeVideo, channel_names: Iterable[str]) -> str:
+# The limits of twitter-text (version 3): a URL counts as 23, and a character outside these ranges as 2.
+MAX_WEIGHTED_LENGTH = 280
+URL_WEIGHT = 23
+_heavy_characters = re.compile("[^\u0000-\u10ff\u2000-\u200d\u2010-\u201f\u2032-\u2037]")
+
+HASHTAG = "#VTuberコラボ通知"
+PARTICIPANTS_HEADER = "【参加者】"
+
+
+def weighted_length(text: str) -> int:
+    """
+    Estimate the weighted length of the text as twitter-text counts it, not detecting URLs in the text.
+
+    Every emoji counts as 2 per code point, so a sequence of emoji is overestimated, which errs on the safe side.
+    """
+    if text.isascii():
+        return len(text)
+    else:
+        return len(text) + len(_heavy_characters.findall(text))
+
+
+def others_line(n: int) -> str:
+    return f"ほか{n}名"
+
+
+def message_candidates(video: YoutubeVideo, channel_names: Iterable[str]) -> Iterator[str]:
+    """
+    Generate the messages estimated to fit in a tweet, from the most informative one.
+
+    With or without the title, the message lists all the participants, or as many as fit followed by the number
+    of the rest, or none of them, in this order of preference.
+    """
     url = short_youtube_video_url(video.url)
-    channel_names_lines = '\n'.join(sorted(channel_names))
+    names = sorted(channel_names)
+    name_lengths = [weighted_length(name) for name in names]
 
-    mes_short = f"#VTuberコラボ通知\n{url}"
-    mes_mid = f"#VTuberコラボ通知\n{video.title}\n{url}"
-    mes_long = f"{mes_short}\n\n【参加者】\n{channel_names_lines}"
-    mes_max = f"{mes_mid}\n\n【参加者】\n{channel_names_lines}"
-    messages = [mes_max, mes_long, mes_mid, mes_short]
+    heads = [[HASHTAG, video.title, url], [HASHTAG, url]] if video.title else [[HASHTAG, url]]
+    # The lines and the newlines between them, where the URL counts as `URL_WEIGHT` whatever its length.
+    head_lengths = [sum(weighted_length(line) for line in head[:-1]) + URL_WEIGHT + len(head) - 1 for head in heads]
+    participants_length = 2 + weighted_length(PARTICIPANTS_HEADER)
 
-    return next(filter(is_valid_tweet, messages))
+    def with_participants(head: List[str], n: int) -> str:
+        lines = names[:n] + ([others_line(len(names) - n)] if n < len(names) else [])
+        return '\n'.join(head) + f"\n\n{PARTICIPANTS_HEADER}\n" + '\n'.join(lines)
 
+    def max_participants(head_length: int) -> int:
+        """
+        The number of the participants which fit, followed by the number of the rest, if any.
+        """
+        length = head_length + participants_length
+        n = 0
 
-def main(event, table: dynamodb.Table, twitter: tweepy.API):
-    video = video_from_event(event)
-    host_channel = vtuber_channel_detail(video.channel_url, table)
-    mentioned_channels = list(mentioned_vtuber_channels(video, table))
+        for name_length in name_lengths[:-1]:
+            others = 1 + weighted_length(others_line(len(names) - n - 1))
+            # The name follows a newline, and so does the number of the rest.
+            if length + 1 + name_length + others > MAX_WEIGHTED_LENGTH:
+                break
+            length += name_length + 1
+            n += 1
+
+        return n
+
+    for head, head_length in zip(heads, head_lengths):
+        if head_length + participants_length + sum(name_lengths) + len(names) <= MAX_WEIGHTED_LENGTH:
+            yield with_participants(head, len(names))
+
+    for head, head_length in zip(heads, head_lengths):
+        n = max_participants(head_length)
+        if n > 0:
+            yield with_participants(head, n)
+
+    for head, head_length in zip(heads, head_lengths):
+        if head_length <= MAX_WEIGHTED_LENGTH:
+            yield '\n'.join(head)
+
+
+def message(video: YoutubeVideo, channel_names: Iterable[str]) -> str:
+    """
+    Compose the tweet about the video, confirming with twitter-text only the message chosen by the estimate.
+
+    The later candidates are tried only if the estimate turns out wrong, e.g. for a title containing a URL.
+    """
+    candidates = message_candidates(video, channel_names)
+    short = f"{HASHTAG}\n{short_youtube_video_url(video.url)}"
+
+    return next(filter(is_valid_tweet, candidates), short)
 
-    if host_channel is None:
-        channels = mentioned_channels
-    elif host_channel.is_host_blacklisted:
-        channels = []
-    else:
-        channels = [host_channel] + mentioned_channels
 
+def notify(video: YoutubeVideo, details: Dict[str, Optional[YoutubeChannel]], twitter: 'tweepy.API',
+           matcher: MentionMatcher = default_matcher):
+    channels = collab_channels(video, details, matcher)
     channel_names = set(channel.name for channel in channels)
 
     if len(channel_names) >= 2:
         mes = message(video, channel_names)
-        twitter.update_status(mes)
 
+        with metrics.timer('TwitterApi'):
+            twitter.update_status(mes)
 
+        metrics.count('Tweets')
+
+
+def channel_urls(video: YoutubeVideo, matcher: MentionMatcher = default_matcher) -> List[str]:
+    return [url for url in [video.channel_url] + mentioned_channel_urls(video, matcher) if url is not None]
+
+
+def batch_item_failures(records: Iterable[dict]) -> dict:
+    """
+    The response reporting the failed records to Lambda, which retries the stream from the first of them.
+    """
+    return {'batchItemFailures': [{'itemIdentifier': record_id(record)} for record in records]}
+
+
+def main(event, table: dynamodb.Table, twitter: 'tweepy.API', directory: Optional[ChannelDirectory] = None,
+         matcher: MentionMatcher = default_matcher) -> dict:
+    """
+    Notify the videos in the order of the stream, stopping at the first failure.
+
+    Lambda retries the stream from the first failed record, redelivering all the records after it,
+    so the failed record and all the later ones are reported, and none of the later videos are tweeted yet.
+    """
+    if directory is None:
+        directory = ChannelDirectory(table)
+
+    records = videos_from_event(event)
+    metrics.count('Records', len(event['Records']))
+
+    with metrics.timer('MentionMatch'):
+        urls = [url for _, video in records if video is not None for url in channel_urls(video, matcher)]
+
+    try:
+        with metrics.timer('ChannelLookup'):
+            details = directory.get_many(urls)
+    except Exception as e:
+        logger.error('Failed to look up the channels of the videos: %s',
+                     [video.url for _, video in records if video is not None])
+        logger.exception('The reason being: %s', e)
+        metrics.count('FailedRecords', len(records))
+        return batch_item_failures(record for record, _ in records)
+
+    for i, (record, video) in enumerate(records):
+        if video is None:
+            continue
+
+        try:
+            notify(video, details, twitter, matcher)
+        except Exception as e:
+            logger.error('Failed to notify the video: %s', video.url)
+            logger.exception('The reason being: %s', e)
+            failed = [record for record, _ in records[i:]]
+            metrics.count('FailedRecords', len(failed))
+            return batch_item_failures(failed)
+
+    directory.log_stats()
+    metrics.count('FailedRecords', 0)
+
+    return batch_item_failures([])
+
+
+@metrics.handler('notifier')
 def lambda_handler_prod(event, context):
+    import tweepy
+
     try:
         CK = os.environ['TWITTER_CONSUMER_KEY']
         CS = os.environ['TWITTER_CONSUMER_SECRET']
@@ -94,12 +333,15 @@ def lambda_handler_prod(event, context):
         table_name = os.environ["CHANNELS_TABLE"]
         table = boto3.resource('dynamodb').Table(table_name)
 
-        main(event, table, twitter)
+        return main(event, table, twitter, channel_directory(table), configured_mention_matcher())
     except Exception as e:
+        # Raised so that Lambda retries the whole batch, instead of taking it as processed.
         logger.error('An unexpected error happened.')
         logger.exception(e)
+        raise
 
 
+@metrics.handler('notifier')
 def lambda_handler_dev(event, context):
     class MockTwitter:
         @staticmethod
@@ -112,7 +354,9 @@ def lambda_handler_dev(event, context):
         table_name = os.environ["CHANNELS_TABLE"]
         table = boto3.resource('dynamodb').Table(table_name)
 
-        main(event, table, twitter)
+        return main(event, table, twitter, channel_directory(table), configured_mention_matcher())
     except Exception as e:
+        # Raised so that Lambda retries the whole batch, instead of taking it as processed.
         logger.error('An unexpected error happened.')
         logger.exception(e)
+        raise
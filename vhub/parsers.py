@@ -0,0 +1,155 @@
+import logging
+import re
+from typing import Iterable, List, Tuple, Optional
+
+from lxml import etree
+from toolz import assoc, groupby
+
+from .youtube import YoutubeVideo, YoutubeChannel
+
+logger = logging.getLogger()
+
+# (href, name, thumbnail) of a channel, or (category,) of a category header.
+ChannelEntry = Tuple[Optional[str], ...]
+
+
+def _has_class(name: str) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# The XPath counterparts of the CSS selectors used with BeautifulSoup below.
+_movie_items = etree.XPath(
+    f"//div[@id='main-area']//div[{_has_class('movie')}]"
+    f"//ul[{_has_class('movieList')} and {_has_class('new')}]//li[not({_has_class('empty')})]"
+)
+_movie_title_links = etree.XPath(f".//p[{_has_class('movieTitle')}]//a")
+_channel_items = etree.XPath(
+    f"//div[@id='main-area']//div[{_has_class('channel')}]"
+    f"//ul[{_has_class('icon')}]//li[not({_has_class('empty')})]"
+)
+_category_headers = etree.XPath(".//h3")
+_thumbnail_images = etree.XPath(f".//p[{_has_class('thumbnail')}]//a//img")
+_channel_name_links = etree.XPath(f".//p[{_has_class('channelName')}]//a")
+
+
+def _first(elements: list):
+    if len(elements) == 0:
+        raise ValueError("The expected element is missing.")
+    else:
+        return elements[0]
+
+
+def _soup(html: str):
+    # BeautifulSoup is only the fallback, so it is imported only when needed.
+    from bs4 import BeautifulSoup
+
+    try:
+        return BeautifulSoup(html, "lxml")
+    except:
+        return BeautifulSoup(html, "html5lib")
+
+
+def _tree(html: str) -> etree._Element:
+    return etree.fromstring(html, etree.HTMLParser())
+
+
+def _video_urls_bs4(html: str) -> List[str]:
+    soup = _soup(html)
+    videos = soup.select("div#main-area div.movie ul.movieList.new li:not(.empty)")
+
+    return [video.select_one("p.movieTitle a")["href"] for video in videos]
+
+
+def _video_urls_lxml(html: str) -> List[str]:
+    tree = _tree(html)
+    return [_first(_movie_title_links(video)).attrib["href"] for video in _movie_items(tree)]
+
+
+def parse_videos_list(html: str) -> Iterable[YoutubeVideo]:
+    """
+    Parse the web page: https://vtuber-antenna.net/new/.
+    """
+    try:
+        urls = _video_urls_lxml(html)
+    except Exception as e:
+        logger.warning('Falling back to BeautifulSoup to parse the videos list: %s', e)
+        urls = _video_urls_bs4(html)
+
+    return (YoutubeVideo(url) for url in urls)
+
+
+def _channel_entries_bs4(html: str) -> List[ChannelEntry]:
+    soup = _soup(html)
+    channels = soup.select("div#main-area div.channel ul.icon li:not(.empty)")
+    entries = []
+
+    for channel in channels:
+        category_elem = channel.select_one("h3")
+
+        if category_elem:
+            entries.append((category_elem.get("id"),))
+        else:
+            thumbnail = channel.select_one("p.thumbnail a img")
+            a = channel.select_one("p.channelName a")
+            entries.append((a.get("href"), a.text, thumbnail.get("src")))
+
+    return entries
+
+
+def _channel_entries_lxml(html: str) -> List[ChannelEntry]:
+    tree = _tree(html)
+    entries = []
+
+    for channel in _channel_items(tree):
+        category_elems = _category_headers(channel)
+
+        if category_elems:
+            entries.append((category_elems[0].get("id"),))
+        else:
+            thumbnail = _first(_thumbnail_images(channel))
+            a = _first(_channel_name_links(channel))
+            entries.append((a.get("href"), "".join(a.itertext()), thumbnail.get("src")))
+
+    return entries
+
+
+def _parse_vtubers_list(html: str) -> Iterable[YoutubeChannel]:
+    try:
+        entries = _channel_entries_lxml(html)
+    except Exception as e:
+        logger.warning('Falling back to BeautifulSoup to parse the VTubers list: %s', e)
+        entries = _channel_entries_bs4(html)
+
+    category = None  # This is mutated inside the `for` statement below.
+
+    for entry in entries:
+        if len(entry) == 1:
+            category, = entry
+        else:
+            href, name, thumbnail = entry
+            channel_id = re.fullmatch(r"\/channel\/\?id=(.+)", href).group(1)
+
+            yield YoutubeChannel(
+                url=f"https://www.youtube.com/channel/{channel_id}",
+                name=name,
+                thumbnail=thumbnail,
+                affiliations=[category]
+            )
+
+
+def process_channels_with_multiple_affiliations(channels: Iterable[YoutubeChannel]) -> Iterable[YoutubeChannel]:
+    groups = groupby(key=lambda x: x.url, seq=channels)
+
+    for group in groups.values():
+        affiliations = [channel.affiliations[0] for channel in group]
+        channel = group[0]
+        dic = assoc(channel.to_item(), 'affiliations', affiliations)
+
+        yield YoutubeChannel(**dic)
+
+
+def parse_vtubers_list(html: str) -> Iterable[YoutubeChannel]:
+    """
+    Parse the web page: https://vtuber-antenna.net/list/
+    """
+    return process_channels_with_multiple_affiliations(_parse_vtubers_list(html))
@@ -0,0 +1,266 @@
+import json
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import List, Callable, Dict, Optional, Set
+
+import boto3
+from boto3_type_annotations import dynamodb
+
+from . import metrics
+from .utils import utc_now
+
+logger = logging.getLogger()
+
+# The quota cost of each API call, see https://developers.google.com/youtube/v3/determine_quota_cost
+QUOTA_COSTS = {
+    'videos.list': 1,
+    'channels.list': 1,
+}
+
+DEFAULT_DAILY_LIMIT = 10000
+
+# The daily quota is reset at midnight Pacific Time. Daylight saving time is ignored, erring on the safe side.
+QUOTA_TIMEZONE = timezone(timedelta(hours=-8))
+
+
+class QuotaStore(ABC):
+    """
+    Persists the quota units spent per day, and the videos deferred to a later run.
+    """
+
+    @abstractmethod
+    def add_units(self, day: str, units: int) -> int:
+        """
+        Add the units spent on the day, and return the new total of the day.
+        """
+        pass
+
+    @abstractmethod
+    def get_units(self, day: str) -> int:
+        pass
+
+    @abstractmethod
+    def defer(self, urls: List[str]):
+        pass
+
+    @abstractmethod
+    def get_deferred(self) -> List[str]:
+        pass
+
+    @abstractmethod
+    def remove_deferred(self, urls: List[str]):
+        pass
+
+    def pop_deferred(self) -> List[str]:
+        """
+        Remove and return all the deferred URLs.
+        """
+        urls = self.get_deferred()
+        self.remove_deferred(urls)
+
+        return urls
+
+
+class FileQuotaStore(QuotaStore):
+    """
+    Keeps the quota in a local JSON file, standing in for `DynamoDBQuotaStore` in tests and local runs.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _load(self) -> dict:
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        else:
+            return {'units': {}, 'deferred': []}
+
+    def _dump(self, data: dict):
+        with open(self.path, 'w') as f:
+            json.dump(data, f)
+
+    def add_units(self, day: str, units: int) -> int:
+        data = self._load()
+        data['units'][day] = data['units'].get(day, 0) + units
+        self._dump(data)
+
+        return data['units'][day]
+
+    def get_units(self, day: str) -> int:
+        return self._load()['units'].get(day, 0)
+
+    def defer(self, urls: List[str]):
+        data = self._load()
+        data['deferred'] = sorted(set(data['deferred']) | set(urls))
+        self._dump(data)
+
+    def get_deferred(self) -> List[str]:
+        return self._load()['deferred']
+
+    def remove_deferred(self, urls: List[str]):
+        data = self._load()
+        data['deferred'] = sorted(set(data['deferred']) - set(urls))
+        self._dump(data)
+
+
+class DynamoDBQuotaStore(QuotaStore):
+    """
+    Keeps the quota in a DynamoDB table with the string hash key `key`.
+
+    The units spent on a day are the number attribute `units` of the item `units#<day>`,
+    and the deferred URLs are the string set `urls` of the item `deferred`.
+    """
+
+    def __init__(self, table: dynamodb.Table):
+        self.table = table
+        # Clients are thread-safe, whereas resources are not.
+        self.client = table.meta.client
+
+    def add_units(self, day: str, units: int) -> int:
+        response = self.client.update_item(
+            TableName=self.table.name,
+            Key={'key': f'units#{day}'},
+            UpdateExpression='ADD #units :units',
+            ExpressionAttributeNames={'#units': 'units'},
+            ExpressionAttributeValues={':units': units},
+            ReturnValues='UPDATED_NEW'
+        )
+        return int(response['Attributes']['units'])
+
+    def get_units(self, day: str) -> int:
+        item = self.client.get_item(TableName=self.table.name, Key={'key': f'units#{day}'}).get('Item')
+        return 0 if item is None else int(item['units'])
+
+    def defer(self, urls: List[str]):
+        if len(urls) > 0:
+            self.client.update_item(
+                TableName=self.table.name,
+                Key={'key': 'deferred'},
+                UpdateExpression='ADD urls :urls',
+                ExpressionAttributeValues={':urls': set(urls)}
+            )
+
+    def get_deferred(self) -> List[str]:
+        item = self.client.get_item(TableName=self.table.name, Key={'key': 'deferred'}).get('Item')
+        return sorted(item.get('urls', set())) if item is not None else []
+
+    def remove_deferred(self, urls: List[str]):
+        # Only the given URLs are removed, so that those deferred meanwhile are kept.
+        if len(urls) > 0:
+            self.client.update_item(
+                TableName=self.table.name,
+                Key={'key': 'deferred'},
+                UpdateExpression='DELETE urls :urls',
+                ExpressionAttributeValues={':urls': set(urls)}
+            )
+
+
+class QuotaLedger:
+    """
+    Accounts the quota units spent on the YouTube Data API.
+
+    Once the units spent today reach `defer_ratio` of `daily_limit`, `can_spend` turns false,
+    and the work is expected to be deferred to a later run with `defer` instead of being dropped.
+    """
+
+    def __init__(self, store: QuotaStore, daily_limit: int = DEFAULT_DAILY_LIMIT, defer_ratio: float = 0.95,
+                 clock: Callable[[], datetime] = utc_now):
+        self.store = store
+        self.daily_limit = daily_limit
+        self.defer_ratio = defer_ratio
+        self.clock = clock
+        self.spent: Dict[str, int] = Counter()
+        self.exhausted = False
+        self._used_today = None
+        self._day = None
+        self._lock = threading.Lock()
+        # The deferred URLs being fetched in this run, see `deferred`.
+        self._resuming: Set[str] = set()
+
+    def today(self) -> str:
+        return self.clock().astimezone(QUOTA_TIMEZONE).strftime('%Y-%m-%d')
+
+    def used_today(self) -> int:
+        day = self.today()
+
+        if self._day != day:
+            self._day = day
+            self._used_today = self.store.get_units(day)
+            self.exhausted = False
+
+        return self._used_today
+
+    def can_spend(self, call_type: str) -> bool:
+        with self._lock:
+            used = self.used_today()
+            return not self.exhausted and used + QUOTA_COSTS[call_type] <= self.daily_limit * self.defer_ratio
+
+    def record(self, call_type: str):
+        cost = QUOTA_COSTS[call_type]
+
+        with self._lock:
+            self.used_today()
+            self.spent[call_type] += cost
+            self._used_today = self.store.add_units(self._day, cost)
+
+    def mark_exhausted(self):
+        """
+        Stop spending for the rest of the day, e.g. when the API says the quota has been exceeded.
+        """
+        with self._lock:
+            self.used_today()
+            self.exhausted = True
+
+    def defer(self, urls: List[str]):
+        if len(urls) > 0:
+            logger.warning('Deferring %d videos to a later run to save the YouTube API quota.', len(urls))
+            with self._lock:
+                self.store.defer(urls)
+
+    def deferred(self) -> List[str]:
+        """
+        Returns the deferred URLs, which are kept in the store until `resolve_deferred` once the videos are saved,
+        so that they are not lost if this run fails.
+        """
+        urls = self.store.get_deferred()
+        with self._lock:
+            self._resuming.update(urls)
+
+        return urls
+
+    def resolve_deferred(self, urls: List[str]):
+        """
+        Remove the URLs returned by `deferred` from the store. The other URLs are ignored without a request.
+        """
+        with self._lock:
+            resolved = sorted(self._resuming.intersection(urls))
+            self._resuming.difference_update(resolved)
+
+            if len(resolved) > 0:
+                self.store.remove_deferred(resolved)
+
+    def log_metrics(self):
+        logger.info('YouTube API quota: %s units spent in this run, %s/%d units spent today.',
+                    dict(self.spent), self._used_today, self.daily_limit)
+        metrics.count('QuotaUnitsSpent', sum(self.spent.values()))
+        if self._used_today is not None:
+            metrics.count('QuotaUsedToday', self._used_today / self.daily_limit * 100, unit='Percent')
+
+
+def quota_ledger() -> Optional[QuotaLedger]:
+    """
+    Returns the quota ledger persisted in the table `QUOTA_TABLE`, or in the local file `QUOTA_FILE`, if any.
+    """
+    if 'QUOTA_TABLE' in os.environ:
+        store = DynamoDBQuotaStore(boto3.resource('dynamodb').Table(os.environ['QUOTA_TABLE']))
+    elif 'QUOTA_FILE' in os.environ:
+        store = FileQuotaStore(os.environ['QUOTA_FILE'])
+    else:
+        return None
+
+    return QuotaLedger(store, daily_limit=int(os.environ.get('YOUTUBE_DAILY_QUOTA', DEFAULT_DAILY_LIMIT)))
@@ -0,0 +1,272 @@
+"""
+Replays the archive of the crawled webpages, fetching and saving the videos new on each crawl.
+
+Run from the repository root, against a local directory of crawled pages or the bucket:
+
+    python -m vhub.replay (--dir PATH | --bucket NAME) [--start-after KEY] [--until KEY]
+                          [--checkpoint PATH] [--workers N] [--batch-size N] [--dry-run]
+
+The pages are walked in the order of their keys, i.e. from the newest to the oldest crawl,
+and the videos on each page but not on the one crawled just before are collected.
+Unless `--dry-run`, the videos are saved into `VIDEOS_TABLE` in batches, as `fetch_video` does.
+With `--checkpoint`, the progress is saved after every batch, and a later run resumes from there.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional, Set, Tuple
+
+from toolz import partition_all
+
+from .compression import GZIP, ZstdCodec, is_crawl_key
+from .parsers import parse_videos_list
+from .utils import read_envelope, extract_page
+from .youtube import YoutubeVideo, youtube_video_url
+
+logger = logging.getLogger()
+
+
+class Archive(ABC):
+    """
+    The crawled webpages, keyed as in the bucket.
+    """
+
+    @abstractmethod
+    def keys(self, start_after: Optional[str] = None) -> Iterator[str]:
+        """
+        Generate the keys of the crawled pages after `start_after`, in ascending order.
+        """
+        pass
+
+    @abstractmethod
+    def read(self, key: str, with_body: bool = True) -> dict:
+        pass
+
+
+class LocalArchive(Archive):
+    """
+    A directory of crawled pages, e.g. a copy of the bucket. Pages compressed with a zstd dictionary are not supported.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def keys(self, start_after: Optional[str] = None) -> Iterator[str]:
+        keys = sorted(key for key in os.listdir(self.directory) if is_crawl_key(key))
+        return (key for key in keys if start_after is None or key > start_after)
+
+    def read(self, key: str, with_body: bool = True) -> dict:
+        codec = ZstdCodec() if key.endswith(ZstdCodec.extension) else GZIP
+
+        with open(os.path.join(self.directory, key), 'rb') as f:
+            return read_envelope(f, with_body=with_body, codec=codec)
+
+
+class S3Archive(Archive):
+    """
+    The bucket of the crawled pages, listed with a single paginated `ListObjectsV2`.
+    """
+
+    def __init__(self, bucket_name: str):
+        self.bucket_name = bucket_name
+
+    def keys(self, start_after: Optional[str] = None) -> Iterator[str]:
+        import boto3
+
+        paginator = boto3.client('s3').get_paginator('list_objects_v2')
+        pages = paginator.paginate(Bucket=self.bucket_name, StartAfter=start_after or '')
+
+        for page in pages:
+            for content in page.get('Contents', []):
+                if is_crawl_key(content['Key']):
+                    yield content['Key']
+
+    def read(self, key: str, with_body: bool = True) -> dict:
+        import boto3
+
+        return extract_page(boto3.resource('s3').Object(self.bucket_name, key), with_body=with_body)
+
+
+def page_video_ids(archive: Archive, key: str) -> List[str]:
+    """
+    Returns the IDs of the videos on the page, parsing the body only if they were not saved alongside.
+    """
+    page = archive.read(key, with_body=False)
+
+    if page.get('videos') is None:
+        body = page['body'] if 'body' in page else archive.read(key)['body']
+        page['videos'] = [video.video_id for video in parse_videos_list(body)]
+
+    return page['videos']
+
+
+class Checkpoint:
+    """
+    The progress of a replay in a JSON file: the last key whose new videos have been saved,
+    and the IDs of all the videos saved so far.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Tuple[Optional[str], Set[str]]:
+        if not os.path.exists(self.path):
+            return None, set()
+
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+
+        return data['last_key'], set(data['seen'])
+
+    def save(self, last_key: str, seen: Set[str]):
+        # Written to a temporary file first, so that an interrupted run never leaves a broken checkpoint.
+        tmp_path = f"{self.path}.tmp"
+
+        with open(tmp_path, 'w') as f:
+            json.dump({'last_key': last_key, 'seen': sorted(seen)}, f)
+
+        os.replace(tmp_path, self.path)
+
+
+def snapshots(archive: Archive, keys: Iterable[str], workers: int = 4,
+              window: int = 64) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Generate the keys along with the video IDs of their pages, in the order of `keys`.
+
+    The pages are read and parsed by a pool of `workers` processes, `window` pages at a time.
+    """
+    if workers <= 1:
+        for key in keys:
+            yield key, page_video_ids(archive, key)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk in partition_all(window, keys):
+            yield from zip(chunk, executor.map(page_video_ids, [archive] * len(chunk), chunk))
+
+
+def new_videos(archive: Archive, keys: List[str], workers: int = 4) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Generate each key of `keys` along with the IDs of the videos new on its page,
+    i.e. not on the page of the next key, which was crawled just before.
+
+    The page of the last key is compared with the page of the key after it in the archive, if any.
+    """
+    if len(keys) == 0:
+        return
+
+    following = next(archive.keys(start_after=keys[-1]), None)
+    walk = keys + ([following] if following is not None else [])
+    pairs = snapshots(archive, walk, workers)
+
+    newer_key, newer_ids = next(pairs)
+
+    for older_key, older_ids in pairs:
+        yield newer_key, sorted(set(newer_ids) - set(older_ids))
+        newer_key, newer_ids = older_key, older_ids
+
+    if following is None:
+        yield newer_key, sorted(newer_ids)
+
+
+def replay(archive: Archive, keys: List[str], sink: Callable[[List[YoutubeVideo]], None],
+           checkpoint: Optional[Checkpoint] = None, workers: int = 4, batch_size: int = 500) -> int:
+    """
+    Pass the videos new on each page of `keys` to `sink` in batches of about `batch_size`,
+    each video only once, and save the progress into `checkpoint` after each batch.
+
+    Returns the number of the videos passed to `sink`.
+    """
+    last_key, seen = checkpoint.load() if checkpoint is not None else (None, set())
+    if last_key is not None:
+        keys = [key for key in keys if key > last_key]
+        logger.info('Resuming the replay after %s, with %d videos already saved.', last_key, len(seen))
+
+    pending: List[str] = []
+    n_videos = 0
+
+    def flush(key: str):
+        nonlocal pending, n_videos
+
+        if len(pending) > 0:
+            sink([YoutubeVideo(youtube_video_url(video_id)) for video_id in pending])
+            n_videos += len(pending)
+            logger.info('Replayed up to %s: %d videos.', key, n_videos)
+
+        pending = []
+        if checkpoint is not None:
+            checkpoint.save(key, seen)
+
+    key = None
+    for key, video_ids in new_videos(archive, keys, workers):
+        for video_id in video_ids:
+            if video_id not in seen:
+                seen.add(video_id)
+                pending.append(video_id)
+
+        if len(pending) >= batch_size:
+            flush(key)
+
+    if key is not None:
+        flush(key)
+
+    return n_videos
+
+
+def key_range(archive: Archive, start_after: Optional[str], until: Optional[str]) -> List[str]:
+    keys = []
+
+    for key in archive.keys(start_after=start_after):
+        if until is not None and key > until:
+            break
+        keys.append(key)
+
+    return keys
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--dir', help='A local directory of crawled pages.')
+    source.add_argument('--bucket', help='The bucket of crawled pages.')
+    parser.add_argument('--start-after', help='Replay the keys after this one.')
+    parser.add_argument('--until', help='Replay the keys up to and including this one.')
+    parser.add_argument('--checkpoint', help='Save the progress into this JSON file, resuming from it if it exists.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--dry-run', action='store_true', help='Print the new videos instead of saving them.')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    archive = LocalArchive(args.dir) if args.dir else S3Archive(args.bucket)
+    keys = key_range(archive, args.start_after, args.until)
+    checkpoint = Checkpoint(args.checkpoint) if args.checkpoint else None
+
+    if args.dry_run:
+        def sink(videos: List[YoutubeVideo]):
+            for video in videos:
+                print(video.url)
+    else:
+        import boto3
+        from .fetch_video import fetch_and_save_videos
+        from .quota import quota_ledger
+        from .youtube import YouTube, youtube_backend
+
+        table = boto3.resource('dynamodb').Table(os.environ['VIDEOS_TABLE'])
+        backend = youtube_backend(os.environ.get('YOUTUBE_BACKEND', 'google'), os.environ['GOOGLE_CLOUD_API_KEY'])
+        youtube = YouTube(backend=backend, ledger=quota_ledger())
+
+        def sink(videos: List[YoutubeVideo]):
+            fetch_and_save_videos(table, videos, youtube)
+
+    n_videos = replay(archive, keys, sink, checkpoint, workers=args.workers, batch_size=args.batch_size)
+    logger.info('Replayed %d pages: %d videos.', len(keys), n_videos)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,229 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Tuple, Callable, Optional, Set
+
+from boto3_type_annotations import dynamodb
+from botocore.exceptions import ClientError
+from toolz import partition_all
+
+from .utils import backoff_delay
+
+logger = logging.getLogger()
+
+# The maximum number of items accepted by a single `BatchWriteItem` call.
+MAX_BATCH_WRITE_ITEMS = 25
+
+# The maximum number of keys accepted by a single `BatchGetItem` call.
+MAX_BATCH_GET_KEYS = 100
+
+# The errors which go away by waiting, e.g. when the table runs out of its provisioned capacity.
+RETRYABLE_ERRORS = {
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'InternalServerError',
+}
+
+
+class UnprocessedItemsError(Exception):
+    pass
+
+
+def is_retryable(e: ClientError) -> bool:
+    return e.response.get('Error', {}).get('Code') in RETRYABLE_ERRORS
+
+
+def _batch_put_chunk(table: dynamodb.Table, items: List[dict], max_attempts: int,
+                     sleep: Callable[[float], None]) -> List[Tuple[dict, Exception]]:
+    requests = [{'PutRequest': {'Item': item}} for item in items]
+
+    for attempt in range(max_attempts):
+        if attempt > 0:
+            sleep(backoff_delay(attempt))
+
+        try:
+            response = table.meta.client.batch_write_item(RequestItems={table.name: requests})
+        except ClientError as e:
+            if is_retryable(e) and attempt + 1 < max_attempts:
+                logger.warning('BatchWriteItem was throttled, retrying: %s', e)
+                continue
+            else:
+                return [(request['PutRequest']['Item'], e) for request in requests]
+
+        requests = response.get('UnprocessedItems', {}).get(table.name, [])
+
+        if len(requests) == 0:
+            return []
+
+    error = UnprocessedItemsError(f'The item was left unprocessed after {max_attempts} attempts.')
+    return [(request['PutRequest']['Item'], error) for request in requests]
+
+
+def batch_put_items(table: dynamodb.Table, items: Iterable[dict], key: str = 'url',
+                    max_attempts: int = 8, sleep: Callable[[float], None] = time.sleep) -> List[Tuple[dict, Exception]]:
+    """
+    Put the items into the table with `BatchWriteItem` calls of up to 25 items each.
+
+    The `UnprocessedItems` are retried with an exponential backoff,
+    so that the writes are spread over time when the table runs out of its provisioned capacity.
+    Items sharing the same `key` are deduplicated, keeping the last one.
+
+    Returns the pairs of an item which could not be saved and the reason.
+    """
+    deduped = {item[key]: item for item in items}
+    failures = []
+
+    for chunk in partition_all(MAX_BATCH_WRITE_ITEMS, deduped.values()):
+        failures.extend(_batch_put_chunk(table, list(chunk), max_attempts, sleep))
+
+    return failures
+
+
+def _batch_get_chunk(table: dynamodb.Table, keys: List[dict], max_attempts: int,
+                     sleep: Callable[[float], None], projection: Optional[List[str]] = None) -> List[dict]:
+    request = {'Keys': keys}
+    if projection is not None:
+        names = {f'#a{i}': name for i, name in enumerate(projection)}
+        request['ProjectionExpression'] = ', '.join(names)
+        request['ExpressionAttributeNames'] = names
+
+    items = []
+
+    for attempt in range(max_attempts):
+        if attempt > 0:
+            sleep(backoff_delay(attempt))
+
+        try:
+            response = table.meta.client.batch_get_item(RequestItems={table.name: request})
+        except ClientError as e:
+            if is_retryable(e) and attempt + 1 < max_attempts:
+                logger.warning('BatchGetItem was throttled, retrying: %s', e)
+                continue
+            else:
+                raise
+
+        items.extend(response.get('Responses', {}).get(table.name, []))
+        # The unprocessed keys come back with the projection of the request.
+        request = response.get('UnprocessedKeys', {}).get(table.name)
+
+        if request is None or len(request['Keys']) == 0:
+            return items
+
+    raise UnprocessedItemsError(f'{len(request["Keys"])} keys were left unprocessed after {max_attempts} attempts.')
+
+
+def batch_get_items(table: dynamodb.Table, keys: Iterable[dict], projection: Optional[List[str]] = None,
+                    max_attempts: int = 8, sleep: Callable[[float], None] = time.sleep) -> List[dict]:
+    """
+    Get the items from the table with `BatchGetItem` calls of up to 100 keys each.
+
+    The `UnprocessedKeys` are retried with an exponential backoff.
+    Keys not found in the table are simply absent from the result, which is in no particular order.
+    With `projection`, only those attributes of the items are read.
+    """
+    deduped = {tuple(sorted(k.items())): k for k in keys}
+    items = []
+
+    for chunk in partition_all(MAX_BATCH_GET_KEYS, deduped.values()):
+        items.extend(_batch_get_chunk(table, list(chunk), max_attempts, sleep, projection))
+
+    return items
+
+
+def existing_keys(table: dynamodb.Table, values: Iterable[str], key: str = 'url',
+                  max_attempts: int = 8, sleep: Callable[[float], None] = time.sleep) -> Set[str]:
+    """
+    Returns the values of the hash key `key` which are in the table, reading nothing but the key.
+    """
+    items = batch_get_items(table, [{key: value} for value in values], [key], max_attempts, sleep)
+    return set(item[key] for item in items)
+
+
+def _put_new_item(table: dynamodb.Table, item: dict, key: str, max_attempts: int,
+                  sleep: Callable[[float], None]) -> Optional[Exception]:
+    for attempt in range(max_attempts):
+        if attempt > 0:
+            sleep(backoff_delay(attempt))
+
+        try:
+            table.meta.client.put_item(
+                TableName=table.name,
+                Item=item,
+                ConditionExpression='attribute_not_exists(#key)',
+                ExpressionAttributeNames={'#key': key}
+            )
+            return None
+        except ClientError as e:
+            if is_retryable(e) and attempt + 1 < max_attempts:
+                logger.warning('PutItem was throttled, retrying: %s', e)
+                continue
+            else:
+                return e
+
+
+def is_conditional_check_failure(e: Exception) -> bool:
+    return isinstance(e, ClientError) and \
+        e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+
+
+def put_new_items(table: dynamodb.Table, items: Iterable[dict], key: str = 'url', max_workers: int = 8,
+                  max_attempts: int = 8, sleep: Callable[[float], None] = time.sleep
+                  ) -> Tuple[List[dict], List[Tuple[dict, Exception]]]:
+    """
+    Put the items which are not in the table yet, leaving the existing ones untouched,
+    with a conditional `PutItem` per item (`BatchWriteItem` takes no conditions) by `max_workers` threads.
+
+    Unlike overwriting an item, skipping it emits no record to the stream of the table.
+
+    Returns the items skipped as they already exist, and the pairs of an item which could not be saved and the reason.
+    """
+    deduped = list({item[key]: item for item in items}.values())
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        errors = list(executor.map(lambda item: _put_new_item(table, item, key, max_attempts, sleep), deduped))
+
+    skipped = [item for item, e in zip(deduped, errors) if is_conditional_check_failure(e)]
+    failures = [(item, e) for item, e in zip(deduped, errors) if e is not None and not is_conditional_check_failure(e)]
+
+    return skipped, failures
+
+
+def _scan_segment(table: dynamodb.Table, segment: int, total_segments: int, max_attempts: int,
+                  sleep: Callable[[float], None]) -> List[dict]:
+    # Resources are not thread-safe, whereas clients are.
+    client = table.meta.client
+    kwargs = {'TableName': table.name, 'Segment': segment, 'TotalSegments': total_segments}
+    items = []
+    attempt = 0
+
+    while True:
+        try:
+            response = client.scan(**kwargs)
+        except ClientError as e:
+            attempt += 1
+            if is_retryable(e) and attempt < max_attempts:
+                logger.warning('Scan was throttled, retrying: %s', e)
+                sleep(backoff_delay(attempt))
+                continue
+            else:
+                raise
+
+        attempt = 0
+        items.extend(response.get('Items', []))
+
+        if 'LastEvaluatedKey' in response:
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        else:
+            return items
+
+
+def scan_items(table: dynamodb.Table, total_segments: int = 4,
+               max_attempts: int = 8, sleep: Callable[[float], None] = time.sleep) -> List[dict]:
+    """
+    Read every item in the table with a parallel `Scan` of `total_segments` segments.
+    """
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        futures = [executor.submit(_scan_segment, table, segment, total_segments, max_attempts, sleep)
+                   for segment in range(total_segments)]
+        return [item for future in futures for item in future.result()]
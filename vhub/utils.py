@@ -1,9 +1,17 @@
+import codecs
+import json
+import random
 from datetime import datetime, timezone
 from gzip import GzipFile
 from io import BytesIO
+from typing import BinaryIO
 
+from boto3_type_annotations import s3
 from toolz.dicttoolz import valmap
 
+from . import metrics
+from .compression import Codec, GZIP, codec_of
+
 
 def gzip_str(string: str, encoding='utf-8') -> bytes:
     out = BytesIO()
@@ -19,6 +27,64 @@ def extract_gzip(body: bytes, encoding='utf-8') -> str:
         return f.read().decode(encoding)
 
 
+# The envelope of a crawled page: a line of JSON with everything but the body, followed by the body as is.
+# The legacy envelope is a single JSON object including the body.
+ENVELOPE_FORMAT = 2
+
+
+def write_envelope(fileobj: BinaryIO, header: dict, body: str, codec: Codec = GZIP, encoding='utf-8',
+                   chunk_size: int = 1 << 16):
+    """
+    Write the compressed envelope into the file object, encoding and compressing the body chunk by chunk.
+    """
+    with codec.writer(fileobj) as f:
+        f.write(json.dumps({**header, 'format': ENVELOPE_FORMAT}, default=str).encode(encoding) + b'\n')
+
+        for i in range(0, len(body), chunk_size):
+            f.write(body[i:i + chunk_size].encode(encoding))
+
+
+def read_text(fileobj: BinaryIO, encoding='utf-8', chunk_size: int = 1 << 16) -> str:
+    """
+    Read the rest of the file object as text, decoding it chunk by chunk instead of holding the whole bytes.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    chunks = [decoder.decode(chunk) for chunk in iter(lambda: fileobj.read(chunk_size), b'')]
+    chunks.append(decoder.decode(b'', final=True))
+
+    return ''.join(chunks)
+
+
+def read_envelope(fileobj: BinaryIO, with_body: bool = True, codec: Codec = GZIP, encoding='utf-8') -> dict:
+    """
+    Read the compressed envelope from the file object, e.g. the `StreamingBody` of an S3 object,
+    decompressing it on the fly.
+
+    Unless `with_body`, the stream is left unread after the header. The legacy envelopes are always read in full.
+    """
+    with codec.reader(fileobj) as f:
+        page = json.loads(f.readline().decode(encoding))
+
+        if page.pop('format', None) == ENVELOPE_FORMAT and with_body:
+            page['body'] = read_text(f, encoding)
+
+    return page
+
+
+def extract_page(obj: s3.Object, with_body: bool = True) -> dict:
+    """
+    Read the crawled page, decompressing it as it is downloaded. Unless `with_body`, the body may be left unread.
+    """
+    with metrics.timer('S3Get'):
+        response = obj.get()
+
+    codec = codec_of(response.get('ContentEncoding'), response.get('Metadata', {}), obj.bucket_name)
+
+    # The body is downloaded and decompressed as it is read, so the two are timed together.
+    with metrics.timer('PageRead'):
+        return read_envelope(response['Body'], with_body=with_body, codec=codec)
+
+
 def utc_now() -> datetime:
     return datetime.now(timezone.utc)
 
@@ -44,3 +110,10 @@ def emptystr_to_none(item):
         return valmap(emptystr_to_none, item)
     else:
         return None if item == "" else item
+
+
+def backoff_delay(attempt: int, base: float = 0.05, cap: float = 10.0) -> float:
+    """
+    Returns the seconds to wait before the `attempt`-th retry, using the exponential backoff with full jitter.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
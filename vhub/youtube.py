@@ -1,17 +1,84 @@
+import json
+import logging
+import os
 import re
-from typing import Optional, List
+import threading
+import time
+from abc import ABC, abstractmethod
+from operator import attrgetter
+from typing import Optional, List, Dict, Iterable, Callable, Tuple, TYPE_CHECKING
 from urllib.parse import urlparse, parse_qs
 
-from googleapiclient.discovery import build
+from toolz import partition_all
+
+from . import metrics
+from .mentions import MentionMatcher, default_matcher, channel_url
+from .utils import backoff_delay
+
+if TYPE_CHECKING:
+    import requests
+    from .quota import QuotaLedger
+
+logger = logging.getLogger()
+
+# The discovery documents bundled with the package, so that building the client needs no network round trip.
+DISCOVERY_DIR = os.path.join(os.path.dirname(__file__), 'discovery')
+
+# The maximum number of comma-separated IDs accepted by a single `videos.list` request.
+MAX_IDS_PER_REQUEST = 50
+
+
+# The canonical form of video URLs, which is matched before falling back to parsing the URL in full.
+_canonical_video_url = re.compile(r"https://www\.youtube\.com/watch\?v=([a-zA-Z0-9_\-]+)")
+_video_id = re.compile(r"[a-zA-Z0-9_\-]+")
+
+
+def parse_youtube_video_id(url: str) -> Optional[str]:
+    """
+    Returns the video ID of the URL, or `None` if it is not a valid YouTube video URL.
+    """
+    match = _canonical_video_url.fullmatch(url)
+
+    if match is not None:
+        return match.group(1)
+
+    o = urlparse(url)
+    qs = parse_qs(o.query)
+
+    if o.scheme == 'https' \
+            and o.netloc == 'www.youtube.com' \
+            and o.path == '/watch' \
+            and 'v' in qs \
+            and _video_id.fullmatch(qs['v'][0]) is not None:
+        return qs['v'][0]
+    else:
+        return None
 
 
 class YoutubeVideo:
+    """
+    A YouTube video, whose attributes other than the URL are filled in by the API if known.
+
+    The video ID is parsed from the URL once on construction.
+    """
+    # The attributes saved in the Videos table, in the order of the constructor arguments.
+    FIELDS = ('url', 'channel_url', 'title', 'description', 'published_at', 'tags', 'thumbnails',
+              'channel_title', 'live_broadcast_content', 'n_watch', 'n_like',
+              'category_id', 'default_language', 'localized')
+
+    __slots__ = FIELDS + ('video_id',)
+
+    _get_fields = attrgetter(*FIELDS)
+
     def __init__(self, url: str, channel_url=None, title=None,
                  description=None, published_at=None, tags=None, thumbnails=None,
                  channel_title=None, live_broadcast_content=None, n_watch=None, n_like=None,
                  category_id=None, default_language=None, localized=None):
-        if is_valid_youtube_video_url(url):
+        video_id = parse_youtube_video_id(url)
+
+        if video_id is not None:
             self.url = url
+            self.video_id = video_id
             self.channel_url = channel_url
             self.channel_title = channel_title
             self.title = title
@@ -28,8 +95,18 @@ class YoutubeVideo:
         else:
             raise ValueError(f"{url} is not a valid YouTube video URL.")
 
+    def to_item(self) -> dict:
+        """
+        Returns the item of the Videos table.
+        """
+        return dict(zip(self.FIELDS, self._get_fields(self)))
+
+    @classmethod
+    def from_item(cls, item: dict) -> 'YoutubeVideo':
+        return cls(**{field: item[field] for field in cls.FIELDS if field in item})
+
     def __str__(self):
-        return str(vars(self))
+        return str(self.to_item())
 
     def __hash__(self):
         return hash(self.url)
@@ -38,14 +115,204 @@ class YoutubeVideo:
         return isinstance(other, YoutubeVideo) and self.url == other.url
 
 
-class YouTube:
+def read_discovery_document(service: str, version: str) -> Optional[str]:
+    path = os.path.join(DISCOVERY_DIR, f"{service}.{version}.json")
+
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return f.read()
+    else:
+        return None
+
+
+class QuotaExceededError(Exception):
+    """
+    Raised when the API refuses a request because the daily quota has been exceeded.
+    """
+    pass
+
+
+# The error reasons in a 403 response meaning the daily quota has been exceeded.
+QUOTA_EXCEEDED_REASONS = {'quotaExceeded', 'dailyLimitExceeded'}
+
+
+def is_quota_exceeded(status: int, content) -> bool:
+    if status != 403:
+        return False
+
+    try:
+        errors = json.loads(content)['error']['errors']
+        return any(error.get('reason') in QUOTA_EXCEEDED_REASONS for error in errors)
+    except (ValueError, KeyError, TypeError):
+        return False
+
+
+class YouTubeBackend(ABC):
+    """
+    The transport calling the YouTube Data API on behalf of `YouTube`.
+    """
+
+    @abstractmethod
+    def list_videos(self, video_ids: List[str]) -> dict:
+        """
+        Call `videos.list` with `part=snippet` for up to 50 videos, and return the response body.
+
+        Raises `QuotaExceededError` if the daily quota has been exceeded.
+        """
+        pass
+
+    @abstractmethod
+    def list_channels(self, channel_ids: List[str]) -> dict:
+        """
+        Call `channels.list` with `part=snippet` for up to 50 channels, and return the response body.
+
+        Raises `QuotaExceededError` if the daily quota has been exceeded.
+        """
+        pass
+
+
+class GoogleApiBackend(YouTubeBackend):
+    """
+    Calls the API through the official client library, googleapiclient.
+
+    Unless `http` is given, each thread gets its own HTTP connection, since httplib2 is not thread-safe.
+    """
+
     def __init__(self, secret: str, version: str = "v3", http=None):
-        self.youtube = build("youtube", version,
-                             developerKey=secret, http=http, cache_discovery=False)
+        self.http = http
+        self._local = threading.local()
+
+        # googleapiclient is slow to import, so it is imported only when a client is actually needed.
+        from googleapiclient.discovery import build, build_from_document
+
+        document = read_discovery_document("youtube", version)
+
+        if document is not None:
+            self.youtube = build_from_document(document, developerKey=secret, http=http)
+        else:
+            self.youtube = build("youtube", version,
+                                 developerKey=secret, http=http, cache_discovery=False)
+
+    def _execute(self, req) -> dict:
+        from googleapiclient.errors import HttpError
+        from googleapiclient.http import build_http
+
+        if self.http is None and not hasattr(self._local, "http"):
+            self._local.http = build_http()
+
+        try:
+            return req.execute(http=self.http or self._local.http)
+        except HttpError as e:
+            if is_quota_exceeded(e.resp.status, e.content):
+                raise QuotaExceededError(str(e)) from e
+            else:
+                raise
+
+    def list_videos(self, video_ids: List[str]) -> dict:
+        return self._execute(self.youtube.videos().list(part="snippet", id=",".join(video_ids)))
+
+    def list_channels(self, channel_ids: List[str]) -> dict:
+        return self._execute(self.youtube.channels().list(part="snippet", id=",".join(channel_ids)))
+
+
+_session = None
+
+
+def shared_session() -> 'requests.Session':
+    """
+    Returns the HTTP session shared within the process, which keeps the connections alive across calls.
+    """
+    global _session
+
+    if _session is None:
+        import requests
+
+        _session = requests.Session()
+        _session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+        # Google APIs compress the response only if the user agent contains "gzip".
+        _session.headers.update({"Accept-Encoding": "gzip", "User-Agent": "vhub (gzip)"})
+
+    return _session
+
+
+class RestBackend(YouTubeBackend):
+    """
+    Calls the REST endpoint directly through a pooled `requests.Session`.
+
+    Requests are retried with an exponential backoff on 429 and 5xx responses and on connection errors,
+    honoring the `Retry-After` header if any.
+    """
+    BASE_URL = "https://www.googleapis.com/youtube/v3"
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, secret: str, session: 'requests.Session' = None, timeout: Tuple[float, float] = (3.05, 10),
+                 max_attempts: int = 4, sleep: Callable[[float], None] = time.sleep):
+        self.secret = secret
+        self.session = session if session is not None else shared_session()
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.sleep = sleep
+
+    def _retry_delay(self, attempt: int, response: Optional['requests.Response']) -> float:
+        retry_after = None if response is None else response.headers.get("Retry-After")
+
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        else:
+            return backoff_delay(attempt, base=0.5)
+
+    def _get(self, resource: str, ids: List[str]) -> dict:
+        import requests
+
+        params = {"part": "snippet", "id": ",".join(ids), "key": self.secret}
+
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                response = self.session.get(f"{self.BASE_URL}/{resource}", params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt < self.max_attempts:
+                    self.sleep(self._retry_delay(attempt, None))
+                    continue
+                else:
+                    raise
+
+            if response.status_code in self.RETRY_STATUSES and attempt < self.max_attempts:
+                self.sleep(self._retry_delay(attempt, response))
+                continue
+
+            if is_quota_exceeded(response.status_code, response.content):
+                raise QuotaExceededError(response.text)
+
+            response.raise_for_status()
+            return response.json()
+
+    def list_videos(self, video_ids: List[str]) -> dict:
+        return self._get("videos", video_ids)
+
+    def list_channels(self, channel_ids: List[str]) -> dict:
+        return self._get("channels", channel_ids)
+
+
+def youtube_backend(name: str, secret: str) -> YouTubeBackend:
+    """
+    Returns the backend of the name, either "google" (googleapiclient) or "rest" (plain HTTP calls).
+    """
+    if name == "google":
+        return GoogleApiBackend(secret)
+    elif name == "rest":
+        return RestBackend(secret)
+    else:
+        raise ValueError(f"Unknown YouTube backend: {name}")
+
+
+class YouTube:
+    def __init__(self, secret: Optional[str] = None, version: str = "v3", http=None,
+                 backend: Optional[YouTubeBackend] = None, ledger: Optional['QuotaLedger'] = None):
+        self.backend = backend if backend is not None else GoogleApiBackend(secret, version, http)
+        self.ledger = ledger
 
     def _get_video_by_id(self, video_id: str) -> dict:
-        req = self.youtube.videos().list(part="snippet", id=video_id)
-        return req.execute()
+        return self.backend.list_videos([video_id])
 
     def get_video_by_id(self, video_id: str) -> Optional[dict]:
         res = self._get_video_by_id(video_id)
@@ -56,41 +323,163 @@ class YouTube:
         else:
             return items[0]
 
+    def get_videos_by_ids(self, video_ids: List[str]) -> Dict[str, dict]:
+        """
+        Fetch up to 50 videos with a single API call.
+
+        Returns a dictionary keyed by the video ID, which does not contain the videos not found.
+        """
+        metrics.count('YouTubeApiCalls')
+
+        with metrics.timer('YouTubeApi'):
+            res = self.backend.list_videos(video_ids)
+
+        return {item['id']: item for item in res['items']}
+
     def get_video_detail(self, video: YoutubeVideo) -> Optional[YoutubeVideo]:
-        video_id = parse_qs(urlparse(video.url).query)['v'][0]
-        res = self.get_video_by_id(video_id)
+        res = self.get_video_by_id(video.video_id)
+        return video_detail(video, res)
 
-        if res is None:
-            return None
-        else:
-            s = res["snippet"]
-            base_url = "https://www.youtube.com/channel"
-            channel_id = s.get('channelId')
-            channel_url = f"{base_url}/{channel_id}" if 'channelId' in s else None
-
-            return YoutubeVideo(
-                url=video.url,
-                n_watch=video.n_watch,
-                n_like=video.n_like,
-                channel_url=channel_url,
-                channel_title=s.get('channelTitle'),
-                title=s.get('title'),
-                description=s.get('description'),
-                published_at=s.get('publishedAt'),
-                tags=s.get('tags', []),
-                thumbnails=s.get('thumbnails'),
-                live_broadcast_content=s.get('liveBroadcastContent', 'none'),
-                category_id=s.get('categoryId'),
-                default_language=s.get('defaultLanguage'),
-                localized=s.get('localized')
-            )
+    def get_video_details(self, videos: Iterable[YoutubeVideo]) -> List[Optional[YoutubeVideo]]:
+        """
+        Fetch the details of the videos, calling the API once per 50 videos.
+
+        The result is in the same order as `videos`.
+        A video is mapped to `None` if it is not found, or if the API call for its chunk failed.
+
+        With a quota ledger, the videos are not fetched but deferred to a later run
+        once the quota is (nearly) exhausted; they are mapped to `None` as well.
+        """
+        details = []
+
+        for chunk in partition_all(MAX_IDS_PER_REQUEST, videos):
+            if self.ledger is not None and not self.ledger.can_spend('videos.list'):
+                self.ledger.defer([video.url for video in chunk])
+                metrics.count('VideosDeferred', len(chunk))
+                details.extend(None for _ in chunk)
+                continue
+
+            try:
+                items = self.get_videos_by_ids([video.video_id for video in chunk])
+            except QuotaExceededError as e:
+                logger.error('The YouTube API quota has been exceeded: %s', e)
+                if self.ledger is not None:
+                    self.ledger.mark_exhausted()
+                    self.ledger.defer([video.url for video in chunk])
+                    metrics.count('VideosDeferred', len(chunk))
+                details.extend(None for _ in chunk)
+                continue
+            except Exception as e:
+                metrics.count('YouTubeApiErrors')
+                logger.error('YouTube API gave an error while getting details of the videos: %s',
+                             [video.url for video in chunk])
+                logger.exception('The reason being: %s', e)
+                items = {}
+
+            if self.ledger is not None:
+                self.ledger.record('videos.list')
+
+            details.extend(video_detail(video, items.get(video.video_id)) for video in chunk)
+
+        return details
+
+    def get_custom_urls(self, channels: Iterable['YoutubeChannel']) -> Dict[str, str]:
+        """
+        Fetch the custom URLs (the handle, or the legacy custom name) of the channels, calling the API once per 50.
+
+        Returns a dictionary from the channel URLs to their custom URLs, which does not contain the channels
+        without a custom URL, nor those left unfetched once the quota (nearly) runs out or an API call fails.
+        """
+        custom_urls = {}
+        channels = [channel for channel in channels if channel.channel_id is not None]
+
+        for chunk in partition_all(MAX_IDS_PER_REQUEST, channels):
+            if self.ledger is not None and not self.ledger.can_spend('channels.list'):
+                logger.warning('Skipping the custom URLs of %d channels to save the YouTube API quota.', len(chunk))
+                break
+
+            metrics.count('YouTubeApiCalls')
+
+            try:
+                with metrics.timer('YouTubeApi'):
+                    res = self.backend.list_channels([channel.channel_id for channel in chunk])
+            except QuotaExceededError as e:
+                logger.error('The YouTube API quota has been exceeded: %s', e)
+                if self.ledger is not None:
+                    self.ledger.mark_exhausted()
+                break
+            except Exception as e:
+                metrics.count('YouTubeApiErrors')
+                logger.error('YouTube API gave an error while getting the channels: %s',
+                             [channel.url for channel in chunk])
+                logger.exception('The reason being: %s', e)
+                continue
+
+            if self.ledger is not None:
+                self.ledger.record('channels.list')
+
+            for item in res.get('items', []):
+                custom_url = item['snippet'].get('customUrl')
+                if custom_url:
+                    custom_urls[channel_url(item['id'])] = custom_url
+
+        return custom_urls
+
+
+def video_detail(video: YoutubeVideo, res: Optional[dict]) -> Optional[YoutubeVideo]:
+    """
+    Build a `YoutubeVideo` from a resource returned by the `videos.list` API.
+    """
+    if res is None:
+        return None
+    else:
+        s = res["snippet"]
+        base_url = "https://www.youtube.com/channel"
+        channel_id = s.get('channelId')
+        channel_url = f"{base_url}/{channel_id}" if 'channelId' in s else None
+
+        return YoutubeVideo(
+            url=video.url,
+            n_watch=video.n_watch,
+            n_like=video.n_like,
+            channel_url=channel_url,
+            channel_title=s.get('channelTitle'),
+            title=s.get('title'),
+            description=s.get('description'),
+            published_at=s.get('publishedAt'),
+            tags=s.get('tags', []),
+            thumbnails=s.get('thumbnails'),
+            live_broadcast_content=s.get('liveBroadcastContent', 'none'),
+            category_id=s.get('categoryId'),
+            default_language=s.get('defaultLanguage'),
+            localized=s.get('localized')
+        )
+
+
+_channel_url = re.compile(r"https:\/\/www\.youtube\.com\/(channel|c|user)\/([a-zA-Z0-9_\-]+)")
 
 
 class YoutubeChannel:
+    """
+    A YouTube channel, whose ID is parsed from the URL once on construction.
+
+    `channel_id` is `None` for the custom URLs (/c/ and /user/), which do not contain the ID.
+    """
+    # The attributes saved in the Channels table, in the order of the constructor arguments.
+    FIELDS = ('url', 'name', 'n_subscriber', 'thumbnail', 'affiliations',
+              'is_host_blacklisted', 'is_guest_blacklisted')
+
+    __slots__ = FIELDS + ('channel_id',)
+
+    _get_fields = attrgetter(*FIELDS)
+
     def __init__(self, url, name=None, n_subscriber=None, thumbnail=None, affiliations=None,
                  is_host_blacklisted=False, is_guest_blacklisted=False):
-        if is_valid_youtube_channel_url(url):
+        match = _channel_url.fullmatch(url)
+
+        if match is not None:
             self.url = url
+            self.channel_id = match.group(2) if match.group(1) == 'channel' else None
             self.name = name
             self.n_subscriber = n_subscriber
             self.thumbnail = thumbnail
@@ -100,35 +489,41 @@ class YoutubeChannel:
         else:
             raise ValueError(f"{url} is not a valid YouTube channel URL.")
 
+    def to_item(self) -> dict:
+        """
+        Returns the item of the Channels table.
+        """
+        return dict(zip(self.FIELDS, self._get_fields(self)))
+
+    @classmethod
+    def from_item(cls, item: dict) -> 'YoutubeChannel':
+        return cls(**{field: item[field] for field in cls.FIELDS if field in item})
+
+    def __str__(self):
+        return str(self.to_item())
+
 
 def is_valid_youtube_channel_url(url: str) -> bool:
-    channel_url_regex = r"https:\/\/www\.youtube\.com\/(?:channel|c|user)\/[a-zA-Z0-9_\-]+"
-    match = re.fullmatch(channel_url_regex, url)
-    return match is not None
+    return _channel_url.fullmatch(url) is not None
 
 
-def mentioned_channel_urls(video: YoutubeVideo) -> List[str]:
-    if video.description is None:
-        return []
-    else:
-        channel_url_regex = r"https:\/\/www\.youtube\.com\/(?:channel|c|user)\/[a-zA-Z0-9_\-]+"
-        urls = re.findall(channel_url_regex, video.description)
-        return list(set(urls) - {video.channel_url})
+def mentioned_channel_urls(video: YoutubeVideo, matcher: MentionMatcher = default_matcher) -> List[str]:
+    """
+    Returns the canonical URLs of the channels mentioned in the description, other than the video's own channel.
+    """
+    return [url for url in matcher.channel_urls(video.description) if url != video.channel_url]
 
 
 def is_valid_youtube_video_url(url: str) -> bool:
-    o = urlparse(url)
-    qs = parse_qs(o.query)
+    return parse_youtube_video_id(url) is not None
+
 
-    return o.scheme == 'https' \
-        and o.netloc == 'www.youtube.com' \
-        and o.path == '/watch' \
-        and 'v' in qs \
-        and re.fullmatch(r"[a-zA-Z0-9_\-]+", qs['v'][0]) is not None
+def youtube_video_url(video_id: str) -> str:
+    return f"https://www.youtube.com/watch?v={video_id}"
 
 
 def short_youtube_video_url(url: str) -> str:
-    if is_valid_youtube_video_url(url):
-        o = urlparse(url)
-        video_id = parse_qs(o.query)['v'][0]
+    video_id = parse_youtube_video_id(url)
+
+    if video_id is not None:
         return f"https://youtu.be/{video_id}"